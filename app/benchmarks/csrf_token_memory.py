@@ -0,0 +1,74 @@
+"""
+Measures the Redis memory taken by each public session's CSRF tokens, after the session has been given a new
+token a number of times: kept in a capped set per session, against the legacy single key per token.
+
+This needs a real Redis at REDIS_DSN, for MEMORY USAGE. Every key it creates is deleted again afterwards.
+
+    python -m benchmarks.csrf_token_memory --sessions 1000 --rotations 50
+"""
+import argparse
+import asyncio
+from secrets import token_urlsafe
+from typing import List
+
+from liminus.middlewares.public_session_csrf_jwt import PublicSessionMiddleware
+from liminus.redis_client import redis_client
+
+
+async def memory_usage(keys: List[str]) -> int:
+    pipeline = redis_client().pipeline(transaction=False)
+    for key in keys:
+        pipeline.memory_usage(key)
+    return sum(usage or 0 for usage in await pipeline.execute())
+
+
+async def per_session_tokens(session_ids: List[str], rotations: int) -> int:
+    middleware = PublicSessionMiddleware()
+    for session_id in session_ids:
+        for _ in range(rotations):
+            await middleware._store_new_csrf(session_id, token_urlsafe(32))
+
+    keys = [middleware._get_csrf_tokens_key(session_id, '') for session_id in session_ids]
+    try:
+        return await memory_usage(keys)
+    finally:
+        await redis_client().delete(*keys)
+
+
+async def legacy_tokens(session_ids: List[str], rotations: int) -> int:
+    middleware = PublicSessionMiddleware()
+    keys = [
+        middleware._get_legacy_csrf_cache_key(session_id, token_urlsafe(32))
+        for session_id in session_ids
+        for _ in range(rotations)
+    ]
+    pipeline = redis_client().pipeline(transaction=False)
+    for key in keys:
+        pipeline.set(key, '1')
+    await pipeline.execute()
+
+    try:
+        return await memory_usage(keys)
+    finally:
+        await redis_client().delete(*keys)
+
+
+async def measure(args: argparse.Namespace):
+    session_ids = [token_urlsafe(32) for _ in range(args.sessions)]
+    per_session = await per_session_tokens(session_ids, args.rotations)
+    legacy = await legacy_tokens(session_ids, args.rotations)
+
+    print(f'{args.sessions} sessions, each given {args.rotations} CSRF tokens')
+    print(f'   per session set: {per_session / args.sessions:10.0f} bytes per session')
+    print(f'  legacy token keys: {legacy / args.sessions:10.0f} bytes per session, and never expiring')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--rotations', type=int, default=50)
+    asyncio.run(measure(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Compares the per-request overhead of the pure ASGI RequestLoggingMiddleware and GatekeeperMiddlewareRunner
+against equivalent BaseHTTPMiddleware ports, each served by uvicorn workers.
+
+Requests go to /health/ping, which resolves to the health check backend and is answered directly,
+so the difference between the two runs is the middleware plumbing rather than any upstream.
+
+    python -m benchmarks.middleware_overhead --workers 2 --requests 20000 --concurrency 64
+"""
+import argparse
+import asyncio
+import statistics
+import subprocess
+import sys
+from secrets import token_hex
+from timeit import default_timer as timer
+from typing import List
+
+import aiohttp
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp
+
+from liminus import health_check
+from liminus.constants import Headers
+from liminus.errors import ErrorResponse
+from liminus.middleware_runner import GatekeeperMiddlewareRunner
+from liminus.middlewares.request_logging import RequestLoggingMiddleware
+
+
+class BaseHttpRequestLoggingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
+        request.scope['request_id'] = token_hex(4)
+        response = await call_next(request)
+        response.headers[Headers.X_REQUEST_ID] = request.scope['request_id']
+        return response
+
+
+class BaseHttpGatekeeperMiddlewareRunner(BaseHTTPMiddleware):
+    def __init__(self, app: ASGIApp) -> None:
+        super().__init__(app)
+        # reuse the real runner's resolution and hooks, so only the middleware plumbing differs
+        self.runner = GatekeeperMiddlewareRunner(app)
+
+    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
+        try:
+            backend, listener, reqset = self.runner._resolve_backend_and_route(request)
+            self.runner._augment_request_scope(request, backend, listener, reqset)
+            early_response = await self.runner._run_request_hooks(request, reqset, backend)
+            if early_response:
+                return early_response
+
+            response = await call_next(request)
+            replacement_response = await self.runner._run_response_hooks(response, request, reqset, backend)
+            return replacement_response or response
+
+        except ErrorResponse as error:
+            return error.response
+
+
+base_http_app = Starlette(
+    routes=health_check.routes,
+    middleware=[Middleware(BaseHttpRequestLoggingMiddleware), Middleware(BaseHttpGatekeeperMiddlewareRunner)],
+)
+pure_asgi_app = Starlette(
+    routes=health_check.routes,
+    middleware=[Middleware(RequestLoggingMiddleware), Middleware(GatekeeperMiddlewareRunner)],
+)
+
+
+async def wait_until_ready(url: str, timeout: float = 20):
+    deadline = timer() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if timer() > deadline:
+                raise TimeoutError(f'{url} did not become ready')
+            await asyncio.sleep(0.1)
+
+
+async def run_load(url: str, total_requests: int, concurrency: int) -> List[float]:
+    latencies: List[float] = []
+    remaining = iter(range(total_requests))
+
+    async def worker(session: aiohttp.ClientSession):
+        for _ in remaining:
+            start = timer()
+            async with session.get(url) as response:
+                await response.read()
+            latencies.append(timer() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+    return latencies
+
+
+def benchmark(app_name: str, args: argparse.Namespace) -> dict:
+    url = f'http://127.0.0.1:{args.port}/health/ping'
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            '-m',
+            'uvicorn',
+            f'benchmarks.middleware_overhead:{app_name}',
+            '--port',
+            str(args.port),
+            '--workers',
+            str(args.workers),
+            '--log-level',
+            'warning',
+            '--no-access-log',
+        ]
+    )
+    try:
+        asyncio.run(wait_until_ready(url))
+        # warm up the workers and the resolution cache before measuring
+        asyncio.run(run_load(url, args.concurrency * 10, args.concurrency))
+
+        start = timer()
+        latencies = asyncio.run(run_load(url, args.requests, args.concurrency))
+        elapsed = timer() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    return {
+        'app': app_name,
+        'rps': len(latencies) / elapsed,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    results = [benchmark('base_http_app', args), benchmark('pure_asgi_app', args)]
+    for result in results:
+        print(
+            f"{result['app']:>14}: {result['rps']:8.0f} req/s, mean {result['mean_ms']:.2f}ms, "
+            f"p50 {result['p50_ms']:.2f}ms, p99 {result['p99_ms']:.2f}ms"
+        )
+
+    base_http, pure_asgi = results
+    overhead_ms = (1000 / base_http['rps'] - 1000 / pure_asgi['rps']) * args.workers
+    print(f'per-request overhead saved: {overhead_ms:.3f}ms of worker time')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class AdaptiveLimitSettings(BaseModel):
+    initial_limit: int = 20
+    min_limit: int = 2
+    max_limit: int = 500
+    # upstream latency over this multiple of its learned baseline means the upstream is overloaded
+    latency_tolerance: float = 2.0
+    # on overload the limit is cut by this ratio, at most once for each limit's worth of requests
+    backoff_ratio: float = 0.9
+    # how fast the baseline follows latency upwards, eg after a deploy makes every request slower
+    baseline_drift: float = 0.01
+
+
+class AdaptiveLimiter:
+    """
+    An AIMD concurrency limit for one upstream, fed with the latency of each upstream request.
+    While latency stays near the learned baseline and the limit is being used, it grows by about one for
+    each limit's worth of requests. Errors or latency well above the baseline cut it by the backoff ratio
+    """
+
+    def __init__(self, name: str, limit_settings: AdaptiveLimitSettings):
+        self.name = name
+        self.settings = limit_settings
+        self.limit = float(limit_settings.initial_limit)
+        self.baseline_latency: Optional[float] = None
+        self.last_latency: Optional[float] = None
+        self.decreases = 0
+        self._samples_until_decrease = 0
+
+    def current_limit(self) -> int:
+        return int(self.limit)
+
+    def record(self, latency: float, failed: bool, in_flight: int):
+        self.last_latency = latency
+        if not failed:
+            self._update_baseline(latency)
+
+        self._samples_until_decrease -= 1
+        baseline = self.baseline_latency
+        overloaded = failed or (baseline is not None and latency > baseline * self.settings.latency_tolerance)
+
+        if overloaded:
+            if self._samples_until_decrease <= 0:
+                self.limit = max(self.settings.min_limit, self.limit * self.settings.backoff_ratio)
+                self._samples_until_decrease = self.current_limit()
+                self.decreases += 1
+        elif in_flight >= self.limit / 2:
+            # only grow while the limit is actually being used
+            self.limit = min(self.settings.max_limit, self.limit + 1 / self.limit)
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.current_limit(),
+            'baseline_latency_seconds': _rounded(self.baseline_latency),
+            'last_latency_seconds': _rounded(self.last_latency),
+            'decreases': self.decreases,
+        }
+
+    def _update_baseline(self, latency: float):
+        if self.baseline_latency is None or latency < self.baseline_latency:
+            self.baseline_latency = latency
+        else:
+            self.baseline_latency += (latency - self.baseline_latency) * self.settings.baseline_drift
+
+
+def _rounded(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds, 4) if seconds is not None else None
@@ -0,0 +1,163 @@
+import asyncio
+import heapq
+from enum import IntEnum
+from itertools import count
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+from liminus.adaptive_limit import AdaptiveLimiter
+
+
+class RequestPriority(IntEnum):
+    # when requests are queued for a backend, higher priorities are let through first
+    LOW = 0
+    NORMAL = 1
+    HIGH = 2
+
+
+# the name of the controller for requests to all backends together
+GLOBAL_ADMISSION = '*'
+
+REJECTED_QUEUE_FULL = 'queue_full'
+REJECTED_QUEUE_TIMEOUT = 'queue_timeout'
+REJECTED_DISPLACED = 'displaced'
+
+
+class AdmissionSettings(BaseModel):
+    # no limit on concurrent requests, unless one is set
+    max_in_flight: Optional[int] = None
+    # requests over the limit wait in a queue this deep, for up to the timeout
+    max_queue_depth: int = 0
+    queue_timeout_seconds: float = 1
+    retry_after_seconds: int = 1
+
+
+class AdmissionController:
+    """
+    Caps the requests in flight, with any more waiting in a bounded priority queue for a slot to free up.
+    When the queue is full a request can take the place of a lower priority one, and otherwise it is rejected.
+    Every admitted request must call release() once it has finished
+    """
+
+    def __init__(self, name: str, admission_settings: AdmissionSettings, limiter: Optional[AdaptiveLimiter] = None):
+        self.name = name
+        self.settings = admission_settings
+        self.limiter = limiter
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {REJECTED_QUEUE_FULL: 0, REJECTED_QUEUE_TIMEOUT: 0, REJECTED_DISPLACED: 0}
+        # a heap of [-priority, arrival order, waiter], so the first is the highest priority, longest waiting
+        self._queue: List[list] = []
+        self._arrivals = count()
+
+    def max_in_flight(self) -> Optional[int]:
+        # an adaptive limit can only ever lower the configured one
+        if self.limiter is None:
+            return self.settings.max_in_flight
+        if self.settings.max_in_flight is None:
+            return self.limiter.current_limit()
+        return min(self.settings.max_in_flight, self.limiter.current_limit())
+
+    async def acquire(self, priority: int = RequestPriority.NORMAL) -> bool:
+        max_in_flight = self.max_in_flight()
+        if max_in_flight is None or (self.in_flight < max_in_flight and not self._queue):
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+        if len(self._queue) >= self.settings.max_queue_depth and not self._displace_lower_priority(priority):
+            self.rejected[REJECTED_QUEUE_FULL] += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = [-priority, next(self._arrivals), waiter]
+        heapq.heappush(self._queue, entry)
+        try:
+            return await asyncio.wait_for(waiter, self.settings.queue_timeout_seconds)
+        except asyncio.TimeoutError:
+            self._remove(entry)
+            self.rejected[REJECTED_QUEUE_TIMEOUT] += 1
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and waiter.result():
+                # a slot was handed over just as the request went away, so pass it on
+                self.release()
+            else:
+                self._remove(entry)
+            raise
+
+    def release(self):
+        # a freed slot goes straight to the next queued request, if there is one and the limit hasn't shrunk since
+        max_in_flight = self.max_in_flight()
+        if max_in_flight is None or self.in_flight <= max_in_flight:
+            if self._admit_next():
+                return
+        self.in_flight -= 1
+
+    def record_upstream_latency(self, latency: float, failed: bool):
+        if self.limiter is None:
+            return
+
+        self.limiter.record(latency, failed, self.in_flight)
+        # if the limit has grown, queued requests can have the new slots
+        max_in_flight = self.max_in_flight()
+        while self._queue and (max_in_flight is None or self.in_flight < max_in_flight):
+            if not self._admit_next():
+                break
+            self.in_flight += 1
+
+    def stats(self) -> dict:
+        stats = {
+            'max_in_flight': self.max_in_flight(),
+            'in_flight': self.in_flight,
+            'queued': len(self._queue),
+            'admitted': self.admitted,
+            'rejected': dict(self.rejected),
+        }
+        if self.limiter is not None:
+            stats['adaptive_limit'] = self.limiter.stats()
+        return stats
+
+    def _admit_next(self) -> bool:
+        while self._queue:
+            _, _, waiter = heapq.heappop(self._queue)
+            if not waiter.done():
+                waiter.set_result(True)
+                self.admitted += 1
+                return True
+        return False
+
+    def _displace_lower_priority(self, priority: int) -> bool:
+        if not self._queue:
+            return False
+
+        # the lowest priority request which arrived last is the one to give up its place
+        lowest = max(self._queue)
+        if -lowest[0] >= priority:
+            return False
+
+        self._remove(lowest)
+        lowest[2].set_result(False)
+        self.rejected[REJECTED_DISPLACED] += 1
+        return True
+
+    def _remove(self, entry: list):
+        if entry in self._queue:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+
+
+_admission_controllers: Dict[str, AdmissionController] = {}
+
+
+def get_admission_controller(
+    name: str, admission_settings: AdmissionSettings, limiter: Optional[AdaptiveLimiter] = None
+) -> AdmissionController:
+    if name not in _admission_controllers:
+        _admission_controllers[name] = AdmissionController(name, admission_settings, limiter)
+    return _admission_controllers[name]
+
+
+def admission_stats() -> Dict[str, dict]:
+    return {name: controller.stats() for name, controller in _admission_controllers.items()}
@@ -11,11 +11,14 @@ from starlette.routing import Route
 from starlette_early_data import EarlyDataMiddleware
 
 from liminus import health_check, settings
+from liminus.backends import valid_backends
 from liminus.background_tasks import complete_all_background_tasks
+from liminus.connection_pools import close_all_connection_pools
 from liminus.middleware_runner import GatekeeperMiddlewareRunner
 from liminus.middlewares.cors import CorsMiddleware
 from liminus.middlewares.request_logging import RequestLoggingMiddleware
 from liminus.proxy_request import proxy_request_to_backend
+from liminus.upstream_warmup import prewarm_upstreams, start_upstream_keepalive, stop_upstream_keepalive
 
 
 def create_app():
@@ -42,11 +45,32 @@ def create_app():
         Middleware(GatekeeperMiddlewareRunner),
     ]
 
+    async def on_app_startup():
+        # open connections to the upstreams before the first requests need them
+        connections = settings.UPSTREAM_PREWARM_CONNECTIONS
+        if connections > 0:
+            await prewarm_upstreams(valid_backends, connections, timeout=settings.UPSTREAM_PREWARM_TIMEOUT_SECONDS)
+            start_upstream_keepalive(
+                valid_backends,
+                connections,
+                interval=settings.UPSTREAM_KEEPALIVE_INTERVAL_SECONDS,
+                timeout=settings.UPSTREAM_PREWARM_TIMEOUT_SECONDS,
+            )
+
     async def on_app_shutdown():
+        await stop_upstream_keepalive()
         # finish all running background coroutines
         await complete_all_background_tasks(timeout=10)
-
-    app = Starlette(routes=routes, middleware=middlewares, on_shutdown=[on_app_shutdown], debug=settings.DEBUG)
+        # and only then close the upstream connections they may have been using
+        await close_all_connection_pools()
+
+    app = Starlette(
+        routes=routes,
+        middleware=middlewares,
+        on_startup=[on_app_startup],
+        on_shutdown=[on_app_shutdown],
+        debug=settings.DEBUG,
+    )
     return app
 
 
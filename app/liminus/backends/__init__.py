@@ -8,6 +8,7 @@ from liminus.backends.health_check import health_check_backend
 from liminus.backends.petitions_service import petitions_service_backend
 from liminus.backends.stats_service import stats_service_backend
 from liminus.backends.web_act import web_act_backend
+from liminus.base.backend import BackendDispatcher
 
 
 all_backends = [
@@ -28,4 +29,7 @@ valid_backends.append(health_check_backend)
 for be in valid_backends:
     be.init()
 
-__all__ = ['valid_backends']
+# requests are matched to the first valid backend that listens on their path
+backend_dispatcher = BackendDispatcher(valid_backends)
+
+__all__ = ['valid_backends', 'backend_dispatcher']
@@ -1,7 +1,9 @@
 import re
 
 from liminus import settings
-from liminus.base.backend import AuthSettings, Backend, ListenPathSettings
+from liminus.adaptive_limit import AdaptiveLimitSettings
+from liminus.admission import AdmissionSettings, RequestPriority
+from liminus.base.backend import AuthSettings, Backend, BodyLimitSettings, ListenPathSettings, StreamingSettings
 from liminus.middlewares.add_ip_headers import AddIpHeadersMiddleware
 from liminus.middlewares.restrict_headers import RestrictHeadersMiddleware
 from liminus.middlewares.staff_auth_session import StaffAuthSessionMiddleware
@@ -15,5 +17,14 @@ admin_backend = Backend(
         strip_prefix=False,
     ),
     auth=AuthSettings(requires_staff_auth=True),
+    # exports can be large, so don't hold them in memory
+    streaming=StreamingSettings(enabled=True, min_content_length=256 * 1024),
+    # uploads are streamed upstream, but still capped
+    body_limits=BodyLimitSettings(max_body_bytes=64 * 1024 * 1024, max_file_bytes=32 * 1024 * 1024),
+    # staff requests are let through ahead of public ones when the gatekeeper is overloaded
+    priority=RequestPriority.HIGH,
+    # admin pages can be slow, so how many run at once follows how the upstream is coping
+    adaptive_limit=AdaptiveLimitSettings(),
+    admission=AdmissionSettings(max_queue_depth=50),
     middlewares=[StaffAuthSessionMiddleware, AddIpHeadersMiddleware, RestrictHeadersMiddleware],
 )
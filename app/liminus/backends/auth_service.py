@@ -1,6 +1,7 @@
 import re
 
 from liminus import settings
+from liminus.admission import RequestPriority
 from liminus.base.backend import Backend, ListenPathSettings, PathRewrites
 from liminus.middlewares.add_ip_headers import AddIpHeadersMiddleware
 from liminus.middlewares.restrict_headers import RestrictHeadersMiddleware
@@ -18,5 +19,6 @@ auth_service_backend = Backend(
             PathRewrites(path_from='/auth/saml/callback', path_to='/staff/saml/callback/login'),
         ],
     ),
+    priority=RequestPriority.HIGH,
     middlewares=[StaffAuthSessionMiddleware, AddIpHeadersMiddleware, RestrictHeadersMiddleware],
 )
@@ -1,8 +1,10 @@
 import re
 
 from liminus import settings
-from liminus.base.backend import Backend, ListenPathSettings
+from liminus.base.backend import Backend, ListenPathSettings, StreamingSettings
 from liminus.middlewares.restrict_headers import RestrictHeadersMiddleware
+from liminus.request_coalescing import CoalesceSettings
+from liminus.response_cache import CacheSettings
 
 
 dev_cfsimulator_backend = Backend(
@@ -12,5 +14,13 @@ dev_cfsimulator_backend = Backend(
         upstream_dsn=settings.BACKEND_WEB_ACT_DSN,
         strip_prefix=False,
     ),
+    # static assets are passed straight through
+    streaming=StreamingSettings(
+        enabled=True, min_content_length=256 * 1024, content_types={'image/', 'font/', 'video/'}
+    ),
+    # pages and assets are cached for as long as the upstream Cache-Control allows
+    cache=CacheSettings(stale_while_revalidate_seconds=30),
+    # and a campaign launch sends only one request upstream for each page, however many arrive at once
+    coalesce=CoalesceSettings(),
     middlewares=[RestrictHeadersMiddleware],
 )
@@ -1,4 +1,5 @@
 from liminus import settings
+from liminus.admission import RequestPriority
 from liminus.base.backend import Backend, ListenPathSettings
 from liminus.middlewares.add_ip_headers import AddIpHeadersMiddleware
 from liminus.middlewares.restrict_headers import RestrictHeadersMiddleware
@@ -12,5 +13,6 @@ devvm_simplesaml_backend = Backend(
         upstream_dsn=settings.BACKEND_ADMIN_DSN,
         strip_prefix=False,
     ),
+    priority=RequestPriority.HIGH,
     middlewares=[StaffAuthSessionMiddleware, AddIpHeadersMiddleware, RestrictHeadersMiddleware],
 )
@@ -1,6 +1,7 @@
 import re
 
 from liminus import settings
+from liminus.admission import RequestPriority
 from liminus.base.backend import (
     Backend,
     CsrfSettings,
@@ -40,6 +41,8 @@ donation_service_backend = Backend(
         RouteSettings(
             path='/donation/public_api/new_donation',
             allow_methods=[HttpMethods.POST],
+            # taking a donation comes before anything else on this backend
+            priority=RequestPriority.HIGH,
             recaptcha=RecaptchaSettings(enabled=RecaptchaEnabled.CAMPAIGN_SETTING),
         ),
         RouteSettings(
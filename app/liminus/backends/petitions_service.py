@@ -1,4 +1,6 @@
 from liminus import settings
+from liminus.adaptive_limit import AdaptiveLimitSettings
+from liminus.admission import AdmissionSettings, RequestPriority
 from liminus.base.backend import AuthSettings, Backend, ListenPathSettings
 from liminus.middlewares.add_ip_headers import AddIpHeadersMiddleware
 from liminus.middlewares.restrict_headers import RestrictHeadersMiddleware
@@ -14,5 +16,8 @@ petitions_service_backend = Backend(
         strip_prefix=True,
     ),
     auth=AuthSettings(requires_staff_auth=True),
+    priority=RequestPriority.HIGH,
+    adaptive_limit=AdaptiveLimitSettings(),
+    admission=AdmissionSettings(max_queue_depth=50),
     middlewares=[StaffAuthSessionMiddleware, AddIpHeadersMiddleware, RestrictHeadersMiddleware],
 )
@@ -1,4 +1,5 @@
 from liminus import settings
+from liminus.admission import RequestPriority
 from liminus.base.backend import AuthSettings, Backend, ListenPathSettings
 from liminus.middlewares.add_ip_headers import AddIpHeadersMiddleware
 from liminus.middlewares.restrict_headers import RestrictHeadersMiddleware
@@ -13,5 +14,6 @@ stats_service_backend = Backend(
         strip_prefix=True,
     ),
     auth=AuthSettings(requires_staff_auth=True),
+    priority=RequestPriority.HIGH,
     middlewares=[StaffAuthSessionMiddleware, AddIpHeadersMiddleware, RestrictHeadersMiddleware],
 )
@@ -1,5 +1,5 @@
 from liminus import settings
-from liminus.base.backend import Backend, CsrfSettings, HeadersAllowedSettings, ListenPathSettings
+from liminus.base.backend import Backend, CsrfSettings, HeadersAllowedSettings, ListenPathSettings, RetryPolicy
 from liminus.constants import Headers
 from liminus.middlewares.add_ip_headers import AddIpHeadersMiddleware
 from liminus.middlewares.public_session_csrf_jwt import PublicSessionMiddleware
@@ -14,6 +14,8 @@ web_act_backend = Backend(
         strip_prefix=False,
     ),
     csrf=CsrfSettings(require_token=True, single_use=True),
+    # only GET / HEAD / OPTIONS are retried, form posts are always sent exactly once
+    retry=RetryPolicy(max_attempts=3, hedge=True),
     allowed_request_headers=HeadersAllowedSettings(
         allowlist=set(
             [
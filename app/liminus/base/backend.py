@@ -1,12 +1,21 @@
+import random
 import re
 from enum import Enum
-from typing import Any, List, Optional, Pattern, Set, Tuple, Type
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Pattern, Set, Tuple, Type
+from urllib.parse import urljoin
 
 from pydantic import BaseModel
 from starlette.datastructures import URL
 
+from liminus.adaptive_limit import AdaptiveLimiter, AdaptiveLimitSettings
+from liminus.admission import AdmissionController, AdmissionSettings, RequestPriority, get_admission_controller
+from liminus.circuit_breaker import CircuitBreaker, CircuitBreakerSettings, get_circuit_breaker
+from liminus.connection_pools import ConnectionPool, ConnectionPoolSettings, get_connection_pool
 from liminus.constants import Headers, HttpMethods
-from liminus.utils import strip_path_prefix, url_join
+from liminus.load_balancer import EjectionSettings, LoadBalancer, TargetState, UpstreamTarget, get_load_balancer
+from liminus.request_coalescing import CoalesceSettings
+from liminus.response_cache import CacheSettings
+from liminus.utils import BaseUrlJoiner, FirstMatchRegex, LatencyWindow, strip_path_prefix
 
 
 class AuthSettings(BaseModel):
@@ -40,6 +49,70 @@ class RecaptchaSettings(BaseModel):
     enabled: RecaptchaEnabled = RecaptchaEnabled.DISABLED
 
 
+class StreamingSettings(BaseModel):
+    # stream the upstream response body through to the client, instead of buffering it whole
+    enabled: bool = False
+    # when set, only stream responses at least this large, or with no declared Content-Length
+    min_content_length: Optional[int] = None
+    # when set, stream responses with any of these content-type prefixes, regardless of size
+    content_types: Set[str] = set()
+    chunk_size: int = 64 * 1024
+
+    def should_stream(self, content_length: Optional[int], content_type: str) -> bool:
+        if not self.enabled:
+            return False
+
+        if self.min_content_length is None and not self.content_types:
+            # no thresholds, so stream everything
+            return True
+
+        if self.min_content_length is not None:
+            if content_length is None or content_length >= self.min_content_length:
+                return True
+
+        return any(content_type.startswith(prefix) for prefix in self.content_types)
+
+
+class BodyLimitSettings(BaseModel):
+    # requests over these sizes are rejected with a 413, before they are fully read
+    max_body_bytes: Optional[int] = None
+    max_file_bytes: Optional[int] = None
+    # bodies with a JSON content-type over this size or nesting depth are rejected with a 400, before being re-encoded
+    max_json_bytes: Optional[int] = None
+    max_json_depth: Optional[int] = None
+
+
+class RetryPolicy(BaseModel):
+    # a single attempt means no retries
+    max_attempts: int = 1
+    retry_on_statuses: Set[int] = {502, 503}
+    # only safe methods are retried or hedged, unless unsafe ones are explicitly opted in
+    retry_unsafe_methods: bool = False
+    backoff_base_seconds: float = 0.05
+    backoff_max_seconds: float = 1.0
+    # send a second request if the first hasn't answered by the route's p95 latency
+    hedge: bool = False
+    hedge_percentile: float = 0.95
+    hedge_min_samples: int = 20
+    # the budget for all attempts together, defaulting to the request timeout
+    deadline_seconds: Optional[float] = None
+
+    def is_enabled(self) -> bool:
+        return self.max_attempts > 1 or self.hedge
+
+    def allows_method(self, method: str) -> bool:
+        return self.retry_unsafe_methods or method in {HttpMethods.GET, HttpMethods.HEAD, HttpMethods.OPTIONS}
+
+    def backoff_delay(self, attempt: int) -> float:
+        # exponential backoff with full jitter, so retries from many requests don't arrive together
+        return random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** (attempt - 1)))
+
+    def hedge_delay(self, latency_window: Optional[LatencyWindow]) -> Optional[float]:
+        if not self.hedge or latency_window is None or len(latency_window) < self.hedge_min_samples:
+            return None
+        return latency_window.percentile(self.hedge_percentile)
+
+
 class ReqSettings(BaseModel):
     csrf: Optional[CsrfSettings] = None
     auth: Optional[AuthSettings] = None
@@ -48,6 +121,14 @@ class ReqSettings(BaseModel):
     allowed_response_headers: Optional[HeadersAllowedSettings] = None
     middlewares: Optional[List[Type]] = None
     timeout: Optional[int] = None
+    streaming: Optional[StreamingSettings] = None
+    body_limits: Optional[BodyLimitSettings] = None
+    retry: Optional[RetryPolicy] = None
+    # responses are only cached for routes which opt in
+    cache: Optional[CacheSettings] = None
+    # as are identical concurrent requests sharing one upstream request
+    coalesce: Optional[CoalesceSettings] = None
+    priority: Optional[RequestPriority] = None
 
 
 class PathRewrites(BaseModel):
@@ -72,55 +153,79 @@ class ListenPathSettings(ReqSettings):
     prefix: Optional[str] = None
     path_regex: Optional[Pattern] = None
     upstream_dsn: Optional[URL] = None
+    # several weighted upstreams can be given instead of a single upstream_dsn
+    upstream_targets: List[UpstreamTarget] = []
+    ejection: EjectionSettings = EjectionSettings()
+    load_balancer: Optional[LoadBalancer] = None
     strip_prefix: bool = True
     rewrites: List[PathRewrites] = []
     extra_headers: List[Tuple[str, str]] = []
+    upstream_url_joiner: Optional[BaseUrlJoiner] = None
+    connection_pool: ConnectionPoolSettings = ConnectionPoolSettings()
+    upstream_pool: Optional[ConnectionPool] = None
+    circuit_breaker: CircuitBreakerSettings = CircuitBreakerSettings()
+    upstream_breaker: Optional[CircuitBreaker] = None
 
     # pydantic needs this to allow a "URL" type
     class Config:
         arbitrary_types_allowed = True
 
-    def matches_path(self, request_path: str) -> bool:
-        if self.prefix and request_path.startswith(self.prefix):
-            return True
+    def compile_upstream_url(self) -> BaseUrlJoiner:
+        self.upstream_url_joiner = BaseUrlJoiner(str(self.upstream_dsn))
+        return self.upstream_url_joiner
 
-        if self.path_regex and self.path_regex.match(request_path):
-            return True
+    def get_upstream_ping_url(self) -> str:
+        return urljoin(str(self.upstream_dsn), '/ping')
 
-        return False
+    def get_upstream_ping_urls(self) -> List[str]:
+        if self.load_balancer:
+            return [target.ping_url() for target in self.load_balancer.targets]
+        return [self.get_upstream_ping_url()]
+
+    def choose_upstream_target(self) -> Optional[TargetState]:
+        return self.load_balancer.choose() if self.load_balancer else None
 
-    def get_upstream_url(self, request_path: str) -> URL:
+    def get_upstream_url(self, request_path: str, query: str = '', target: Optional[TargetState] = None) -> URL:
         if not self.upstream_dsn:
             raise AttributeError('Cannot generate upstream URL with no upstream DSN')
+        joiner = target.url_joiner if target else self.upstream_url_joiner or self.compile_upstream_url()
 
-        upstream_path = request_path
-        for rewrite in self.rewrites:
-            upstream_path = rewrite.rewrite_path(upstream_path)
         if self.strip_prefix:
+            # path rewrites are not applied when the prefix is stripped
             upstream_path = strip_path_prefix(request_path, self.prefix, self.path_regex)
-        return url_join(self.upstream_dsn, upstream_path)
+        else:
+            upstream_path = request_path
+            for rewrite in self.rewrites:
+                upstream_path = rewrite.rewrite_path(upstream_path)
+
+        upstream_url = joiner.join(upstream_path)
+        if query:
+            # the raw query string is passed through untouched, keeping repeated keys and the original encoding
+            upstream_url += ('&' if '?' in upstream_url else '?') + query
+
+        return URL(upstream_url)
 
 
 class RouteSettings(ReqSettings):
     path: Optional[str] = None
     path_regex: Optional[Pattern] = None
     allow_methods: Set[str] = {HttpMethods.ALL}
+    # the Allow header value for a 405 response, set in Backend.init()
+    allow_header: str = ''
+    # the middleware hooks to run for this route, compiled in Backend.init()
+    # the request hooks are grouped into stages which run in order, and the hooks within a stage run concurrently
+    request_stages: List[List[Callable[..., Awaitable[Any]]]] = []
+    response_hooks: List[Callable[..., Awaitable[Any]]] = []
+    # recent upstream latencies for this route, eg for hedging at the p95
+    latency_window: Optional[LatencyWindow] = None
+
+    # pydantic needs this to allow a "LatencyWindow" type
+    class Config:
+        arbitrary_types_allowed = True
 
     def __str__(self) -> str:
         return f'{self.path or self.path_regex}'
 
-    def route_exactly_matches(self, request_path: str) -> bool:
-        return self.path == request_path
-
-    def route_matches(self, request_path: str) -> bool:
-        if self.path == request_path:
-            return True
-
-        if self.path_regex and self.path_regex.match(request_path):
-            return True
-
-        return False
-
     def method_matches(self, request_method: str) -> bool:
         if HttpMethods.ALL in self.allow_methods:
             return True
@@ -129,6 +234,82 @@ class RouteSettings(ReqSettings):
         return False
 
 
+class ExactPathRoutes:
+    """
+    The routes with the same exact path, by the HTTP method each will be matched for
+    """
+
+    def __init__(self):
+        self.by_method: Dict[str, RouteSettings] = {}
+        self.any_method: Optional[RouteSettings] = None
+        self.last_route: Optional[RouteSettings] = None
+
+    def add(self, route: RouteSettings):
+        self.last_route = route
+        if self.any_method:
+            # an earlier route already accepts every method, so this one can never match
+            return
+
+        if HttpMethods.ALL in route.allow_methods:
+            self.any_method = route
+        for method in route.allow_methods:
+            self.by_method.setdefault(method, route)
+
+    def match(self, request_method: str) -> Optional[RouteSettings]:
+        return self.by_method.get(request_method) or self.any_method
+
+
+class RouteIndex:
+    """
+    The routes of a backend, compiled for fast lookup with the same priority as checking them in order:
+     1. exact path match, via a dict of path -> method -> route
+     2. regex path match, via one combined regex per HTTP method
+    If the path matches but the method does not, the route to build a 405 response from is also found
+    """
+
+    def __init__(self, routes: List[RouteSettings]):
+        self.exact: Dict[str, ExactPathRoutes] = {}
+        for route in routes:
+            if route.path is not None:
+                self.exact.setdefault(route.path, ExactPathRoutes()).add(route)
+
+        regex_routes = [route for route in routes if route.path_regex]
+        explicit_methods = set(method for route in regex_routes for method in route.allow_methods)
+        explicit_methods.discard(HttpMethods.ALL)
+
+        self.regex_by_method: Dict[str, FirstMatchRegex[RouteSettings]] = {
+            method: self._combine([route for route in regex_routes if route.method_matches(method)])
+            for method in explicit_methods
+        }
+        # any other method can only match routes that allow all methods
+        self.regex_other_methods = self._combine(
+            [route for route in regex_routes if HttpMethods.ALL in route.allow_methods]
+        )
+        self.regex_any_method = self._combine(regex_routes)
+
+    def match(self, request_method: str, request_path: str) -> Tuple[Optional[RouteSettings], Optional[RouteSettings]]:
+        """
+        Returns a tuple of (matching route, route matching only on path)
+        """
+        exact = self.exact.get(request_path)
+        if exact:
+            route = exact.match(request_method)
+            if route:
+                return route, None
+
+        route = self.regex_by_method.get(request_method, self.regex_other_methods).match(request_path)
+        if route:
+            return route, None
+
+        if exact:
+            return None, exact.last_route
+
+        return None, self.regex_any_method.match(request_path)
+
+    def _combine(self, routes: List[RouteSettings]) -> FirstMatchRegex[RouteSettings]:
+        return FirstMatchRegex([(route.path_regex, route) for route in routes if route.path_regex])
+
+
 class Backend(ReqSettings):
     name: str
     listen: ListenPathSettings = ListenPathSettings()
@@ -141,7 +322,20 @@ class Backend(ReqSettings):
     allowed_response_headers: HeadersAllowedSettings = HeadersAllowedSettings(blocklist=Headers.RESPONSE_DEFAULT_BLOCK)
     middlewares: List[Type] = []
     middleware_instances: List[Any] = []
+    route_index: Optional[RouteIndex] = None
     timeout: int = 10
+    streaming: StreamingSettings = StreamingSettings()
+    body_limits: BodyLimitSettings = BodyLimitSettings()
+    retry: RetryPolicy = RetryPolicy()
+    priority: RequestPriority = RequestPriority.NORMAL
+    admission: AdmissionSettings = AdmissionSettings()
+    # an upstream's concurrency can also be limited by how its latency responds to load
+    adaptive_limit: Optional[AdaptiveLimitSettings] = None
+    admission_controller: Optional[AdmissionController] = None
+
+    # pydantic needs this to allow a "RouteIndex" type
+    class Config:
+        arbitrary_types_allowed = True
 
     def __str__(self):
         return f'<Backend "{self.name}">'
@@ -153,13 +347,124 @@ class Backend(ReqSettings):
 
         for route in self.routes:
             self._coalesce_settings(route, self.listen, self)
+            route.allow_header = ','.join(list(route.allow_methods))
+            route.latency_window = LatencyWindow()
+
+        # compile the routes so matching a request doesn't have to check each in turn
+        self.route_index = RouteIndex(self.routes)
+        if self.listen.upstream_targets:
+            self.listen.load_balancer = get_load_balancer(self.name, self.listen.upstream_targets, self.listen.ejection)
+            # the first target stands in wherever a single upstream is expected
+            self.listen.upstream_dsn = self.listen.upstream_dsn or self.listen.upstream_targets[0].dsn
+        if self.listen.upstream_dsn:
+            self.listen.compile_upstream_url()
+            # every upstream gets its own pool of connections
+            self.listen.upstream_pool = get_connection_pool(self.name, self.listen.connection_pool)
+            self.listen.upstream_breaker = get_circuit_breaker(self.name, self.listen.circuit_breaker)
+
+        limiter = AdaptiveLimiter(self.name, self.adaptive_limit) if self.adaptive_limit else None
+        self.admission_controller = get_admission_controller(self.name, self.admission, limiter)
 
         # create instances for all the middleware classes
         for mw_class in self.middlewares:
             self.middleware_instances.append(mw_class())
 
+        # and compile each route's pipeline of only the hooks that do something for it
+        for route in self.routes:
+            self._compile_middleware_hooks(route)
+
+    def match_route(
+        self, request_method: str, request_path: str
+    ) -> Tuple[Optional[RouteSettings], Optional[RouteSettings]]:
+        if self.route_index is None:
+            raise AttributeError(f'{self} must be initialised before matching routes')
+
+        return self.route_index.match(request_method, request_path)
+
+    def _compile_middleware_hooks(self, route: RouteSettings):
+        route.response_hooks = []
+        route.request_stages = []
+        previous_parallel_safe = False
+        for mw in self.middleware_instances:
+            if not mw.applies_to(route):
+                continue
+
+            if mw.overrides_hook('handle_request'):
+                # consecutive parallel safe hooks share a stage, anything else is a stage of its own
+                if mw.PARALLEL_SAFE and previous_parallel_safe:
+                    route.request_stages[-1].append(mw.handle_request)
+                else:
+                    route.request_stages.append([mw.handle_request])
+                previous_parallel_safe = mw.PARALLEL_SAFE
+
+            if mw.overrides_hook('handle_response'):
+                route.response_hooks.append(mw.handle_response)
+
     def _coalesce_settings(self, into: ReqSettings, *args):
         for setting_source in args:
             for prop in ReqSettings().dict():
                 if getattr(into, prop) is None:
                     setattr(into, prop, getattr(setting_source, prop))
+
+
+class PrefixTrie:
+    """
+    A character trie of path prefixes, each mapped to a priority (lower wins)
+    """
+
+    def __init__(self):
+        self._root: Dict[Optional[str], Any] = {}
+
+    def insert(self, prefix: str, priority: int):
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # if the same prefix is inserted twice, the first one keeps priority
+        node.setdefault(None, priority)
+
+    def best_match(self, path: str) -> Optional[int]:
+        # walk the path, collecting the best priority of every prefix it passes through
+        best = None
+        node: Any = self._root
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            priority = node.get(None)
+            if priority is not None and (best is None or priority < best):
+                best = priority
+
+        return best
+
+
+class BackendDispatcher:
+    """
+    Finds the first backend (in the given order) with a listener matching a request path.
+    This is built once at startup: prefix listeners go into a trie, and regex listeners are
+    combined into a single alternation, so a lookup does not grow with the number of backends
+    """
+
+    def __init__(self, backends: List[Backend]):
+        self.backends = backends
+        self._prefixes = PrefixTrie()
+        regex_listeners: List[Tuple[Pattern, int]] = []
+
+        for index, be in enumerate(backends):
+            if be.listen.prefix:
+                self._prefixes.insert(be.listen.prefix, index)
+            if be.listen.path_regex:
+                regex_listeners.append((be.listen.path_regex, index))
+
+        self._regexes = FirstMatchRegex(regex_listeners)
+        self._first_regex_index = regex_listeners[0][1] if regex_listeners else None
+
+    def match(self, request_path: str) -> Optional[Backend]:
+        best = self._prefixes.best_match(request_path)
+
+        # a regex listener can only win if it comes before the best prefix listener
+        if self._first_regex_index is not None and (best is None or self._first_regex_index < best):
+            regex_index = self._regexes.match(request_path)
+            if regex_index is not None and (best is None or regex_index < best):
+                best = regex_index
+
+        return self.backends[best] if best is not None else None
@@ -5,11 +5,25 @@ from liminus.base.backend import Backend, ReqSettings
 
 
 class GkRequestMiddleware:
+    # a parallel safe handle_request() doesn't depend on, or change anything read by, the request hooks around it
+    # so consecutive parallel safe hooks for a route are run concurrently, and once they have all finished the
+    # first rejection in their declared order wins
+    PARALLEL_SAFE = False
+
     async def handle_request(self, req: Request, reqset: ReqSettings, backend: Backend):
         pass
 
     async def handle_response(self, res: Response, req: Request, reqset: ReqSettings, backend: Backend):
         pass
 
+    def applies_to(self, reqset: ReqSettings) -> bool:
+        # called once per route from Backend.init(), with the coalesced route settings
+        # a middleware that has nothing to do for a route can return False to never be invoked for it
+        return True
+
+    def overrides_hook(self, hook_name: str) -> bool:
+        # the inherited no-op hooks are left out of the compiled route pipelines
+        return getattr(type(self), hook_name) is not getattr(GkRequestMiddleware, hook_name)
+
     def __str__(self) -> str:
         return self.__class__.__name__
@@ -0,0 +1,98 @@
+from time import monotonic
+from typing import Dict, Optional, Set
+
+from pydantic import BaseModel
+
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+
+class CircuitBreakerSettings(BaseModel):
+    enabled: bool = True
+    # this many upstream errors / timeouts in a row opens the circuit
+    failure_threshold: int = 5
+    failure_statuses: Set[int] = {502, 503, 504}
+    # how long requests fail fast before a single probe request is let through
+    open_seconds: float = 10
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive upstream failures, so that once an upstream is down we fail fast
+    rather than have every request wait out its full timeout.
+    Once open for a while, one probe request at a time is let through (half-open) - a success closes the circuit
+    and a failure opens it again. A probe that never reports back is replaced after another open_seconds
+    """
+
+    def __init__(self, name: str, breaker_settings: CircuitBreakerSettings):
+        self.name = name
+        self.settings = breaker_settings
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at: Optional[float] = None
+        self.times_opened = 0
+        self.rejected = 0
+
+    def allow_request(self) -> bool:
+        if not self.settings.enabled or self.state == STATE_CLOSED:
+            return True
+
+        now = monotonic()
+        probe_started_at = self.probe_started_at if self.state == STATE_HALF_OPEN else self.opened_at
+        if probe_started_at is None or now - probe_started_at >= self.settings.open_seconds:
+            self.state = STATE_HALF_OPEN
+            self.probe_started_at = now
+            return True
+
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.probe_started_at = None
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == STATE_HALF_OPEN or self.consecutive_failures >= self.settings.failure_threshold:
+            if self.state != STATE_OPEN:
+                self.times_opened += 1
+            self.state = STATE_OPEN
+            self.opened_at = monotonic()
+            self.probe_started_at = None
+
+    def record_status(self, status: int):
+        if status in self.settings.failure_statuses:
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def retry_after(self) -> int:
+        # whole seconds until the next probe request may be let through
+        started_at = self.probe_started_at if self.state == STATE_HALF_OPEN else self.opened_at
+        remaining = self.settings.open_seconds - (monotonic() - (started_at or 0))
+        return max(1, int(remaining + 0.999))
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'times_opened': self.times_opened,
+            'rejected': self.rejected,
+        }
+
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(name: str, breaker_settings: Optional[CircuitBreakerSettings] = None) -> CircuitBreaker:
+    if name not in _circuit_breakers:
+        _circuit_breakers[name] = CircuitBreaker(name, breaker_settings or CircuitBreakerSettings())
+    return _circuit_breakers[name]
+
+
+def circuit_breaker_stats() -> Dict[str, dict]:
+    return {name: breaker.stats() for name, breaker in _circuit_breakers.items()}
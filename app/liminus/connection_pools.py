@@ -0,0 +1,94 @@
+from typing import Dict, Optional
+
+from aiohttp import ClientSession, ClientTimeout, DummyCookieJar, TCPConnector
+from pydantic import BaseModel
+
+
+class ConnectionPoolSettings(BaseModel):
+    max_connections: int = 100
+    # 0 means no per-host limit, beyond max_connections
+    max_connections_per_host: int = 0
+    keepalive_timeout_seconds: float = 15
+    dns_cache_ttl_seconds: Optional[int] = 10
+    connect_timeout_seconds: Optional[float] = None
+    read_timeout_seconds: Optional[float] = None
+    # aiohttp's own default, for requests which don't set a total timeout of their own
+    total_timeout_seconds: float = 300
+
+
+class ConnectionPool:
+    """
+    A ClientSession with its own TCPConnector, so that one slow upstream can only exhaust its own sockets.
+    The session is created lazily inside the running event loop, and again after being closed
+    """
+
+    def __init__(self, name: str, pool_settings: ConnectionPoolSettings):
+        self.name = name
+        self.settings = pool_settings
+        self._session: Optional[ClientSession] = None
+
+    def session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            connector = TCPConnector(
+                limit=self.settings.max_connections,
+                limit_per_host=self.settings.max_connections_per_host,
+                keepalive_timeout=self.settings.keepalive_timeout_seconds,
+                use_dns_cache=self.settings.dns_cache_ttl_seconds is not None,
+                ttl_dns_cache=self.settings.dns_cache_ttl_seconds,
+            )
+            # we proxy for many users, so upstream cookies must never be remembered between requests
+            self._session = ClientSession(connector=connector, timeout=self.timeout(), cookie_jar=DummyCookieJar())
+        return self._session
+
+    def timeout(self, total: Optional[float] = None) -> ClientTimeout:
+        # a per-request timeout replaces the session one entirely, so it always needs the pool's limits too
+        return ClientTimeout(
+            total=total if total is not None else self.settings.total_timeout_seconds,
+            sock_connect=self.settings.connect_timeout_seconds,
+            sock_read=self.settings.read_timeout_seconds,
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def stats(self) -> dict:
+        stats: dict = {
+            'max_connections': self.settings.max_connections,
+            'max_connections_per_host': self.settings.max_connections_per_host,
+        }
+        connector = self._session.connector if self._session else None
+        if connector is None or connector.closed:
+            return {**stats, 'in_use': 0, 'idle': 0, 'waiting': 0}
+
+        return {
+            **stats,
+            'in_use': len(connector._acquired),
+            'idle': sum(len(conns) for conns in connector._conns.values()),
+            'waiting': sum(len(waiters) for waiters in connector._waiters.values()),
+        }
+
+
+AD_HOC_POOL_NAME = 'ad-hoc'
+_connection_pools: Dict[str, ConnectionPool] = {}
+
+
+def get_connection_pool(name: str, pool_settings: Optional[ConnectionPoolSettings] = None) -> ConnectionPool:
+    if name not in _connection_pools:
+        _connection_pools[name] = ConnectionPool(name, pool_settings or ConnectionPoolSettings())
+    return _connection_pools[name]
+
+
+def get_ad_hoc_connection_pool() -> ConnectionPool:
+    # ad-hoc requests, eg to verify a recaptcha or refresh a JWT, never share sockets with the upstreams
+    return get_connection_pool(AD_HOC_POOL_NAME)
+
+
+def connection_pool_stats() -> Dict[str, dict]:
+    return {name: pool.stats() for name, pool in _connection_pools.items()}
+
+
+async def close_all_connection_pools():
+    for pool in _connection_pools.values():
+        await pool.close()
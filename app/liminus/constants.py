@@ -6,13 +6,27 @@ class Headers:
     CONNECTING_IP_NORMALIZED = 'connecting-ip-normalized'
     RECAPTCHA_TOKEN = 'recaptcha-token'
 
+    AGE = 'age'
     ALLOW = 'allow'
     AUTHORIZATION = 'authorization'
+    CACHE_CONTROL = 'cache-control'
     CLOUDFLARE_CONNECTING_IP = 'cf-connecting-ip'
+    CONTENT_LENGTH = 'content-length'
+    CONTENT_TYPE = 'content-type'
+    COOKIE = 'cookie'
+    RETRY_AFTER = 'retry-after'
+    SET_COOKIE = 'set-cookie'
+    VARY = 'vary'
+    X_CACHE = 'x-gk-cache'
     X_FORWARDED_FOR = 'x-forwarded-for'
     X_REQUESTED_WITH = 'x-requested-with'
     X_REQUEST_ID = 'x-request-id'
 
+    AUTH_JWT_HEADERS = {
+        'member-authentication-jwt',
+        'staff-authentication-jwt',
+    }
+
     REQUEST_DEFAULT_ALLOW = {
         'accept-encoding',
         'accept',
@@ -0,0 +1,53 @@
+"""
+CSRF tokens used to each be stored under their own Redis key, with no expiry. They are now kept in a capped
+set per session, and the old keys are only still checked while CSRF_CHECK_LEGACY_KEYS is set.
+
+This gives every old key without an expiry the strict lifetime of a public session. Once that has passed, none
+of them can belong to a valid session any more, and CSRF_CHECK_LEGACY_KEYS can be turned off.
+
+    python -m liminus.expire_legacy_csrf_keys
+"""
+import asyncio
+from typing import List
+
+from liminus import settings
+from liminus.redis_client import redis_client
+
+
+LEGACY_KEY_PATTERN = 'csrf-*'
+# per session token sets match the legacy pattern too, but always have an expiry
+TOKENS_KEY_PREFIX = b'csrf-tokens-'
+
+
+async def expire_legacy_csrf_keys(batch_size: int = 1000) -> int:
+    expired = 0
+    batch: List[bytes] = []
+    async for key in redis_client().scan_iter(match=LEGACY_KEY_PATTERN, count=batch_size):
+        if not key.startswith(TOKENS_KEY_PREFIX):
+            batch.append(key)
+        if len(batch) >= batch_size:
+            expired += await _expire_keys_without_ttl(batch)
+            batch = []
+
+    if batch:
+        expired += await _expire_keys_without_ttl(batch)
+    return expired
+
+
+async def _expire_keys_without_ttl(keys: List[bytes]) -> int:
+    pipeline = redis_client().pipeline(transaction=False)
+    for key in keys:
+        pipeline.ttl(key)
+    ttls = await pipeline.execute()
+
+    # a TTL of -1 means the key exists with no expiry
+    keys_without_ttl = [key for key, ttl in zip(keys, ttls) if ttl == -1]
+    pipeline = redis_client().pipeline(transaction=False)
+    for key in keys_without_ttl:
+        pipeline.expire(key, settings.PUBLIC_SESSION_STRICT_MAX_LIFETIME_SECONDS)
+    await pipeline.execute()
+    return len(keys_without_ttl)
+
+
+if __name__ == '__main__':
+    print(f'set an expiry on {asyncio.run(expire_legacy_csrf_keys())} legacy CSRF keys')
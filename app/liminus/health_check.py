@@ -3,7 +3,6 @@ import json
 import logging
 from http import HTTPStatus
 from typing import Union
-from urllib.parse import urljoin
 
 from starlette.datastructures import URL
 from starlette.requests import Request
@@ -11,8 +10,17 @@ from starlette.responses import HTMLResponse, JSONResponse, PlainTextResponse, R
 from starlette.routing import Route
 
 from liminus import settings
+from liminus.admission import admission_stats
 from liminus.backends import valid_backends
+from liminus.circuit_breaker import circuit_breaker_stats
+from liminus.connection_pools import connection_pool_stats
+from liminus.load_balancer import load_balancer_stats
+from liminus.middleware_runner import GatekeeperMiddlewareRunner
+from liminus.middlewares.mixins.session_mixin import session_save_stats
 from liminus.proxy_request import http_request
+from liminus.request_coalescing import request_coalescer
+from liminus.response_cache import response_cache
+from liminus.upstream_warmup import upstream_warmup_stats
 from liminus.utils import loggable_string, loggable_url
 
 
@@ -34,20 +42,34 @@ async def check_connectivity(request: Request) -> Response:
         if not be.listen.upstream_dsn:
             continue
 
-        upstream_dsn_ping = urljoin(str(be.listen.upstream_dsn), '/ping')
         listen_path_label = be.listen.prefix or be.listen.path_regex
 
-        checks.append(
-            {
-                'name': f'{be.name} {listen_path_label} upstream_dsn',
-                'status': await get_http_connection_status(upstream_dsn_ping),
-            }
-        )
+        upstream_dsn_pings = be.listen.get_upstream_ping_urls()
+        for upstream_dsn_ping in upstream_dsn_pings:
+            target_label = f' {loggable_url(upstream_dsn_ping)}' if len(upstream_dsn_pings) > 1 else ''
+            checks.append(
+                {
+                    'name': f'{be.name} {listen_path_label} upstream_dsn{target_label}',
+                    'status': await get_http_connection_status(upstream_dsn_ping),
+                }
+            )
 
     passing_checks = [check['status'] == CHECK_STATUS_SUCCESS for check in checks]
     summary = SUMMARY_STATUS_PERFECT if all(passing_checks) else SUMMARY_STATUS_DEGRADED
 
-    results = {'checks': checks, 'summary': summary}
+    results = {
+        'checks': checks,
+        'summary': summary,
+        'admission': admission_stats(),
+        'connection_pools': connection_pool_stats(),
+        'circuit_breakers': circuit_breaker_stats(),
+        'load_balancers': load_balancer_stats(),
+        'route_resolution_cache': GatekeeperMiddlewareRunner._resolution_cache.stats(),
+        'response_cache': response_cache.stats(),
+        'request_coalescing': request_coalescer.stats(),
+        'sessions': session_save_stats(),
+        'upstream_warmup': upstream_warmup_stats,
+    }
 
     # return HTML for browser requests, return JSON for automated
     if 'text/html' in request.headers.get('accept', ''):
@@ -78,6 +100,22 @@ def _render_html_results(results: dict) -> str:
                 <h2 style='background-color:{heading_color}'>Liminus Health Check: {results['summary']}</h2>
                 <h4>Enabled backends: {settings.ENABLED_BACKENDS}</h4>
                 <pre>{html.escape(json.dumps(results['checks'], indent=4))}</pre>
+                <h4>Admission control</h4>
+                <pre>{html.escape(json.dumps(results['admission'], indent=4))}</pre>
+                <h4>Connection pools</h4>
+                <pre>{html.escape(json.dumps(results['connection_pools'], indent=4))}</pre>
+                <h4>Circuit breakers</h4>
+                <pre>{html.escape(json.dumps(results['circuit_breakers'], indent=4))}</pre>
+                <h4>Upstream targets</h4>
+                <pre>{html.escape(json.dumps(results['load_balancers'], indent=4))}</pre>
+                <h4>Route resolution cache</h4>
+                <pre>{html.escape(json.dumps(results['route_resolution_cache'], indent=4))}</pre>
+                <h4>Response cache</h4>
+                <pre>{html.escape(json.dumps(results['response_cache'], indent=4))}</pre>
+                <h4>Request coalescing</h4>
+                <pre>{html.escape(json.dumps(results['request_coalescing'], indent=4))}</pre>
+                <h4>Session saves</h4>
+                <pre>{html.escape(json.dumps(results['sessions'], indent=4))}</pre>
             </body>
         </html>
     '''
@@ -0,0 +1,72 @@
+import json
+import re
+from typing import Any, Iterable, Tuple
+
+
+try:
+    import orjson
+
+    HAS_ORJSON = True
+except ImportError:  # pragma: no cover
+    HAS_ORJSON = False
+
+
+# both orjson.JSONDecodeError and json.JSONDecodeError are ValueErrors, as is a UnicodeDecodeError
+JSONDecodeError = ValueError
+
+
+# orjson decodes integers wider than 64 bits as lossy floats, so any body with a run of digits this long
+# is left to the stdlib json, which keeps them exact
+LONG_DIGITS = re.compile(rb'\d{19,}')
+
+
+def loads(data: bytes) -> Any:
+    return decode(data)[0]
+
+
+def decode(data: bytes) -> Tuple[Any, bool]:
+    """
+    Decodes the data, and says whether it was decoded by the stdlib json and should be encoded by it again.
+    orjson rejects the NaN, Infinity and lone surrogates which the stdlib accepts, and would encode NaN as null
+    """
+    if HAS_ORJSON and not LONG_DIGITS.search(data):
+        try:
+            return orjson.loads(data), False
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data), True
+
+
+def dumps(obj: Any, stdlib: bool = False) -> bytes:
+    if HAS_ORJSON and not stdlib:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            # eg integers wider than 64 bits
+            pass
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def json_depth_exceeds(obj: Any, max_depth: int) -> bool:
+    # walk the decoded structure iteratively, so a deep payload can't exhaust the stack
+    stack = [(obj, 1)]
+    while stack:
+        value, depth = stack.pop()
+        children: Iterable[Any]
+        if isinstance(value, dict):
+            children = value.values()
+        elif isinstance(value, list):
+            children = value
+        else:
+            continue
+
+        if depth > max_depth:
+            return True
+        stack.extend((child, depth + 1) for child in children)
+
+    return False
+
+
+def is_json_content_type(content_type: str) -> bool:
+    media_type = content_type.split(';', 1)[0].strip().lower()
+    return media_type == 'application/json' or media_type.endswith('+json')
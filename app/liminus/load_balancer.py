@@ -0,0 +1,122 @@
+import random
+from time import monotonic
+from typing import Dict, List, Sequence
+from urllib.parse import urljoin
+
+from pydantic import BaseModel
+from starlette.datastructures import URL
+
+from liminus.utils import BaseUrlJoiner, loggable_url
+
+
+class UpstreamTarget(BaseModel):
+    dsn: URL
+    weight: int = 1
+
+    # pydantic needs this to allow a "URL" type
+    class Config:
+        arbitrary_types_allowed = True
+
+
+class EjectionSettings(BaseModel):
+    # a target giving this many 5xx responses or connection errors in a row is taken out of rotation
+    consecutive_failures: int = 3
+    eject_seconds: float = 30
+    # however badly the targets are doing, never eject more than this share of them
+    max_ejected_fraction: float = 0.5
+
+
+class TargetState:
+    def __init__(self, target: UpstreamTarget):
+        self.dsn = str(target.dsn)
+        self.weight = max(target.weight, 1)
+        self.url_joiner = BaseUrlJoiner(self.dsn)
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.times_ejected = 0
+
+    def load(self) -> float:
+        return self.in_flight / self.weight
+
+    def ping_url(self) -> str:
+        return urljoin(self.dsn, '/ping')
+
+
+class LoadBalancer:
+    """
+    Spreads requests over a listener's upstream targets: of two different targets picked at random by weight,
+    the one with fewer requests in flight (relative to its weight) gets the request.
+    Targets that keep failing are ejected for a while, and all the other targets share their traffic
+    """
+
+    def __init__(self, name: str, targets: List[UpstreamTarget], ejection: EjectionSettings):
+        self.name = name
+        self.ejection = ejection
+        self.targets = [TargetState(target) for target in targets]
+
+    def choose(self, exclude: Sequence[TargetState] = ()) -> TargetState:
+        # a retry or hedge avoids the targets already tried, unless there are no others left
+        available = self._available_targets()
+        candidates = [target for target in available if target not in exclude] or available
+        if len(candidates) == 1:
+            return candidates[0]
+
+        # two different targets, each picked by weight
+        first = self._pick_by_weight(candidates)
+        second = self._pick_by_weight([target for target in candidates if target is not first])
+        return second if second.load() < first.load() else first
+
+    def start(self, target: TargetState):
+        target.in_flight += 1
+
+    def finish(self, target: TargetState, failed: bool):
+        target.in_flight -= 1
+        if not failed:
+            target.consecutive_failures = 0
+            return
+
+        target.consecutive_failures += 1
+        if target.consecutive_failures >= self.ejection.consecutive_failures and self._can_eject():
+            target.ejected_until = monotonic() + self.ejection.eject_seconds
+            target.consecutive_failures = 0
+            target.times_ejected += 1
+
+    def stats(self) -> List[dict]:
+        now = monotonic()
+        return [
+            {
+                'dsn': loggable_url(target.dsn),
+                'weight': target.weight,
+                'in_flight': target.in_flight,
+                'ejected': target.ejected_until > now,
+                'times_ejected': target.times_ejected,
+            }
+            for target in self.targets
+        ]
+
+    def _available_targets(self) -> List[TargetState]:
+        now = monotonic()
+        available = [target for target in self.targets if target.ejected_until <= now]
+        return available or self.targets
+
+    def _pick_by_weight(self, candidates: List[TargetState]) -> TargetState:
+        return random.choices(candidates, weights=[target.weight for target in candidates])[0]
+
+    def _can_eject(self) -> bool:
+        now = monotonic()
+        ejected = len([target for target in self.targets if target.ejected_until > now])
+        return ejected + 1 <= len(self.targets) * self.ejection.max_ejected_fraction
+
+
+_load_balancers: Dict[str, LoadBalancer] = {}
+
+
+def get_load_balancer(name: str, targets: List[UpstreamTarget], ejection: EjectionSettings) -> LoadBalancer:
+    if name not in _load_balancers:
+        _load_balancers[name] = LoadBalancer(name, targets, ejection)
+    return _load_balancers[name]
+
+
+def load_balancer_stats() -> Dict[str, List[dict]]:
+    return {name: balancer.stats() for name, balancer in _load_balancers.items()}
@@ -1,71 +1,233 @@
+import asyncio
 from http import HTTPStatus
-from typing import Callable, Dict, Optional, Tuple
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
-from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 from starlette.responses import PlainTextResponse, Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from liminus import settings
-from liminus.backends import valid_backends
+from liminus.admission import (
+    GLOBAL_ADMISSION,
+    AdmissionController,
+    AdmissionSettings,
+    RequestPriority,
+    get_admission_controller,
+)
+from liminus.backends import backend_dispatcher
 from liminus.base.backend import Backend, ListenPathSettings, ReqSettings, RouteSettings
 from liminus.base.middleware import GkRequestMiddleware
 from liminus.constants import Headers
 from liminus.errors import ErrorResponse
+from liminus.proxy_request import circuit_open_error
+from liminus.resolution_cache import Resolution, ResolutionCache
 
 
 logger = settings.logger
 
 
-class GatekeeperMiddlewareRunner(BaseHTTPMiddleware):
+class GatekeeperMiddlewareRunner:
+    """
+    A pure ASGI middleware that matches each request to a backend and route, and runs that backend's
+    GkRequestMiddleware hooks: handle_request() before the request continues on to be proxied, and
+    handle_response() as the response starts, before anything is sent to the client
+    """
+
     _middleware_instances: Dict[str, GkRequestMiddleware] = {}
+    _resolution_cache = ResolutionCache(settings.RESOLUTION_CACHE_MAX_ENTRIES_PER_BACKEND)
+    _global_admission = get_admission_controller(
+        GLOBAL_ADMISSION,
+        AdmissionSettings(
+            max_in_flight=settings.ADMISSION_MAX_IN_FLIGHT or None,
+            max_queue_depth=settings.ADMISSION_MAX_QUEUE_DEPTH,
+            queue_timeout_seconds=settings.ADMISSION_QUEUE_TIMEOUT_SECONDS,
+        ),
+    )
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope, receive)
+        admitted: List[AdmissionController] = []
+        try:
+            await self._handle_request(request, send, admitted)
+        finally:
+            for controller in admitted:
+                controller.release()
 
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
+    async def _handle_request(self, request: Request, send: Send, admitted: List[AdmissionController]):
         try:
-            # go through all our backends, find the first that match this request path (no url params)
-            backend, listener = self._get_matching_backend_and_listener(request)
-            reqset = self._get_req_settings(request, backend, listener)
+            # find the first of our backends that matches this request path (no url params), and its route
+            backend, listener, reqset = self._resolve_backend_and_route(request)
             logger.debug(f'{request} found matching backend: {backend}')
 
             # add all relevant backend details to this request state
             self._augment_request_scope(request, backend, listener, reqset)
 
+            # shed load before doing any Redis or session work for this request
+            await self._admit_request(request, backend, reqset, admitted)
+            self._check_upstream_breaker(request, listener, reqset)
+
             # run the pre-request hooks
-            for mw in backend.middleware_instances:
-                early_response = await mw.handle_request(request, reqset, backend)
-                if early_response and isinstance(early_response, Response):
-                    logger.debug(f'{request} {mw}.handle_request() returned early response {early_response}')
-                    return early_response
-
-            # continue with the middleware chain, ending up with actually forwarding the request to a backing service
-            response = await call_next(request)
-
-            # run the post-response hooks
-            for mw in backend.middleware_instances:
-                replacement_response = await mw.handle_response(
-                    response,
-                    request,
-                    reqset,
-                    backend,
-                )
+            early_response = await self._run_request_hooks(request, reqset, backend)
+
+        except ErrorResponse as error:
+            logger.debug(f'{request} middleware processing raised error response {error.response}')
+            early_response = error.response
+
+        if early_response:
+            await early_response(request.scope, request.receive, send)
+            return
+
+        # continue with the middleware chain, ending up with actually forwarding the request to a backing service
+        await self._call_app_with_response_hooks(request, reqset, backend, send)
+
+    async def _admit_request(
+        self, request: Request, backend: Backend, reqset: RouteSettings, admitted: List[AdmissionController]
+    ):
+        # a slot for the backend is taken first, so requests queued for a busy backend don't hold global slots
+        priority = reqset.priority if reqset.priority is not None else RequestPriority.NORMAL
+        for controller in [backend.admission_controller, self._global_admission]:
+            if controller is None:
+                continue
+            if not await controller.acquire(priority):
+                logger.info(f'{request} rejected by {controller.name} admission control, overloaded')
+                msg = f'{request}: {controller.name} is overloaded' if settings.DEBUG else ''
+                retry_after = str(controller.settings.retry_after_seconds)
+                response = PlainTextResponse(msg, HTTPStatus.SERVICE_UNAVAILABLE, {Headers.RETRY_AFTER: retry_after})
+                raise ErrorResponse(response)
+            admitted.append(controller)
+
+    def _check_upstream_breaker(self, request: Request, listener: ListenPathSettings, reqset: RouteSettings):
+        # if the upstream is known to be down, fail fast before running any request hooks
+        breaker = listener.upstream_breaker
+        if breaker is None or breaker.allow_request():
+            return
+        if not reqset.cache:
+            raise circuit_open_error(request, breaker)
+        # looking up a stale cached response to serve instead needs the headers as changed by the request hooks
+        request.scope['open_upstream_breaker'] = breaker
+
+    async def _run_request_hooks(self, request: Request, reqset: RouteSettings, backend: Backend) -> Optional[Response]:
+        hook: Optional[Callable]
+        for stage in reqset.request_stages:
+            if len(stage) == 1:
+                early_response = await stage[0](request, reqset, backend)
+                hook = stage[0]
+            else:
+                early_response, hook = await self._run_concurrent_request_hooks(stage, request, reqset, backend)
+
+            if early_response and isinstance(early_response, Response):
+                mw = getattr(hook, '__self__', hook)
+                logger.debug(f'{request} {mw}.handle_request() returned early response {early_response}')
+                return early_response
+
+        return None
+
+    async def _run_concurrent_request_hooks(
+        self, hooks: List[Callable[..., Awaitable[Any]]], request: Request, reqset: RouteSettings, backend: Backend
+    ) -> Tuple[Optional[Response], Optional[Callable]]:
+        # every hook runs to completion, since cancelling one midway could leave a Redis transaction's replies
+        # unread on its connection, and then the first hook in declared order to return early or raise wins
+        results = await asyncio.gather(*[hook(request, reqset, backend) for hook in hooks], return_exceptions=True)
+        for hook, result in zip(hooks, results):
+            if isinstance(result, BaseException):
+                raise result
+            if result and isinstance(result, Response):
+                return result, hook
+
+        return None, None
+
+    async def _run_response_hooks(
+        self, response: Response, request: Request, reqset: RouteSettings, backend: Backend
+    ) -> Optional[Response]:
+        try:
+            for handle_response in reqset.response_hooks:
+                replacement_response = await handle_response(response, request, reqset, backend)
                 if replacement_response and isinstance(replacement_response, Response):
-                    logger.debug(f'{request} {mw}.handle_response() returned replacement response {early_response}')
+                    mw = getattr(handle_response, '__self__', handle_response)
+                    logger.debug(
+                        f'{request} {mw}.handle_response() returned replacement response {replacement_response}'
+                    )
                     return replacement_response
 
-            return response
-
         except ErrorResponse as error:
             logger.debug(f'{request} middleware processing raised error response {error.response}')
             return error.response
 
-    def _get_matching_backend_and_listener(self, request: Request) -> Tuple[Backend, ListenPathSettings]:
-        for be in valid_backends:
-            if be.listen.matches_path(request.url.path):
-                return (be, be.listen)
+        return None
+
+    async def _call_app_with_response_hooks(
+        self, request: Request, reqset: RouteSettings, backend: Backend, send: Send
+    ):
+        response_started = False
+        replacement_response: Optional[Response] = None
+
+        async def send_with_response_hooks(message: Message):
+            nonlocal response_started, replacement_response
+
+            if message['type'] != 'http.response.start':
+                # once replaced, the rest of the original response is dropped
+                if not replacement_response:
+                    await send(message)
+                return
+
+            response_started = True
+            # the hooks get a Response whose headers are the ones about to be sent
+            response = Response(status_code=message['status'])
+            response.raw_headers = list(message['headers'])
 
-        # if there are no matching backends, return a 404
-        msg = f'{request}: No backend found to proxy {request.url.path}' if settings.DEBUG else ''
-        response = PlainTextResponse(msg, HTTPStatus.NOT_FOUND)
-        raise ErrorResponse(response)
+            replacement_response = await self._run_response_hooks(response, request, reqset, backend)
+            if replacement_response:
+                await replacement_response(request.scope, request.receive, send)
+                return
+
+            message['status'] = response.status_code
+            message['headers'] = response.raw_headers
+            await send(message)
+
+        try:
+            await self.app(request.scope, request.receive, send_with_response_hooks)
+        except ErrorResponse as error:
+            if response_started:
+                raise
+            logger.debug(f'{request} request processing raised error response {error.response}')
+            # the request hooks have already run, so the response hooks still need to see this response,
+            # e.g. to rotate a CSRF token that was consumed
+            replacement_response = await self._run_response_hooks(error.response, request, reqset, backend)
+            response = replacement_response or error.response
+            await response(request.scope, request.receive, send)
+
+    def _resolve_backend_and_route(self, request: Request) -> Tuple[Backend, ListenPathSettings, RouteSettings]:
+        # most traffic is for a few hot paths, so remember what each (method, path) resolves to
+        path = request.url.path
+        resolution = self._resolution_cache.get(request.method, path)
+        if resolution is None:
+            backend = backend_dispatcher.match(path)
+            resolution = Resolution(backend)
+            if backend:
+                # the backend settings have a priority:
+                #  1. exact path match
+                #  2. regex path match
+                #  3. listener
+                resolution.route, resolution.route_wrong_method = backend.match_route(request.method, path)
+            self._resolution_cache.put(request.method, path, resolution)
+
+        if not resolution.backend:
+            # if there are no matching backends, return a 404
+            msg = f'{request}: No backend found to proxy {path}' if settings.DEBUG else ''
+            response = PlainTextResponse(msg, HTTPStatus.NOT_FOUND)
+            raise ErrorResponse(response)
+
+        if not resolution.route:
+            raise self._no_route_error(request, resolution.backend, resolution.route_wrong_method)
+
+        return resolution.backend, resolution.backend.listen, resolution.route
 
     def _augment_request_scope(
         self, request: Request, backend: Backend, listener: ListenPathSettings, reqset: ReqSettings
@@ -78,26 +240,9 @@ class GatekeeperMiddlewareRunner(BaseHTTPMiddleware):
         # and every request through GK gets a special header indicating that
         request.state.headers['Proxied-By'] = 'Gatekeeper'
 
-    def _get_req_settings(self, request: Request, backend: Backend, listener: ListenPathSettings) -> ReqSettings:
-        # the backend settings have a priority:
-        #  1. exact path match
-        #  2. regex path match
-        #  3. listener
-        route_wrong_method: Optional[RouteSettings] = None
-        for route in backend.routes:
-            if route.route_exactly_matches(request.url.path):
-                if route.method_matches(request.method):
-                    return route
-                else:
-                    route_wrong_method = route
-
-        for route in backend.routes:
-            if route.route_matches(request.url.path):
-                if route.method_matches(request.method):
-                    return route
-                else:
-                    route_wrong_method = route_wrong_method or route
-
+    def _no_route_error(
+        self, request: Request, backend: Backend, route_wrong_method: Optional[RouteSettings]
+    ) -> ErrorResponse:
         # if this request does not match any routes, it means we do not proceed
         response_message = ''
         if settings.DEBUG:
@@ -112,9 +257,9 @@ class GatekeeperMiddlewareRunner(BaseHTTPMiddleware):
             response = PlainTextResponse(
                 response_message,
                 HTTPStatus.METHOD_NOT_ALLOWED,
-                headers={Headers.ALLOW: ','.join(list(route_wrong_method.allow_methods))},
+                headers={Headers.ALLOW: route_wrong_method.allow_header},
             )
         else:
             response = PlainTextResponse(response_message, HTTPStatus.NOT_FOUND)
 
-        raise ErrorResponse(response)
+        return ErrorResponse(response)
@@ -7,6 +7,8 @@ from liminus.utils import normalize_ip_address
 
 
 class AddIpHeadersMiddleware(GkRequestMiddleware):
+    PARALLEL_SAFE = True
+
     async def handle_request(self, req: Request, reqset: ReqSettings, backend: Backend):
         # for geo-ip purposes we trust the x-forwarded-for
         # for security purposes we do not trust that, and we use the IP that connected to CloudFlare
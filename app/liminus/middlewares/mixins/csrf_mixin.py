@@ -1,12 +1,13 @@
-import asyncio
 from http import HTTPStatus
 from secrets import token_urlsafe
+from time import time
+from typing import List, Optional
 
+from aioredis.client import Pipeline
 from starlette.requests import Request
 from starlette.responses import JSONResponse, Response
 
 from liminus import settings
-from liminus.background_tasks import run_background_task
 from liminus.base.backend import ReqSettings
 from liminus.errors import ErrorResponse
 from liminus.redis_client import redis_client
@@ -15,12 +16,20 @@ from liminus.utils import get_cache_hash_key
 
 logger = settings.logger
 
+# an unconsumed token's score is when it was created, and a consumed one's is the end of its grace TTL
+# plus this, so consumed tokens always rank above unconsumed ones and trimming by rank never reaches them
+CONSUMED_CSRF_SCORE_OFFSET = 10 ** 10
+
 
 class CsrfHandlerMixin:
     CSRF_HEADER_NAME = ''
     CSRF_SESSION_KEY = 'csrf-token'
     # allow a CSRF to be used more than once, during this very-short TTL
     CSRF_REUSE_GRACE_TTL_SECONDS = 3
+    # only this many of a session's most recent tokens are kept, and they expire along with the session
+    CSRF_MAX_TOKENS_PER_SESSION = settings.CSRF_MAX_TOKENS_PER_SESSION
+    # set by the session handler this is mixed in with
+    SESSION_IDLE_TIMEOUT_SECONDS: int
 
     async def _rotate_csrf_if_needed(
         self, request: Request, response: Response, session_id: str, force_refresh: bool = False
@@ -32,24 +41,60 @@ class CsrfHandlerMixin:
             await self._store_new_csrf(session_id, new_csrf_token)
             response.headers[self.CSRF_HEADER_NAME] = new_csrf_token
 
-    async def _verify_csrf_if_needed(self, request: Request, session_id: str, reqset: ReqSettings) -> bool:
+    def _get_csrf_token_to_verify(self, request: Request, reqset: ReqSettings) -> Optional[str]:
         if not reqset.csrf or not reqset.csrf.require_token:
             # we don't need any CSRF for this backend
-            return True
+            return None
 
         if request.method not in reqset.csrf.require_on_methods:
             # we don't need to check a CSRF token for this kind of request
+            return None
+
+        return request.headers.get(self.CSRF_HEADER_NAME, '')
+
+    def _queue_csrf_check(self, pipeline: Pipeline, session_id: str, csrf_token: str, consume: bool):
+        # the pipeline must be a transaction, so that the token is checked and consumed atomically
+        tokens_key = self._get_csrf_tokens_key(session_id, csrf_token)
+        token_hash = self._get_csrf_token_hash(csrf_token)
+        now = time()
+        pipeline.zscore(tokens_key, token_hash)
+        if consume:
+            # drop tokens whose grace TTL has run out, so they can't be brought back here
+            self._queue_expired_csrf_removal(pipeline, tokens_key, now)
+            consumed_score = CONSUMED_CSRF_SCORE_OFFSET + now + self.CSRF_REUSE_GRACE_TTL_SECONDS
+            pipeline.zadd(tokens_key, {token_hash: consumed_score}, xx=True)
+
+        if settings.CSRF_CHECK_LEGACY_KEYS:
+            # tokens stored before they were kept per session each have a key of their own
+            legacy_key = self._get_legacy_csrf_cache_key(session_id, csrf_token)
+            if consume:
+                pipeline.expire(legacy_key, self.CSRF_REUSE_GRACE_TTL_SECONDS)
+            else:
+                pipeline.exists(legacy_key)
+
+    def _csrf_check_result(self, results: List) -> bool:
+        # results are those of the commands queued by _queue_csrf_check(), in order
+        score = results[0]
+        if score is not None and (score < CONSUMED_CSRF_SCORE_OFFSET or score - CONSUMED_CSRF_SCORE_OFFSET > time()):
+            return True
+        return settings.CSRF_CHECK_LEGACY_KEYS and bool(results[-1])
+
+    async def _verify_csrf_if_needed(
+        self, request: Request, session_id: str, reqset: ReqSettings, csrf_token_found: bool
+    ) -> bool:
+        # csrf_token_found is the result of the check queued by _queue_csrf_check(), see _csrf_check_result()
+        csrf_token_from_header = self._get_csrf_token_to_verify(request, reqset)
+        if csrf_token_from_header is None:
             return True
 
-        csrf_token_from_header = request.headers.get(self.CSRF_HEADER_NAME, '')
-        if await self._is_valid_csrf(session_id, csrf_token_from_header):
+        if csrf_token_from_header and csrf_token_found:
             # a valid CSRF token was provided in the request headers
 
-            if reqset.csrf.single_use:
+            if reqset.csrf and reqset.csrf.single_use:
                 # any time we use a token, we want to rotate it
                 # this requires setting a response header in the response hook, not in this pre-hook
                 # so set a flag here that we will pick up in the response hook
-                await self._consume_csrf(session_id, csrf_token_from_header)
+                # the token itself was already consumed when it was checked, and Redis expires it after the grace TTL
                 request.state.rotate_csrf = True
 
             return True
@@ -73,26 +118,30 @@ class CsrfHandlerMixin:
 
     async def _store_new_csrf(self, session_id: str, new_csrf_token: str):
         # add a new token to this session's valid list
-        cache_key = self._get_csrf_cache_key(session_id, new_csrf_token)
-        await redis_client().set(cache_key, '1')
-
-    async def _consume_csrf(self, session_id: str, csrf_token: str):
-        cache_key = self._get_csrf_cache_key(session_id, csrf_token)
-        await redis_client().expire(cache_key, self.CSRF_REUSE_GRACE_TTL_SECONDS)
-        run_background_task(self._delete_csrf_after_grace_delay(cache_key))
-
-    async def _delete_csrf_after_grace_delay(self, cache_key: str):
-        await asyncio.sleep(self.CSRF_REUSE_GRACE_TTL_SECONDS)
-        logger.info(f'deleting CSRF token after delay: {cache_key}')
-        await redis_client().delete(cache_key)
-
-    async def _is_valid_csrf(self, session_id: str, csrf_token: str) -> bool:
-        if not csrf_token:
-            return False
-
-        cache_key = self._get_csrf_cache_key(session_id, csrf_token)
-        value = await redis_client().get(cache_key)
-        return value is not None
-
-    def _get_csrf_cache_key(self, session_id: str, csrf_token: str) -> str:
+        tokens_key = self._get_csrf_tokens_key(session_id, new_csrf_token)
+        now = time()
+        pipeline = redis_client().pipeline(transaction=True)
+        self._queue_expired_csrf_removal(pipeline, tokens_key, now)
+        pipeline.zadd(tokens_key, {self._get_csrf_token_hash(new_csrf_token): now})
+        pipeline.expire(tokens_key, self.SESSION_IDLE_TIMEOUT_SECONDS)
+        pipeline.zcount(tokens_key, '-inf', f'({CONSUMED_CSRF_SCORE_OFFSET}')
+        *_, unconsumed = await pipeline.execute()
+
+        # tokens still in their grace TTL are kept, and only the oldest unconsumed ones beyond the cap are dropped
+        # these always have the lowest ranks, even if another request consumes one of them in the meantime
+        excess = unconsumed - self.CSRF_MAX_TOKENS_PER_SESSION
+        if excess > 0:
+            await redis_client().zremrangebyrank(tokens_key, 0, excess - 1)
+
+    def _queue_expired_csrf_removal(self, pipeline: Pipeline, tokens_key: str, now: float):
+        pipeline.zremrangebyscore(tokens_key, CONSUMED_CSRF_SCORE_OFFSET, f'({CONSUMED_CSRF_SCORE_OFFSET + now}')
+
+    def _get_csrf_tokens_key(self, session_id: Optional[str], csrf_token: str) -> str:
+        # without a session there is nothing to group tokens by, so each one gets a set of its own
+        return get_cache_hash_key('csrf-tokens-', session_id or f'no-session-{csrf_token}')
+
+    def _get_csrf_token_hash(self, csrf_token: str) -> str:
+        return get_cache_hash_key('', csrf_token)
+
+    def _get_legacy_csrf_cache_key(self, session_id: str, csrf_token: str) -> str:
         return get_cache_hash_key('csrf-', f'{session_id}-{csrf_token}')
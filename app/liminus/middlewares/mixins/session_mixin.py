@@ -1,13 +1,16 @@
 import json
-from dataclasses import dataclass
+from copy import deepcopy
+from dataclasses import dataclass, field
 from http.cookies import SimpleCookie
 from secrets import token_urlsafe
 from time import time
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
+from aioredis.client import Pipeline
 from starlette.requests import Request
 from starlette.responses import Response
 
+from liminus import settings
 from liminus.redis_client import redis_client
 from liminus.settings import logger
 from liminus.utils import get_cache_hash_key, to_seconds
@@ -17,6 +20,29 @@ from liminus.utils import get_cache_hash_key, to_seconds
 class Session:
     session_id: str
     session_data: Optional[dict]
+    # the seconds left before Redis expires this session, when it was loaded
+    ttl: Optional[int] = None
+    # what Redis holds for this session, so we only write it back if it has changed
+    stored_session_id: Optional[str] = field(init=False)
+    stored_session_data: Optional[dict] = field(init=False)
+
+    def __post_init__(self):
+        self.mark_stored()
+
+    def mark_stored(self):
+        self.stored_session_id = self.session_id
+        self.stored_session_data = deepcopy(self.session_data)
+
+    def is_dirty(self) -> bool:
+        return self.session_id != self.stored_session_id or self.session_data != self.stored_session_data
+
+
+SESSION_WRITTEN = 'written'
+SESSION_TTL_REFRESHED = 'ttl_refreshed'
+SESSION_TTL_REFRESH_SKIPPED = 'ttl_refresh_skipped'
+
+# how each kind of session (by its key prefix) was saved at the end of its requests
+_session_save_stats: Dict[str, Dict[str, int]] = {}
 
 
 class SessionHandlerMixin:
@@ -26,6 +52,7 @@ class SessionHandlerMixin:
 
     SESSION_IDLE_TIMEOUT_SECONDS = to_seconds(minutes=30)
     SESSION_STRICT_MAX_LIFETIME_SECONDS = to_seconds(hours=24)
+    SESSION_TTL_REFRESH_FRACTION = settings.SESSION_TTL_REFRESH_FRACTION
 
     async def _ensure_session(self, request: Request) -> Tuple[Session, bool]:
         # if the request has no session cookie specified, or it's an invalid session id, create a new one
@@ -39,9 +66,19 @@ class SessionHandlerMixin:
         return session, is_new
 
     async def _load_session(self, request: Request) -> Session:
-        session_id = self._get_session_id(request)
-        session_data = await self._load_session_from_cache(session_id)
-
+        session = self._get_request_session(request)
+        if session is None:
+            session_id = self._get_session_id(request)
+            session_data, ttl = await self._load_session_from_cache(session_id)
+            session = await self._set_request_session(request, session_id, session_data, ttl)
+        return session
+
+    def _get_request_session(self, request: Request) -> Optional[Session]:
+        return request.scope.get('sessions', {}).get(self.SESSION_KEY_PREFIX)
+
+    async def _set_request_session(
+        self, request: Request, session_id: str, session_data: Optional[dict], ttl: Optional[int]
+    ) -> Session:
         # our sessions have a 'strict expiry', which ensures there is a max lifetime even if something
         # is keeping active requests going
         if session_data:
@@ -52,7 +89,10 @@ class SessionHandlerMixin:
                 await self._store_session(session_id, None)
                 session_data = None
 
-        return Session(session_id, session_data)
+        # the session is only read from Redis once per request, and the same object is shared by both hooks
+        session = Session(session_id, session_data, ttl)
+        request.scope.setdefault('sessions', {})[self.SESSION_KEY_PREFIX] = session
+        return session
 
     async def _store_session(self, *args):
         if isinstance(args[0], Session):
@@ -62,6 +102,36 @@ class SessionHandlerMixin:
 
         await self._store_session_in_cache(session_id, self.SESSION_IDLE_TIMEOUT_SECONDS, session_data)
 
+    async def _save_session(self, session: Session):
+        # a new or changed session is written in full, otherwise the TTL is only extended once it runs low
+        if session.is_dirty():
+            await self._store_session(session)
+            session.mark_stored()
+            self._count_session_save(SESSION_WRITTEN)
+        elif self._session_ttl_needs_refresh(session):
+            pipeline = redis_client().pipeline(transaction=False)
+            for key in [
+                self._get_session_redis_key(session.session_id),
+                *self._get_session_linked_redis_keys(session.session_id),
+            ]:
+                pipeline.expire(key, self.SESSION_IDLE_TIMEOUT_SECONDS)
+            await pipeline.execute()
+            self._count_session_save(SESSION_TTL_REFRESHED)
+        else:
+            self._count_session_save(SESSION_TTL_REFRESH_SKIPPED)
+
+    def _session_ttl_needs_refresh(self, session: Session) -> bool:
+        if session.ttl is None or session.ttl < 0:
+            return True
+        return session.ttl < self.SESSION_IDLE_TIMEOUT_SECONDS * self.SESSION_TTL_REFRESH_FRACTION
+
+    def _count_session_save(self, outcome: str):
+        stats = _session_save_stats.setdefault(
+            self.SESSION_KEY_PREFIX,
+            {SESSION_WRITTEN: 0, SESSION_TTL_REFRESHED: 0, SESSION_TTL_REFRESH_SKIPPED: 0},
+        )
+        stats[outcome] += 1
+
     def _get_session_id(self, request):
         cookies = self._get_cookies(request)
         return cookies[self.SESSION_ID_COOKIE_NAME] if self.SESSION_ID_COOKIE_NAME in cookies else None
@@ -70,17 +140,35 @@ class SessionHandlerMixin:
         # Use a hash of the session id, so even if someone could access Redis they couldn't swap sessions
         return get_cache_hash_key(self.SESSION_KEY_PREFIX, session_id)
 
+    def _get_session_linked_redis_keys(self, session_id: str) -> List[str]:
+        # any other keys for this session, which should expire along with it
+        return []
+
     async def _store_session_in_cache(self, session_id: str, exp: int, data: Optional[dict]):
         key = self._get_session_redis_key(session_id)
         encoded_data = json.dumps(data)
-        await redis_client().setex(key, exp, encoded_data)
+        pipeline = redis_client().pipeline(transaction=False)
+        pipeline.setex(key, exp, encoded_data)
+        for linked_key in self._get_session_linked_redis_keys(session_id):
+            pipeline.expire(linked_key, exp)
+        await pipeline.execute()
 
-    async def _load_session_from_cache(self, session_id: str) -> Optional[dict]:
+    async def _load_session_from_cache(self, session_id: str) -> Tuple[Optional[dict], Optional[int]]:
         if not session_id:
-            return None
+            return None, None
+        pipeline = redis_client().pipeline(transaction=False)
+        self._queue_session_load(pipeline, session_id)
+        encoded_data, ttl = await pipeline.execute()
+        return self._decode_session_load(encoded_data, ttl)
+
+    def _queue_session_load(self, pipeline: Pipeline, session_id: str):
         key = self._get_session_redis_key(session_id)
-        encoded_data = await redis_client().get(key)
-        return json.loads(encoded_data) if encoded_data else None
+        # find out how long the session has left in the same round trip, to decide later whether to extend it
+        pipeline.get(key)
+        pipeline.ttl(key)
+
+    def _decode_session_load(self, encoded_data: Optional[bytes], ttl: int) -> Tuple[Optional[dict], Optional[int]]:
+        return (json.loads(encoded_data) if encoded_data else None), ttl
 
     def _generate_unique_session_id(self) -> str:
         return token_urlsafe(32)
@@ -120,3 +208,7 @@ class SessionHandlerMixin:
 
         cookies = {key: morsel.value for key, morsel in cookie.items()}
         return cookies
+
+
+def session_save_stats() -> Dict[str, Dict[str, int]]:
+    return {prefix: dict(stats) for prefix, stats in _session_save_stats.items()}
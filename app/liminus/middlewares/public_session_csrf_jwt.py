@@ -1,3 +1,5 @@
+from typing import List, Tuple
+
 from starlette.requests import Request
 from starlette.responses import Response
 
@@ -6,6 +8,8 @@ from liminus.base.backend import Backend, ReqSettings
 from liminus.base.middleware import GkRequestMiddleware
 from liminus.middlewares.mixins.csrf_mixin import CsrfHandlerMixin
 from liminus.middlewares.mixins.jwt_mixin import JwtHandlerMixin
+from liminus.middlewares.mixins.session_mixin import Session
+from liminus.redis_client import redis_client
 
 
 class PublicSessionMiddleware(GkRequestMiddleware, CsrfHandlerMixin, JwtHandlerMixin):
@@ -16,6 +20,8 @@ class PublicSessionMiddleware(GkRequestMiddleware, CsrfHandlerMixin, JwtHandlerM
      - Store authenticated member JWTs, and append these to all backend requests
     """
 
+    PARALLEL_SAFE = True
+
     SESSION_KEY_PREFIX = 'public_session_'
     SESSION_ID_COOKIE_NAME = settings.PUBLIC_SESSION_COOKIE_NAME
     SESSION_COOKIE_DOMAIN = settings.PUBLIC_COOKIES_DOMAIN
@@ -37,9 +43,9 @@ class PublicSessionMiddleware(GkRequestMiddleware, CsrfHandlerMixin, JwtHandlerM
         # if they already have a valid session, pull the session data
         # if this request needs a valid CSRF, validate it
         # if the session has an auth JWT, add it to the backend request
-        session = await self._load_session(req)
+        session, csrf_token_found = await self._load_session_and_csrf(req, reqset)
 
-        await self._verify_csrf_if_needed(req, session.session_id, reqset)
+        await self._verify_csrf_if_needed(req, session.session_id, reqset, csrf_token_found)
         await self._append_jwt_if_present(req, session)
 
     async def handle_response(self, res: Response, req: Request, reqset: ReqSettings, backend: Backend):
@@ -54,5 +60,30 @@ class PublicSessionMiddleware(GkRequestMiddleware, CsrfHandlerMixin, JwtHandlerM
 
         await self._rotate_csrf_if_needed(req, res, session.session_id, force_refresh=needs_new_session)
 
-        # we always save the session data even if it hasn't changed, to ensure the TTL is bumped
-        await self._store_session(session)
+        # only a new or changed session is written back, and otherwise its TTL is extended if it's running low
+        await self._save_session(session)
+
+    async def _load_session_and_csrf(self, req: Request, reqset: ReqSettings) -> Tuple[Session, bool]:
+        # both Redis keys come from the request, so the session and its CSRF token are read in one round trip
+        session_id = self._get_session_id(req)
+        csrf_token = self._get_csrf_token_to_verify(req, reqset)
+
+        # a transaction, as the CSRF check needs to be atomic
+        pipeline = redis_client().pipeline(transaction=True)
+        if session_id:
+            self._queue_session_load(pipeline, session_id)
+        if csrf_token:
+            self._queue_csrf_check(
+                pipeline, session_id, csrf_token, consume=bool(reqset.csrf and reqset.csrf.single_use)
+            )
+        results = await pipeline.execute()
+
+        session_data, ttl = self._decode_session_load(*results[:2]) if session_id else (None, None)
+        csrf_token_found = self._csrf_check_result(results[2:] if session_id else results) if csrf_token else False
+
+        session = await self._set_request_session(req, session_id, session_data, ttl)
+        return session, csrf_token_found
+
+    def _get_session_linked_redis_keys(self, session_id: str) -> List[str]:
+        # the session's CSRF tokens expire along with it
+        return [self._get_csrf_tokens_key(session_id, '')]
@@ -19,8 +19,15 @@ logger = settings.logger
 
 
 class RecaptchaCheckMiddleware(GkRequestMiddleware):
+    # the token can only be verified once, so this waits until the request has passed the CSRF check
+    # rather than spending the token on a request that is then rejected and retried with a new CSRF token
+    PARALLEL_SAFE = False
+
     campaign_settings: CampaignSettingsProvider = CampaignSettingsProvider()
 
+    def applies_to(self, reqset: ReqSettings) -> bool:
+        return bool(reqset.recaptcha and reqset.recaptcha.enabled != RecaptchaEnabled.DISABLED)
+
     async def handle_request(self, req: Request, reqset: ReqSettings, backend: Backend):
         if not reqset.recaptcha or reqset.recaptcha.enabled == RecaptchaEnabled.DISABLED:
             # nothing to check for this request
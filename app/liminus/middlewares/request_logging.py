@@ -1,28 +1,43 @@
 from secrets import token_hex
 from timeit import default_timer as timer
 
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import MutableHeaders
 from starlette.requests import Request
-from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from liminus.constants import Headers
 from liminus.settings import logger
 
 
-class RequestLoggingMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
+class RequestLoggingMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
         # the request id doesn't need to be globally unique, just for concurrent requests
         # and we don't want huge identifiers in logs
         request_id = token_hex(4)
-        request.scope['request_id'] = request_id
+        scope['request_id'] = request_id
+        request = Request(scope)
 
         start = timer()
         logger.debug(f'{request} start proxying {request.method} {request.url.path}')
 
-        response: Response = await call_next(request)
-        response.headers[Headers.X_REQUEST_ID] = request_id
+        status_code = None
 
-        end = timer()
-        logger.debug(f'{request} completed in {end - start} secs, responding with HTTP {response.status_code}')
+        async def send_with_request_id(message: Message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                headers = MutableHeaders(scope=message)
+                headers[Headers.X_REQUEST_ID] = request_id
+            await send(message)
 
-        return response
+        await self.app(scope, receive, send_with_request_id)
+
+        end = timer()
+        logger.debug(f'{request} completed in {end - start} secs, responding with HTTP {status_code}')
@@ -64,8 +64,8 @@ class StaffAuthSessionMiddleware(GkRequestMiddleware, JwtHandlerMixin):
                 res, session.session_id, age=self.SESSION_STRICT_MAX_LIFETIME_SECONDS
             )
 
-        # we always save the session data even if it hasn't changed, to ensure the TTL is bumped
-        await self._store_session(session)
+        # only a new or changed session is written back, and otherwise its TTL is extended if it's running low
+        await self._save_session(session)
 
     def _is_staff_authn_required(self, reqset: ReqSettings) -> bool:
         if not reqset.auth or not reqset.auth.requires_staff_auth:
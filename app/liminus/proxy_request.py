@@ -1,26 +1,58 @@
+import asyncio
 import logging
-from json import JSONDecodeError
-from typing import Dict, Union
-from urllib.parse import parse_qsl
-
-from aiohttp import ClientResponse, ClientSession, ClientTimeout, FormData
-from starlette.datastructures import URL, MultiDict, MutableHeaders, UploadFile
+from functools import partial
+from http import HTTPStatus
+from time import time
+from timeit import default_timer as timer
+from typing import AsyncIterator, Callable, Dict, List, Optional, Union, cast
+
+from aiohttp import ClientError, ClientResponse, FormData
+from multipart.multipart import parse_options_header
+from starlette.background import BackgroundTask
+from starlette.datastructures import URL, MutableHeaders, UploadFile
+from starlette.formparsers import MultiPartParser
 from starlette.requests import Request
-from starlette.responses import Response
-
-from liminus.base.backend import ListenPathSettings, ReqSettings
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.types import Message
+
+from liminus import json_codec, settings
+from liminus.admission import AdmissionController
+from liminus.base.backend import (
+    BodyLimitSettings,
+    ListenPathSettings,
+    ReqSettings,
+    RetryPolicy,
+    RouteSettings,
+    StreamingSettings,
+)
+from liminus.circuit_breaker import CircuitBreaker
+from liminus.connection_pools import ConnectionPool, get_ad_hoc_connection_pool
 from liminus.constants import Headers
+from liminus.errors import ErrorResponse
+from liminus.load_balancer import LoadBalancer, TargetState
+from liminus.request_coalescing import coalesce_key, request_coalescer
+from liminus.response_cache import (
+    CACHE_HIT,
+    CACHE_MISS,
+    CACHE_STALE,
+    request_cache_key,
+    request_is_cacheable,
+    response_cache,
+)
+from liminus.upstream_retry import send_timed, send_with_retry_policy
+from liminus.utils import LatencyWindow
 
 
 logger = logging.getLogger('gk-py-proxy')
-aiohttp_session = None
+JSON_CONTENT_TYPE = 'application/json'
 
 
 async def http_request(method: str, url: Union[str, URL], timeout: int = 10, **kwargs) -> ClientResponse:
     """
     This function is for making ad-hoc HTTP requests to other resources, eg to verify Recaptcha
     """
-    return await aiohttp_request(method=method, url=url, timeout=ClientTimeout(total=timeout), **kwargs)
+    pool = get_ad_hoc_connection_pool()
+    return await aiohttp_request(pool, method=method, url=url, timeout=pool.timeout(timeout), **kwargs)
 
 
 async def proxy_request_to_backend(request: Request) -> Response:
@@ -28,22 +60,172 @@ async def proxy_request_to_backend(request: Request) -> Response:
     This function is the main Gatekeeper proxying function, sending a request
     that has gone through all our middlewares to a backend
     """
+    backend_settings: RouteSettings = request.scope['backend_per_request_settings']
+    backend_listener: ListenPathSettings = request.scope['backend_listener']
+
+    # routes can opt in to having their responses cached
+    cache_settings = backend_settings.cache
+    cache_key = get_response_cache_key(request) if cache_settings else None
+    cached = None
+    if cache_settings and cache_key:
+        cached = await response_cache.lookup(cache_key, request.state.headers, cache_settings)
+        if cached and cached.is_fresh(time()):
+            return cached.to_response(CACHE_HIT)
+
+    # requests to an upstream known to be down have already failed fast, unless a cached response could be served
+    open_breaker: Optional[CircuitBreaker] = request.scope.get('open_upstream_breaker')
+    if open_breaker:
+        if cached:
+            return cached.to_response(CACHE_STALE)
+        raise circuit_open_error(request, open_breaker)
+
     backend_request_params = await construct_backend_request_params(request)
+    send_upstream = partial(
+        request_to_backend,
+        request,
+        pool=backend_listener.upstream_pool,
+        breaker=backend_listener.upstream_breaker,
+        balancer=backend_listener.load_balancer,
+        target=request.scope.get('upstream_target'),
+        url_for_target=partial(
+            backend_listener.get_upstream_url,
+            getattr(request.state, 'path', request.url.path),
+            getattr(request.state, 'query', request.url.query),
+        ),
+        admission=request.scope['backend'].admission_controller,
+        retry=backend_settings.retry,
+        latency_window=backend_settings.latency_window,
+        **backend_request_params,
+    )
+
+    if cached and cache_settings and cache_key:
+        # serve the stale response straight away, and refresh it in the background
+        # which is never streamed, as nothing would read the stream
+        response_cache.revalidate(cache_key, request.state.headers, cache_settings, send_upstream)
+        return cached.to_response(CACHE_STALE)
+
+    async def fetch_upstream(streaming: Optional[StreamingSettings]) -> Response:
+        response = await send_upstream(streaming=streaming)
+        if cache_settings and cache_key:
+            await response_cache.store(cache_key, request.state.headers, response, cache_settings)
+        return response
+
+    # a streamed response can't be shared between concurrent requests, so the others then make their own
+    coalescing_key = get_coalesce_key(request)
+    fetch = partial(fetch_upstream, backend_settings.streaming)
+    if coalescing_key:
+        response = await request_coalescer.run(coalescing_key, fetch)
+    else:
+        response = await fetch()
+
+    if cache_key:
+        response.headers[Headers.X_CACHE] = CACHE_MISS
+    return response
+
+
+def get_coalesce_key(request: Request) -> Optional[str]:
+    backend_settings: RouteSettings = request.scope['backend_per_request_settings']
+    backend_listener: ListenPathSettings = request.scope['backend_listener']
+    if not backend_settings.coalesce:
+        return None
+
+    # keyed on the upstream URL before any target is chosen, so requests share a call whichever target it goes to
+    override = request.state
+    upstream_url = backend_listener.get_upstream_url(
+        getattr(override, 'path', request.url.path), getattr(override, 'query', request.url.query)
+    )
+    method = getattr(override, 'method', request.method)
+    return coalesce_key(method, str(upstream_url), request.state.headers, backend_settings.coalesce)
 
-    return await request_to_backend(request, **backend_request_params)
 
+def get_response_cache_key(request: Request) -> Optional[str]:
+    # the upstream sees the headers as changed by the middleware, so that is what the cache looks at too
+    request_headers: MutableHeaders = request.state.headers
+    if not request_is_cacheable(request.method, request_headers):
+        return None
 
-async def request_to_backend(source_request: Request, **backend_request_params) -> Response:
+    override = request.state
+    return request_cache_key(
+        request.method,
+        request_headers.get('host', ''),
+        getattr(override, 'path', request.url.path),
+        getattr(override, 'query', request.url.query),
+    )
+
+
+async def request_to_backend(
+    source_request: Request,
+    streaming: Optional[StreamingSettings] = None,
+    pool: Optional[ConnectionPool] = None,
+    retry: Optional[RetryPolicy] = None,
+    latency_window: Optional[LatencyWindow] = None,
+    breaker: Optional[CircuitBreaker] = None,
+    balancer: Optional[LoadBalancer] = None,
+    target: Optional[TargetState] = None,
+    url_for_target: Optional[Callable[[TargetState], URL]] = None,
+    admission: Optional[AdmissionController] = None,
+    **backend_request_params,
+) -> Response:
     """
     This function is for making sub-requests to a backend, eg when a request requiring staff
     auth is sent to the Auth Service instead of the normal routing backend
     """
-    if 'timeout' in backend_request_params and isinstance(backend_request_params['timeout'], int):
-        backend_request_params['timeout'] = ClientTimeout(total=backend_request_params['timeout'])
+    upstream_pool = pool or get_ad_hoc_connection_pool()
+    timeout = backend_request_params.get('timeout')
+
+    tried_targets: List[TargetState] = []
+
+    async def send_attempt(attempt_timeout: Optional[float]) -> ClientResponse:
+        params = backend_request_params
+        if attempt_timeout is not None:
+            params = {**backend_request_params, 'timeout': upstream_pool.timeout(attempt_timeout)}
+        if not (balancer and target):
+            return await aiohttp_request(upstream_pool, allow_redirects=False, **params)
+
+        # retries and hedges go to a target other than the ones which were slow or failed, where there is one
+        attempt_target = target
+        if tried_targets:
+            attempt_target = balancer.choose(exclude=tried_targets)
+            if url_for_target:
+                params = {**params, 'url': url_for_target(attempt_target)}
+        tried_targets.append(attempt_target)
+
+        # the target is counted as busy until its response headers arrive
+        failed = False
+        balancer.start(attempt_target)
+        try:
+            response = await aiohttp_request(upstream_pool, allow_redirects=False, **params)
+            failed = response.status >= 500
+            return response
+        except (ClientError, asyncio.TimeoutError):
+            failed = True
+            raise
+        finally:
+            balancer.finish(attempt_target, failed)
 
     logger.debug(f'{source_request} proxying to backend {backend_request_params["url"]}')
 
-    backend_response: ClientResponse = await aiohttp_request(allow_redirects=False, **backend_request_params)
+    int_timeout = timeout if isinstance(timeout, int) else None
+    upstream_start = timer()
+    try:
+        if retry and retry.is_enabled() and _can_retry(backend_request_params, retry):
+            backend_response = await send_with_retry_policy(
+                send_attempt, retry, latency_window, int_timeout, log_prefix=str(source_request)
+            )
+        else:
+            backend_response = await send_timed(send_attempt, int_timeout, latency_window)
+    except (ClientError, asyncio.TimeoutError):
+        if breaker:
+            breaker.record_failure()
+        if admission:
+            admission.record_upstream_latency(timer() - upstream_start, failed=True)
+        raise
+
+    if admission:
+        admission.record_upstream_latency(timer() - upstream_start, failed=backend_response.status >= 500)
+
+    if breaker:
+        breaker.record_status(backend_response.status)
 
     response_log = f'{source_request} backend responded with HTTP {backend_response.status}'
     if 300 <= backend_response.status <= 308:
@@ -51,11 +233,30 @@ async def request_to_backend(source_request: Request, **backend_request_params)
         response_log += f' to {backend_response.headers.get("location")}'
     logger.debug(response_log)
 
+    if streaming and streaming.should_stream(
+        backend_response.content_length, backend_response.headers.get(Headers.CONTENT_TYPE, '')
+    ):
+        logger.debug(f'{source_request} streaming backend response')
+        return convert_aiohttp_reponse_to_starlette_stream(backend_response, streaming.chunk_size)
+
     starlette_response = await convert_aiohttp_reponse_to_starlette(backend_response)
 
     return starlette_response
 
 
+def circuit_open_error(request: Request, breaker: CircuitBreaker) -> ErrorResponse:
+    logger.info(f'{request} circuit breaker for {breaker.name} is {breaker.state}, failing fast')
+    msg = f'{request}: Upstream {breaker.name} is unavailable' if settings.DEBUG else ''
+    response = PlainTextResponse(msg, HTTPStatus.SERVICE_UNAVAILABLE, {Headers.RETRY_AFTER: str(breaker.retry_after())})
+    return ErrorResponse(response)
+
+
+def _can_retry(backend_request_params: Dict, retry: RetryPolicy) -> bool:
+    # a streamed body can only be sent once
+    replayable_body = isinstance(backend_request_params.get('data'), (bytes, type(None)))
+    return replayable_body and retry.allows_method(backend_request_params['method'])
+
+
 async def convert_aiohttp_reponse_to_starlette(aiohttp_reponse: ClientResponse) -> Response:
     # starlette.Response constructor only accepts a header dict, not multidict
     # but after creation it becomes a multidict, and we can call .append()
@@ -69,6 +270,34 @@ async def convert_aiohttp_reponse_to_starlette(aiohttp_reponse: ClientResponse)
     return response
 
 
+def convert_aiohttp_reponse_to_starlette_stream(aiohttp_reponse: ClientResponse, chunk_size: int) -> Response:
+    # the body is sent on to the client as it arrives, while the headers are available to
+    # the response middleware hooks as usual, as they run before the response starts
+    response = StreamingResponse(
+        content=_iter_aiohttp_response_body(aiohttp_reponse, chunk_size),
+        status_code=aiohttp_reponse.status,
+        # also releases the upstream connection of a response that is never sent
+        background=BackgroundTask(_release_aiohttp_response, aiohttp_reponse),
+    )
+    for k, v in aiohttp_reponse.headers.items():
+        response.headers.append(k, v)
+
+    return response
+
+
+async def _iter_aiohttp_response_body(aiohttp_reponse: ClientResponse, chunk_size: int) -> AsyncIterator[bytes]:
+    try:
+        async for chunk in aiohttp_reponse.content.iter_chunked(chunk_size):
+            yield chunk
+    finally:
+        # if the client goes away mid-stream, the upstream connection is released rather than left half read
+        aiohttp_reponse.release()
+
+
+async def _release_aiohttp_response(aiohttp_reponse: ClientResponse):
+    aiohttp_reponse.release()
+
+
 async def construct_backend_request_params(request: Request) -> Dict:
     # middleware can add settings to the request state, to override the request settings
     override = request.state
@@ -78,10 +307,10 @@ async def construct_backend_request_params(request: Request) -> Dict:
     # build the upstream URL
     request_path = getattr(override, 'path', request.url.path)
     request_query = getattr(override, 'query', request.url.query)
-    upstream_url = backend_listener.get_upstream_url(request_path)
-    if request_query:
-        query_params = MultiDict(parse_qsl(request_query, keep_blank_values=True))
-        upstream_url = upstream_url.include_query_params(**query_params)
+    # with several upstream targets, the least busy of two random ones is picked
+    upstream_target = backend_listener.choose_upstream_target()
+    request.scope['upstream_target'] = upstream_target
+    upstream_url = backend_listener.get_upstream_url(request_path, request_query, upstream_target)
 
     # we always use the mutable headers set in the middleware runner, so that
     # other middleware steps can delete / change request headers
@@ -94,6 +323,13 @@ async def construct_backend_request_params(request: Request) -> Dict:
     # ensure we have our request id sent upstream
     request_headers[Headers.X_REQUEST_ID] = request.scope['request_id']
 
+    # the client's Cookie header is forwarded as-is, unless some middleware provided new cookies
+    override_cookies = getattr(override, 'cookies', None)
+    if override_cookies is not None:
+        del request_headers[Headers.COOKIE]
+        if override_cookies:
+            request_headers[Headers.COOKIE] = '; '.join(f'{name}={value}' for name, value in override_cookies.items())
+
     # the listener may define custom headers
     for header_name, header_value in backend_listener.extra_headers:
         request_headers.append(header_name, header_value)
@@ -103,52 +339,188 @@ async def construct_backend_request_params(request: Request) -> Dict:
         'method': getattr(override, 'method', request.method),
         'url': upstream_url,
         'headers': request_headers,
-        'cookies': getattr(override, 'cookies', request.cookies),
         'timeout': backend_settings.timeout,
     }
 
     # if some middleware provided a new body, that takes precedence
     override_json = getattr(override, 'json', None)
     if override_json:
-        backend_request_params['json'] = override_json
+        backend_request_params['data'] = json_codec.dumps(override_json)
+        request_headers[Headers.CONTENT_TYPE] = JSON_CONTENT_TYPE
     else:
         # proxy the original request data
         # rather than just blindly proxying the binary request upstream, we parse it here and re-encode
         # this will hopefully protect our backing services against any weird content attacks
-        request_body = await request.body()
-        if request_body:
-            # there is a body, which we should parse and include in the upstream request
-            try:
-                json_data = await request.json()
-                backend_request_params['json'] = json_data
-            except (JSONDecodeError, UnicodeDecodeError):
-                # it's not json, try normal form data
-                request_form = await request.form()
-
-                backend_form = FormData()
-                for field_name, field_data in request_form.multi_items():
-                    if isinstance(field_data, UploadFile):
-                        file_data = await field_data.read()
-                        backend_form.add_field(
-                            field_name, file_data, filename=field_data.filename, content_type=field_data.content_type
-                        )
-                    else:
-                        backend_form.add_field(field_name, field_data)
-
-                backend_request_params['data'] = backend_form
+        body_limits = backend_settings.body_limits or BodyLimitSettings()
+        body_request = limit_request_body(request, body_limits)
+        content_type = request.headers.get(Headers.CONTENT_TYPE, '')
+
+        if content_type.startswith('multipart/form-data'):
+            # multipart is parsed straight from the request stream, with file parts spooled to disk
+            # rather than buffering the whole body first
+            backend_request_params['data'] = await construct_backend_form(body_request, body_limits)
+        elif content_type.startswith('application/x-www-form-urlencoded'):
+            if await body_request.body():
+                backend_request_params['data'] = await construct_backend_form(body_request, body_limits)
+        else:
+            request_body = await body_request.body()
+            if request_body:
+                # there is a body, which we should parse and include in the upstream request
+                declared_json = json_codec.is_json_content_type(content_type)
+                json_body = decode_json_body(request, request_body, body_limits, declared_json)
+                if json_body is not None:
+                    backend_request_params['data'] = json_body
+                    request_headers[Headers.CONTENT_TYPE] = JSON_CONTENT_TYPE
+                else:
+                    # it's not json, try normal form data
+                    backend_request_params['data'] = await construct_backend_form(body_request, body_limits)
 
     return backend_request_params
 
 
-async def get_aiohttp_session() -> ClientSession:
-    global aiohttp_session
-    if aiohttp_session is None:
-        aiohttp_session = ClientSession()
-    return aiohttp_session
+def decode_json_body(
+    request: Request, request_body: bytes, body_limits: BodyLimitSettings, declared_json: bool
+) -> Optional[bytes]:
+    """
+    Parses the body as JSON exactly once, and returns it re-encoded for the upstream request.
+    A body with a JSON content-type that is too large, too deep or invalid is a 400, while for any
+    other content-type a body that isn't JSON returns None
+    """
+    max_json_bytes = body_limits.max_json_bytes
+    if declared_json and max_json_bytes is not None and len(request_body) > max_json_bytes:
+        raise _invalid_json_error(request, f'JSON body is larger than {max_json_bytes} bytes')
+
+    try:
+        json_data, decoded_by_stdlib = json_codec.decode(request_body)
+    except (json_codec.JSONDecodeError, RecursionError):
+        if declared_json:
+            raise _invalid_json_error(request, 'JSON body could not be decoded')
+        return None
+
+    max_json_depth = body_limits.max_json_depth
+    if declared_json and max_json_depth is not None and json_codec.json_depth_exceeds(json_data, max_json_depth):
+        raise _invalid_json_error(request, f'JSON body is nested deeper than {max_json_depth}')
+
+    return json_codec.dumps(json_data, stdlib=decoded_by_stdlib)
+
+
+def _invalid_json_error(request: Request, details: str) -> ErrorResponse:
+    message = f'{request}: {details}' if settings.DEBUG else ''
+    return ErrorResponse(PlainTextResponse(message, HTTPStatus.BAD_REQUEST))
+
+
+async def construct_backend_form(request: Request, body_limits: BodyLimitSettings) -> FormData:
+    content_type = request.headers.get(Headers.CONTENT_TYPE, '')
+    if body_limits.max_file_bytes is not None and content_type.startswith('multipart/form-data'):
+        request_form = await FileLimitedMultiPartParser(request, body_limits.max_file_bytes).parse()
+    else:
+        request_form = await request.form()
+
+    backend_form = FormData()
+    for field_name, field_data in request_form.multi_items():
+        if isinstance(field_data, UploadFile):
+
+            # the file is sent upstream in chunks, from the spooled temp file
+            backend_form.add_field(
+                field_name,
+                _iter_upload_file(field_data),
+                filename=field_data.filename,
+                content_type=field_data.content_type,
+            )
+        else:
+            backend_form.add_field(field_name, field_data)
+
+    return backend_form
+
+
+class FileLimitedMultiPartParser(MultiPartParser):
+    """
+    Starlette's multipart parser, raising a 413 ErrorResponse as soon as any uploaded file passes max_file_bytes,
+    so the rest of an oversized file is never spooled to disk
+    """
+
+    def __init__(self, request: Request, max_file_bytes: int):
+        super().__init__(request.headers, request.stream())
+        self.request = request
+        self.max_file_bytes = max_file_bytes
+        self.header_field = b''
+        self.header_value = b''
+        self.part_filename: Optional[str] = None
+        self.part_bytes = 0
+
+    def on_part_begin(self) -> None:
+        super().on_part_begin()
+        self.part_filename = None
+        self.part_bytes = 0
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        super().on_header_field(data, start, end)
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        super().on_header_value(data, start, end)
+        self.header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        super().on_header_end()
+        if self.header_field.lower() == b'content-disposition':
+            _, options = parse_options_header(self.header_value)
+            if b'filename' in options:
+                self.part_filename = options[b'filename'].decode('latin-1')
+        self.header_field = b''
+        self.header_value = b''
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        # called while the parser is fed a chunk, before the parsed data is written to the spooled file
+        if self.part_filename is not None:
+            self.part_bytes += end - start
+            if self.part_bytes > self.max_file_bytes:
+                raise _body_too_large_error(self.request, f'file "{self.part_filename}" is too large')
+        super().on_part_data(data, start, end)
+
+
+async def _iter_upload_file(upload: UploadFile, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    await upload.seek(0)
+    while True:
+        chunk = cast(bytes, await upload.read(chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def limit_request_body(request: Request, body_limits: BodyLimitSettings) -> Request:
+    """
+    Returns a request whose body can only be read up to the max body size, raising a 413 ErrorResponse beyond that
+    """
+    if body_limits.max_body_bytes is None:
+        return request
+    max_body_bytes = body_limits.max_body_bytes
+
+    # reject up front if we are told the body is too large
+    content_length = request.headers.get(Headers.CONTENT_LENGTH, '')
+    if content_length.isdigit() and int(content_length) > max_body_bytes:
+        raise _body_too_large_error(request, f'Content-Length {content_length} is too large')
+
+    received = 0
+
+    async def limited_receive() -> Message:
+        nonlocal received
+        message = await request.receive()
+        received += len(message.get('body', b''))
+        if received > max_body_bytes:
+            raise _body_too_large_error(request, f'body is larger than {max_body_bytes} bytes')
+        return message
+
+    return Request(request.scope, limited_receive)
+
+
+def _body_too_large_error(request: Request, details: str) -> ErrorResponse:
+    message = f'{request}: request {details}' if settings.DEBUG else ''
+    return ErrorResponse(PlainTextResponse(message, HTTPStatus.REQUEST_ENTITY_TOO_LARGE))
 
 
-async def aiohttp_request(**kwargs) -> ClientResponse:
-    session = await get_aiohttp_session()
+async def aiohttp_request(pool: ConnectionPool, **kwargs) -> ClientResponse:
+    session = pool.session()
     # we need to convert the URL to a string for aoihttp, but we do this after any printing
     # so that secrets will be exposed for as short as possible
     kwargs['url'] = str(kwargs['url'])
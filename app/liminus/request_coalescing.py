@@ -0,0 +1,120 @@
+import asyncio
+from functools import partial
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from pydantic import BaseModel
+from starlette.datastructures import Headers as RequestHeaders
+from starlette.responses import Response, StreamingResponse
+
+from liminus.background_tasks import run_background_task
+from liminus.constants import Headers
+from liminus.response_cache import VISITOR_COOKIES_KEY, parse_cache_control, visitor_cookies
+
+
+class CoalesceSettings(BaseModel):
+    # concurrent requests only share an upstream call if these request headers match too
+    vary_headers: Set[str] = {'accept', 'accept-encoding', 'accept-language', 'host'}
+    # requests for a logged in user are always sent upstream on their own, unless this is set
+    allow_authenticated: bool = False
+
+
+class RequestCoalescer:
+    """
+    Identical GETs arriving while one is already in flight upstream wait for that one instead of
+    making their own upstream request, and each gets its own copy of the response to go through
+    the response middleware. The upstream request carries on even if the client which started it goes away.
+    A response which is only for the client that asked for it goes to that client alone,
+    and the others waiting for it then make their own upstream requests
+    """
+
+    def __init__(self):
+        self.upstream_requests = 0
+        self.coalesced_requests = 0
+        self.unshared_responses = 0
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def run(self, key: str, fetch: Callable[[], Awaitable[Response]]) -> Response:
+        upstream = self._in_flight.get(key)
+        is_first = upstream is None
+        if upstream is None:
+            self.upstream_requests += 1
+            upstream = asyncio.ensure_future(fetch())
+            self._in_flight[key] = upstream
+            upstream.add_done_callback(partial(self._finished, key))
+        else:
+            self.coalesced_requests += 1
+
+        try:
+            response = await asyncio.shield(upstream)
+        except asyncio.CancelledError:
+            if is_first:
+                # nobody else can take a response that is only for this request
+                upstream.add_done_callback(_discard_unshared)
+            raise
+
+        if is_shareable(response):
+            return copy_response(response)
+        if is_first:
+            return response
+
+        self.unshared_responses += 1
+        return await fetch()
+
+    def stats(self) -> dict:
+        return {
+            'upstream_requests': self.upstream_requests,
+            'coalesced_requests': self.coalesced_requests,
+            'unshared_responses': self.unshared_responses,
+            'in_flight': len(self._in_flight),
+        }
+
+    def _finished(self, key: str, upstream: asyncio.Future):
+        if self._in_flight.get(key) is upstream:
+            del self._in_flight[key]
+        # if every waiting client went away, nobody else will look at the error
+        if not upstream.cancelled():
+            upstream.exception()
+
+
+def coalesce_key(
+    method: str, upstream_url: str, request_headers: RequestHeaders, coalesce_settings: CoalesceSettings
+) -> Optional[str]:
+    if method != 'GET':
+        return None
+
+    is_authenticated = Headers.AUTHORIZATION in request_headers or any(
+        request_headers.get(h) for h in Headers.AUTH_JWT_HEADERS
+    )
+    if is_authenticated and not coalesce_settings.allow_authenticated:
+        return None
+
+    # an upstream can tailor a response to the visitor's cookies, so only requests sending the same ones share it
+    vary = [f'{name}:{request_headers.get(name, "")}' for name in sorted(coalesce_settings.vary_headers)]
+    vary.append(f'{VISITOR_COOKIES_KEY}:{visitor_cookies(request_headers)}')
+    return '\n'.join([f'{method} {upstream_url}', *vary])
+
+
+def is_shareable(response: Response) -> bool:
+    # a streamed body can only be read once, and a response starting a session
+    # or marked private is only for the client it was fetched for
+    if isinstance(response, StreamingResponse) or Headers.SET_COOKIE in response.headers:
+        return False
+    return 'private' not in parse_cache_control(response.headers.get(Headers.CACHE_CONTROL, ''))
+
+
+def _discard_unshared(upstream: asyncio.Future):
+    if upstream.cancelled() or upstream.exception() is not None:
+        return
+    response = upstream.result()
+    # a streamed response holds on to its upstream connection until its background task releases it
+    if not is_shareable(response) and response.background is not None:
+        run_background_task(response.background())
+
+
+def copy_response(response: Response) -> Response:
+    copy = Response(content=response.body, status_code=response.status_code)
+    copy.raw_headers = list(response.raw_headers)
+    return copy
+
+
+request_coalescer = RequestCoalescer()
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from liminus.base.backend import Backend, RouteSettings
+
+
+@dataclass
+class Resolution:
+    # a missing backend means a 404, a missing route means a 405 if route_wrong_method is set, otherwise 404
+    backend: Optional[Backend]
+    route: Optional[RouteSettings] = None
+    route_wrong_method: Optional[RouteSettings] = None
+
+
+class ResolutionCache:
+    """
+    An LRU memo of (method, path) -> the backend and route that request resolves to, including 404 / 405 outcomes.
+    Anyone can send us random paths, so to keep memory bounded the entries are capped per backend
+    (with requests matching no backend sharing their own cap), and very long paths are never cached
+    """
+
+    MAX_PATH_LENGTH = 256
+
+    def __init__(self, max_entries_per_backend: int):
+        self.max_entries_per_backend = max_entries_per_backend
+        self.hits = 0
+        self.misses = 0
+        self._buckets: Dict[Optional[str], OrderedDict] = {}
+        self._bucket_for_key: Dict[Tuple[str, str], Optional[str]] = {}
+
+    def get(self, method: str, path: str) -> Optional[Resolution]:
+        key = (method, path)
+        if key not in self._bucket_for_key:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        bucket = self._buckets[self._bucket_for_key[key]]
+        bucket.move_to_end(key)
+        return bucket[key]
+
+    def put(self, method: str, path: str, resolution: Resolution):
+        if self.max_entries_per_backend <= 0 or len(path) > self.MAX_PATH_LENGTH:
+            return
+
+        key = (method, path)
+        bucket_name = resolution.backend.name if resolution.backend else None
+        bucket = self._buckets.setdefault(bucket_name, OrderedDict())
+        if key not in bucket and len(bucket) >= self.max_entries_per_backend:
+            # evict the least recently used entry for this backend only
+            evicted_key, _ = bucket.popitem(last=False)
+            del self._bucket_for_key[evicted_key]
+
+        bucket[key] = resolution
+        self._bucket_for_key[key] = bucket_name
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': {str(name): len(bucket) for name, bucket in self._buckets.items()},
+        }
@@ -0,0 +1,343 @@
+import base64
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from time import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from aioredis.exceptions import RedisError
+from pydantic import BaseModel
+from starlette.datastructures import Headers as RequestHeaders
+from starlette.responses import Response, StreamingResponse
+
+from liminus import json_codec, settings
+from liminus.background_tasks import run_background_task
+from liminus.constants import Headers
+from liminus.redis_client import redis_client
+from liminus.settings import logger
+from liminus.utils import get_cache_hash_key
+
+
+CACHE_HIT = 'hit'
+CACHE_STALE = 'stale'
+CACHE_MISS = 'miss'
+
+CACHEABLE_STATUSES = {200, 203, 300, 301, 404, 410}
+# these are recalculated for every response served from the cache
+UNCACHED_RESPONSE_HEADERS = {Headers.AGE, Headers.CONTENT_LENGTH, Headers.X_CACHE}
+# an entry's bookkeeping, on top of its body and headers
+ENTRY_OVERHEAD_BYTES = 256
+GATEKEEPER_SESSION_COOKIES = {settings.PUBLIC_SESSION_COOKIE_NAME, settings.STAFF_SESSION_COOKIE_NAME}
+# never a request header name, so it can't clash with one listed in Vary
+VISITOR_COOKIES_KEY = 'visitor cookies'
+
+
+class CacheSettings(BaseModel):
+    # upstream Cache-Control is always honoured, these only fill in or cap what it says
+    default_ttl_seconds: Optional[float] = None
+    max_ttl_seconds: float = 300
+    stale_while_revalidate_seconds: Optional[float] = None
+    max_entry_bytes: int = 1024 * 1024
+    # also share cached responses between workers, through Redis
+    shared: bool = False
+
+
+@dataclass
+class CachedResponse:
+    status_code: int
+    headers: List[Tuple[str, str]]
+    body: bytes
+    stored_at: float
+    ttl: float
+    stale_ttl: float = 0
+    size: int = field(init=False)
+
+    def __post_init__(self):
+        self.size = len(self.body) + sum(len(k) + len(v) for k, v in self.headers) + ENTRY_OVERHEAD_BYTES
+
+    def is_fresh(self, now: float) -> bool:
+        return now < self.stored_at + self.ttl
+
+    def is_servable(self, now: float) -> bool:
+        return now < self.stored_at + self.ttl + self.stale_ttl
+
+    def to_response(self, cache_status: str) -> Response:
+        # every request gets its own response object, as the response middleware can change it
+        response = Response(content=self.body, status_code=self.status_code)
+        for k, v in self.headers:
+            response.headers.append(k, v)
+        response.headers[Headers.AGE] = str(max(0, int(time() - self.stored_at)))
+        response.headers[Headers.X_CACHE] = cache_status
+        return response
+
+    def encode(self) -> bytes:
+        return json_codec.dumps(
+            {
+                'status_code': self.status_code,
+                'headers': self.headers,
+                'body': base64.b64encode(self.body).decode(),
+                'stored_at': self.stored_at,
+                'ttl': self.ttl,
+                'stale_ttl': self.stale_ttl,
+            }
+        )
+
+    @classmethod
+    def decode(cls, data: bytes) -> 'CachedResponse':
+        entry = json_codec.loads(data)
+        entry['headers'] = [tuple(header) for header in entry['headers']]
+        entry['body'] = base64.b64decode(entry['body'])
+        return cls(**entry)
+
+
+class ResponseCache:
+    """
+    A per-worker LRU of upstream responses, bounded by the bytes it holds, optionally backed by Redis
+    so that workers can share what they have fetched. Responses are stored under their request's method,
+    host, path and query, plus the values of whichever request headers the upstream said they Vary on
+    """
+
+    # how many (method, host, path, query) -> Vary header lists to remember
+    MAX_VARY_ENTRIES = 10000
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes_held = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._entries: 'OrderedDict[str, CachedResponse]' = OrderedDict()
+        self._vary: 'OrderedDict[str, Tuple[str, ...]]' = OrderedDict()
+        self._revalidating: Set[str] = set()
+
+    async def lookup(
+        self, primary_key: str, request_headers: RequestHeaders, cache_settings: CacheSettings
+    ) -> Optional[CachedResponse]:
+        now = time()
+        vary = self._vary.get(primary_key)
+        if vary is None and cache_settings.shared:
+            vary = await self._shared_vary(primary_key)
+
+        entry = None
+        if vary is not None:
+            key = self._variant_key(primary_key, vary, request_headers)
+            entry = self._entries.get(key)
+            if entry is None and cache_settings.shared:
+                entry = await self._shared_entry(key)
+                if entry is not None:
+                    self._put(primary_key, vary, key, entry)
+
+            if entry is not None and not entry.is_servable(now):
+                self._remove(key)
+                entry = None
+
+            if entry is not None and key in self._entries:
+                self._entries.move_to_end(key)
+
+        if entry is None:
+            self.misses += 1
+        elif entry.is_fresh(now):
+            self.hits += 1
+        else:
+            self.stale_hits += 1
+        return entry
+
+    async def store(
+        self, primary_key: str, request_headers: RequestHeaders, response: Response, cache_settings: CacheSettings
+    ) -> Optional[CachedResponse]:
+        entry = cacheable_entry(response, cache_settings)
+        if entry is None or entry.size > self.max_bytes:
+            return None
+
+        vary = vary_headers(response)
+        key = self._variant_key(primary_key, vary, request_headers)
+        self._put(primary_key, vary, key, entry)
+        self.stores += 1
+
+        if cache_settings.shared:
+            await self._store_shared(primary_key, vary, key, entry)
+        return entry
+
+    def revalidate(
+        self,
+        primary_key: str,
+        request_headers: RequestHeaders,
+        cache_settings: CacheSettings,
+        fetch: Callable[[], Awaitable[Response]],
+    ):
+        # only one refresh of any stale response is ever in progress
+        if primary_key in self._revalidating:
+            return
+        self._revalidating.add(primary_key)
+        run_background_task(self._revalidate(primary_key, request_headers, cache_settings, fetch))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'hit_ratio': round((self.hits + self.stale_hits) / lookups, 3) if lookups else 0,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes_held': self.bytes_held,
+            'max_bytes': self.max_bytes,
+        }
+
+    async def _revalidate(
+        self,
+        primary_key: str,
+        request_headers: RequestHeaders,
+        cache_settings: CacheSettings,
+        fetch: Callable[[], Awaitable[Response]],
+    ):
+        try:
+            response = await fetch()
+            await self.store(primary_key, request_headers, response, cache_settings)
+        except Exception:
+            # the stale response was already served, so there is no one to report this to except the logs
+            logger.exception(f'revalidating cached response {primary_key} failed')
+        finally:
+            self._revalidating.discard(primary_key)
+
+    def _put(self, primary_key: str, vary: Tuple[str, ...], key: str, entry: CachedResponse):
+        self._vary[primary_key] = vary
+        self._vary.move_to_end(primary_key)
+        if len(self._vary) > self.MAX_VARY_ENTRIES:
+            self._vary.popitem(last=False)
+
+        self._remove(key)
+        self._entries[key] = entry
+        self.bytes_held += entry.size
+        while self.bytes_held > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes_held -= evicted.size
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes_held -= entry.size
+
+    def _variant_key(self, primary_key: str, vary: Tuple[str, ...], request_headers: RequestHeaders) -> str:
+        parts = [f'{name}:{request_headers.get(name, "")}' for name in vary]
+        # an upstream can tailor a response to the visitor's cookies without saying so in Vary,
+        # so only visitors sending the same cookies share an entry
+        cookies = visitor_cookies(request_headers)
+        if cookies:
+            parts.append(f'{VISITOR_COOKIES_KEY}:{cookies}')
+        return '\n'.join([primary_key, *parts])
+
+    async def _shared_vary(self, primary_key: str) -> Optional[Tuple[str, ...]]:
+        try:
+            vary = await redis_client().get(get_cache_hash_key('response-cache-vary-', primary_key))
+        except (RedisError, OSError):
+            logger.exception('shared response cache lookup failed')
+            return None
+        return tuple(name for name in vary.decode().split(',') if name) if vary is not None else None
+
+    async def _shared_entry(self, key: str) -> Optional[CachedResponse]:
+        try:
+            data = await redis_client().get(get_cache_hash_key('response-cache-', key))
+        except (RedisError, OSError):
+            logger.exception('shared response cache lookup failed')
+            return None
+        return CachedResponse.decode(data) if data is not None else None
+
+    async def _store_shared(self, primary_key: str, vary: Tuple[str, ...], key: str, entry: CachedResponse):
+        expire_seconds = max(1, int(entry.ttl + entry.stale_ttl))
+        try:
+            pipeline = redis_client().pipeline(transaction=False)
+            pipeline.setex(get_cache_hash_key('response-cache-vary-', primary_key), expire_seconds, ','.join(vary))
+            pipeline.setex(get_cache_hash_key('response-cache-', key), expire_seconds, entry.encode())
+            await pipeline.execute()
+        except (RedisError, OSError):
+            logger.exception('shared response cache store failed')
+
+
+def parse_cache_control(value: str) -> Dict[str, Optional[str]]:
+    directives: Dict[str, Optional[str]] = {}
+    for directive in value.split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+
+def vary_headers(response: Response) -> Tuple[str, ...]:
+    names = {name.strip().lower() for value in response.headers.getlist(Headers.VARY) for name in value.split(',')}
+    return tuple(sorted(name for name in names if name))
+
+
+def visitor_cookies(request_headers: RequestHeaders) -> str:
+    # the gatekeeper's own session ids mean nothing to an upstream, which is sent the session's JWT instead,
+    # so they are left out and visitors who only differ by them can still share a response
+    cookies = [cookie.strip() for cookie in request_headers.get(Headers.COOKIE, '').split(';')]
+    return '; '.join(
+        cookie for cookie in cookies if cookie and cookie.partition('=')[0].strip() not in GATEKEEPER_SESSION_COOKIES
+    )
+
+
+def request_cache_key(method: str, host: str, path: str, query: str) -> str:
+    return f'{method} {host}{path}?{query}'
+
+
+def request_is_cacheable(method: str, request_headers: RequestHeaders) -> bool:
+    if method != 'GET':
+        return False
+
+    # anything sent with credentials for the upstream is personal, and is never shared with anyone else
+    if Headers.AUTHORIZATION in request_headers or any(request_headers.get(h) for h in Headers.AUTH_JWT_HEADERS):
+        return False
+
+    directives = parse_cache_control(request_headers.get(Headers.CACHE_CONTROL, ''))
+    return 'no-store' not in directives and 'no-cache' not in directives
+
+
+def cacheable_entry(response: Response, cache_settings: CacheSettings) -> Optional[CachedResponse]:
+    if isinstance(response, StreamingResponse) or response.status_code not in CACHEABLE_STATUSES:
+        return None
+    if len(response.body) > cache_settings.max_entry_bytes:
+        return None
+
+    # responses starting or changing a session are never cached
+    if Headers.SET_COOKIE in response.headers or any(response.headers.get(h) for h in Headers.AUTH_JWT_HEADERS):
+        return None
+
+    directives = parse_cache_control(response.headers.get(Headers.CACHE_CONTROL, ''))
+    if directives.keys() & {'no-store', 'no-cache', 'private'} or '*' in vary_headers(response):
+        return None
+
+    ttl = _directive_seconds(directives, 's-maxage')
+    if ttl is None:
+        ttl = _directive_seconds(directives, 'max-age')
+    if ttl is None:
+        ttl = cache_settings.default_ttl_seconds
+    if not ttl or ttl <= 0:
+        return None
+
+    stale_ttl = _directive_seconds(directives, 'stale-while-revalidate')
+    if stale_ttl is None:
+        stale_ttl = cache_settings.stale_while_revalidate_seconds
+
+    return CachedResponse(
+        status_code=response.status_code,
+        headers=[(k, v) for k, v in response.headers.items() if k not in UNCACHED_RESPONSE_HEADERS],
+        body=response.body,
+        stored_at=time(),
+        ttl=min(ttl, cache_settings.max_ttl_seconds),
+        stale_ttl=stale_ttl or 0,
+    )
+
+
+def _directive_seconds(directives: Dict[str, Optional[str]], name: str) -> Optional[float]:
+    argument = directives.get(name)
+    try:
+        return float(argument) if argument is not None else None
+    except ValueError:
+        return None
+
+
+response_cache = ResponseCache(settings.RESPONSE_CACHE_MAX_BYTES)
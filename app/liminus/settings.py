@@ -34,6 +34,24 @@ BACKEND_ADMIN_DSN = env('BACKEND_ADMIN_DSN', cast=URL)
 
 BACKEND_DONATIONS_SERVICE_AUTH_JWT = env('DONATION_SERVICE_JWT', cast=Secret)
 
+# how many resolved (method, path) -> backend / route lookups to remember, per backend
+RESOLUTION_CACHE_MAX_ENTRIES_PER_BACKEND = env('RESOLUTION_CACHE_MAX_ENTRIES_PER_BACKEND', cast=int, default=256)
+
+# a cap on concurrent requests across all backends, 0 for no limit
+ADMISSION_MAX_IN_FLIGHT = env('ADMISSION_MAX_IN_FLIGHT', cast=int, default=0)
+ADMISSION_MAX_QUEUE_DEPTH = env('ADMISSION_MAX_QUEUE_DEPTH', cast=int, default=100)
+ADMISSION_QUEUE_TIMEOUT_SECONDS = env('ADMISSION_QUEUE_TIMEOUT_SECONDS', cast=float, default=1)
+
+# the most upstream response bytes each worker keeps in its response cache
+RESPONSE_CACHE_MAX_BYTES = env('RESPONSE_CACHE_MAX_BYTES', cast=int, default=32 * 1024 * 1024)
+
+# how many keepalive connections to open to each upstream at startup, and keep open while quiet
+UPSTREAM_PREWARM_CONNECTIONS = env('UPSTREAM_PREWARM_CONNECTIONS', cast=int, default=4)
+# startup never waits longer than this for the pre-warming
+UPSTREAM_PREWARM_TIMEOUT_SECONDS = env('UPSTREAM_PREWARM_TIMEOUT_SECONDS', cast=float, default=3)
+# this should be shorter than the connection pool keepalive timeout
+UPSTREAM_KEEPALIVE_INTERVAL_SECONDS = env('UPSTREAM_KEEPALIVE_INTERVAL_SECONDS', cast=float, default=10)
+
 # Campaign settings, eg for recaptcha
 READONLY_DATABASE_DSN = env('READONLY_DATABASE_DSN', cast=URL)
 CAMPAIGN_SETTINGS_CACHE_EXPIRY_SECONDS = 30
@@ -52,6 +70,10 @@ CORS_MIDDLEWARE_ARGS = {
     'allow_methods': ['GET', 'POST', 'PATCH', 'DELETE', 'OPTIONS'],
 }
 
+# a session's idle TTL is only extended once less than this fraction of it remains,
+# so an idle session can expire after as little as this fraction of its idle timeout
+SESSION_TTL_REFRESH_FRACTION = env('SESSION_TTL_REFRESH_FRACTION', cast=float, default=0.75)
+
 # Staff session settings
 STAFF_SESSION_COOKIE_NAME = env('STAFF_SESSION_COOKIE_NAME')
 STAFF_SESSION_COOKIE_DOMAIN = env('STAFF_SESSION_COOKIE_DOMAIN')
@@ -70,6 +92,9 @@ PUBLIC_CSRF_HEADER_NAME = 'Gk-Public-Csrf-Token'
 PUBLIC_COOKIES_DOMAIN = env('PUBLIC_COOKIES_DOMAIN')
 PUBLIC_SESSION_IDLE_TIMEOUT_SECONDS = to_seconds(minutes=30)
 PUBLIC_SESSION_STRICT_MAX_LIFETIME_SECONDS = to_seconds(hours=24)
+CSRF_MAX_TOKENS_PER_SESSION = env('CSRF_MAX_TOKENS_PER_SESSION', cast=int, default=10)
+# CSRF tokens used to have a Redis key each, these are still accepted until they've all expired
+CSRF_CHECK_LEGACY_KEYS = env('CSRF_CHECK_LEGACY_KEYS', cast=bool, default=True)
 
 # Member auth JWT verification / refreshing
 MEMBER_AUTH_JWKS_URL = url_join(BACKEND_AUTH_SERVICE_DSN, '/jwks')
@@ -0,0 +1,116 @@
+import asyncio
+from timeit import default_timer as timer
+from typing import Awaitable, Callable, Optional, Sequence
+
+from aiohttp import ClientConnectionError, ClientResponse
+
+from liminus.base.backend import RetryPolicy
+from liminus.settings import logger
+from liminus.utils import LatencyWindow
+
+
+# sends one attempt of the upstream request, with the given total timeout
+SendAttempt = Callable[[Optional[float]], Awaitable[ClientResponse]]
+
+
+async def send_with_retry_policy(
+    send_attempt: SendAttempt,
+    policy: RetryPolicy,
+    latency_window: Optional[LatencyWindow],
+    timeout: Optional[float],
+    log_prefix: str = '',
+) -> ClientResponse:
+    """
+    Sends the request, retrying connection errors and retryable statuses with a jittered backoff, and
+    optionally hedging each attempt once it is slower than the route's usual latency.
+    Every attempt has to fit within the overall deadline, and the last response or error is returned as-is
+    """
+    deadline_seconds = policy.deadline_seconds or timeout
+    deadline = timer() + deadline_seconds if deadline_seconds else None
+    hedge_after = policy.hedge_delay(latency_window)
+
+    attempt = 0
+    while True:
+        attempt += 1
+        is_last_attempt = attempt >= policy.max_attempts
+        attempt_timeout = _time_left(deadline, timeout)
+
+        try:
+            response = await send_hedged(send_attempt, attempt_timeout, hedge_after, latency_window)
+        except ClientConnectionError as error:
+            backoff = policy.backoff_delay(attempt)
+            if is_last_attempt or _out_of_time(deadline, backoff):
+                raise
+            logger.debug(f'{log_prefix} upstream attempt {attempt} failed with {error!r}, retrying in {backoff:.3f}s')
+        else:
+            if response.status not in policy.retry_on_statuses:
+                return response
+            backoff = policy.backoff_delay(attempt)
+            if is_last_attempt or _out_of_time(deadline, backoff):
+                return response
+            logger.debug(
+                f'{log_prefix} upstream attempt {attempt} gave HTTP {response.status}, retrying in {backoff:.3f}s'
+            )
+            response.release()
+
+        await asyncio.sleep(backoff)
+
+
+async def send_hedged(
+    send_attempt: SendAttempt,
+    timeout: Optional[float],
+    hedge_after: Optional[float],
+    latency_window: Optional[LatencyWindow],
+) -> ClientResponse:
+    if hedge_after is None or (timeout is not None and hedge_after >= timeout):
+        return await send_timed(send_attempt, timeout, latency_window)
+
+    tasks = [asyncio.ensure_future(send_timed(send_attempt, timeout, latency_window))]
+    done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+    if not done:
+        # the first request is slower than usual, so race it against a second one
+        hedge_timeout = timeout - hedge_after if timeout is not None else None
+        tasks.append(asyncio.ensure_future(send_timed(send_attempt, hedge_timeout, latency_window)))
+
+    return await _first_response(tasks)
+
+
+async def send_timed(
+    send_attempt: SendAttempt, timeout: Optional[float], latency_window: Optional[LatencyWindow]
+) -> ClientResponse:
+    start = timer()
+    response = await send_attempt(timeout)
+    if latency_window is not None and response.status < 500:
+        latency_window.record(timer() - start)
+    return response
+
+
+async def _first_response(tasks: Sequence[asyncio.Future]) -> ClientResponse:
+    # the first response wins, and only if every request failed is the last error raised
+    pending = set(tasks)
+    try:
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+            if not pending:
+                raise done.pop().exception()  # type: ignore
+    finally:
+        for task in pending:
+            task.cancel()
+        # a losing request may have finished anyway, and its connection goes back to the pool
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, ClientResponse):
+                result.release()
+
+
+def _time_left(deadline: Optional[float], timeout: Optional[float]) -> Optional[float]:
+    if deadline is None:
+        return timeout
+    time_left = max(deadline - timer(), 0.001)
+    return min(time_left, timeout) if timeout is not None else time_left
+
+
+def _out_of_time(deadline: Optional[float], backoff: float) -> bool:
+    return deadline is not None and timer() + backoff >= deadline
@@ -0,0 +1,84 @@
+import asyncio
+from timeit import default_timer as timer
+from typing import Dict, List, Optional, Tuple
+
+from liminus.base.backend import Backend
+from liminus.connection_pools import ConnectionPool
+from liminus.settings import logger
+
+
+upstream_warmup_stats: Dict[str, object] = {}
+_keepalive_task: Optional[asyncio.Task] = None
+
+
+async def prewarm_pool(pool: ConnectionPool, ping_url: str, connections: int, timeout: float) -> int:
+    # the pings are concurrent so that each one opens its own connection, all returned to the pool once read
+    async def ping():
+        async with pool.session().get(ping_url, timeout=pool.timeout(timeout)) as response:
+            await response.read()
+
+    results = await asyncio.gather(*[ping() for _ in range(connections)], return_exceptions=True)
+    return len([result for result in results if not isinstance(result, BaseException)])
+
+
+async def prewarm_upstreams(backends: List[Backend], connections: int, timeout: float) -> float:
+    """
+    Opens keepalive connections to every backend upstream, so the first real requests don't pay for
+    TCP and TLS setup. This never takes longer than the timeout, whatever state the upstreams are in
+    """
+    start = timer()
+    upstreams = _upstream_pools(backends)
+    warmed: Dict[str, int] = {name: 0 for name, _, _ in upstreams}
+
+    async def prewarm_upstream(name: str, pool: ConnectionPool, ping_url: str):
+        # a backend with several upstream targets warms connections to each of them
+        warmed[name] += await prewarm_pool(pool, ping_url, connections, timeout)
+
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*[prewarm_upstream(*upstream) for upstream in upstreams]), timeout=timeout
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f'pre-warming upstream connections timed out after {timeout} secs')
+
+    duration = timer() - start
+    upstream_warmup_stats.update({'duration_seconds': round(duration, 3), 'connections': warmed})
+    logger.info(f'pre-warmed upstream connections in {duration:.3f} secs: {warmed}')
+    return duration
+
+
+async def keep_upstreams_warm(backends: List[Backend], connections: int, interval: float, timeout: float):
+    # while an upstream is quiet its idle connections would expire, so ping through them to keep them open
+    # when there are requests in flight, real traffic is keeping the connections warm
+    upstreams = _upstream_pools(backends)
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.gather(
+            *[
+                prewarm_pool(pool, ping_url, connections, timeout)
+                for _, pool, ping_url in upstreams
+                if pool.stats()['in_use'] == 0
+            ]
+        )
+
+
+def start_upstream_keepalive(backends: List[Backend], connections: int, interval: float, timeout: float):
+    global _keepalive_task
+    _keepalive_task = asyncio.create_task(keep_upstreams_warm(backends, connections, interval, timeout))
+
+
+async def stop_upstream_keepalive():
+    global _keepalive_task
+    if _keepalive_task is not None:
+        _keepalive_task.cancel()
+        await asyncio.gather(_keepalive_task, return_exceptions=True)
+        _keepalive_task = None
+
+
+def _upstream_pools(backends: List[Backend]) -> List[Tuple[str, ConnectionPool, str]]:
+    return [
+        (be.name, be.listen.upstream_pool, ping_url)
+        for be in backends
+        if be.listen.upstream_dsn and be.listen.upstream_pool
+        for ping_url in be.listen.get_upstream_ping_urls()
+    ]
@@ -4,14 +4,18 @@ import ipaddress
 import math
 import re
 import socket
+from collections import deque
 from datetime import timedelta
 from os import getenv
-from typing import Optional, Pattern, Union
-from urllib.parse import urljoin
+from typing import Deque, Generic, List, Optional, Pattern, Sequence, Tuple, TypeVar, Union
+from urllib.parse import urljoin, urlsplit
 
 from starlette.datastructures import URL
 
 
+T = TypeVar('T')
+
+
 def get_env_var(name: str, default: str = None):
     value = getenv(name, default)
 
@@ -33,17 +37,125 @@ def url_join(url: Union[str, URL], path: str) -> URL:
     return URL(urljoin(str(url), path))
 
 
+class BaseUrlJoiner:
+    """
+    A precompiled `urljoin(base_url, path)` for a fixed base URL, which joins ordinary paths with plain string
+    assembly. Paths that urljoin treats specially (dot or empty segments, a scheme, params, query or fragment,
+    leading whitespace or control characters, which it strips) still go through urljoin, so the result is the same
+    """
+
+    SPECIAL_PATH = re.compile(r'//|/\.|^\.|[?#;:]|^\s|[\x00-\x1f\x7f]')
+
+    def __init__(self, base_url: Union[str, URL]):
+        self.base_url = str(base_url)
+        parts = urlsplit(self.base_url)
+        base_path = parts.path or '/'
+
+        self._origin = f'{parts.scheme}://{parts.netloc}'
+        # a relative path replaces the last segment of the base path
+        self._base_dir = base_path[: base_path.rfind('/') + 1]
+        self._simple_base = (
+            parts.scheme in ('http', 'https')
+            and not parts.query
+            and not parts.fragment
+            and not self.SPECIAL_PATH.search(base_path)
+        )
+
+    def join(self, path: str) -> str:
+        if not path:
+            return self.base_url
+
+        if not self._simple_base or self.SPECIAL_PATH.search(path):
+            return urljoin(self.base_url, path)
+
+        if path[0] == '/':
+            return self._origin + path
+
+        return self._origin + self._base_dir + path
+
+
 def strip_path_prefix(request_path: str, path: Optional[str] = None, path_regex: Optional[Pattern] = None) -> str:
     if path is not None and request_path.startswith(path):
         offset = len(path)
         return request_path[offset:]
 
     if path_regex is not None:
-        return re.sub(path_regex, '', request_path)
+        return path_regex.sub('', request_path)
 
     return request_path
 
 
+def compile_alternation(patterns: Sequence[Pattern]) -> Optional[Pattern]:
+    """
+    Combines regexes into a single alternation, with each wrapped in a named group "_<index>" so
+    that `match.lastgroup` tells us which one matched. Alternatives are tried in order, so the
+    first matching pattern wins just as if they were tried one by one.
+    Returns None if the patterns cannot be safely combined (mixed flags, numbered backreferences)
+    """
+    if not patterns:
+        return None
+
+    flags = patterns[0].flags
+    for pattern in patterns:
+        if pattern.flags != flags or re.search(r'\\[1-9]', pattern.pattern):
+            return None
+
+    try:
+        return re.compile('|'.join(f'(?P<_{i}>{p.pattern})' for i, p in enumerate(patterns)), flags)
+    except re.error:
+        return None
+
+
+class FirstMatchRegex(Generic[T]):
+    """
+    Matches a string against (regex, value) pairs in order, returning the value of the first regex
+    that matches. The regexes are combined into one alternation where possible, so a lookup is a
+    single regex match however many pairs there are
+    """
+
+    def __init__(self, entries: Sequence[Tuple[Pattern, T]]):
+        self.entries: List[Tuple[Pattern, T]] = list(entries)
+        self._combined = compile_alternation([pattern for pattern, _ in self.entries])
+
+    def __bool__(self) -> bool:
+        return bool(self.entries)
+
+    def match(self, string: str) -> Optional[T]:
+        if self._combined is not None:
+            match = self._combined.match(string)
+            if match and match.lastgroup:
+                return self.entries[int(match.lastgroup[1:])][1]
+            return None
+
+        # the regexes could not be combined, so fall back to trying each in turn
+        for pattern, value in self.entries:
+            if pattern.match(string):
+                return value
+
+        return None
+
+
+class LatencyWindow:
+    """
+    The most recent latency samples, in seconds, for percentile estimates
+    """
+
+    def __init__(self, size: int = 200):
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
 def ensure_bytes(input: Union[str, bytes, bytearray]) -> bytes:
     if isinstance(input, (bytes, bytearray)):
         return input
@@ -1,3 +1,4 @@
+import asyncio
 from unittest.mock import patch
 
 import fakeredis.aioredis
@@ -12,6 +13,7 @@ environ['TESTING'] = 'TRUE'
 environ['READONLY_DATABASE_DSN'] = ''
 environ['RECAPTCHA_VERIFY_URL'] = ''
 environ['DONATION_SERVICE_JWT'] = ''
+environ['UPSTREAM_PREWARM_CONNECTIONS'] = '0'
 
 environ['BACKEND_DONATIONS_DSN'] = 'https://unit-tests/'
 environ['BACKEND_WEB_ACT_DSN'] = 'https://unit-tests/'
@@ -24,6 +26,15 @@ environ['BACKEND_AUTH_SERVICE_DSN'] = 'https://unit-tests/'
 environ['APIS_CORS_ALLOWED_ORIGINS_REGEX'] = '.*\\.unit-tests\\.dev'
 
 
+def run(coroutine):
+    # unlike asyncio.run(), this leaves the current event loop in place, which creating a FakeRedis needs
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
 @pytest.fixture()
 def client():
     from liminus.app import create_app
@@ -34,3 +45,10 @@ def client():
     with patch('liminus.redis_client._redis_client', redis_pool):
         with TestClient(app) as test_client:
             yield test_client
+
+
+@pytest.fixture()
+def redis():
+    redis = fakeredis.aioredis.FakeRedis()
+    with patch('liminus.redis_client._redis_client', redis):
+        yield redis
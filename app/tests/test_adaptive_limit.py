@@ -0,0 +1,105 @@
+import asyncio
+import re
+
+from liminus.adaptive_limit import AdaptiveLimiter, AdaptiveLimitSettings
+from liminus.admission import AdmissionController, AdmissionSettings
+from liminus.backends.admin import admin_backend
+from liminus.proxy_request import request_to_backend
+
+from .conftest import run
+from .mock_http_proxy import MockHttpProxy
+
+
+def test_limit_grows_only_while_healthy_and_in_use():
+    limiter = AdaptiveLimiter('test', AdaptiveLimitSettings(initial_limit=10, max_limit=15))
+    for _ in range(100):
+        limiter.record(0.01, failed=False, in_flight=0)
+    assert limiter.current_limit() == 10
+
+    for _ in range(100):
+        limiter.record(0.01, failed=False, in_flight=limiter.current_limit())
+    assert limiter.current_limit() > 10
+
+    for _ in range(1000):
+        limiter.record(0.01, failed=False, in_flight=limiter.current_limit())
+    assert limiter.current_limit() == 15
+
+
+def test_limit_shrinks_when_latency_rises_above_the_baseline():
+    limiter = AdaptiveLimiter('test', AdaptiveLimitSettings(initial_limit=20, backoff_ratio=0.5, min_limit=3))
+    for _ in range(10):
+        limiter.record(0.01, failed=False, in_flight=0)
+    assert limiter.baseline_latency == 0.01
+
+    # the limit is cut once, and then not again until a limit's worth of slow requests have been seen
+    limiter.record(0.05, failed=False, in_flight=20)
+    assert limiter.current_limit() == 10
+    for _ in range(9):
+        limiter.record(0.05, failed=False, in_flight=20)
+    assert limiter.current_limit() == 10
+    limiter.record(0.05, failed=False, in_flight=20)
+    assert limiter.current_limit() == 5
+
+    for _ in range(100):
+        limiter.record(1, failed=True, in_flight=5)
+    assert limiter.current_limit() == 3
+    assert limiter.stats()['decreases'] > 2
+
+
+def test_baseline_follows_latency_up_slowly():
+    limiter = AdaptiveLimiter('test', AdaptiveLimitSettings(baseline_drift=0.1))
+    limiter.record(0.01, failed=False, in_flight=0)
+    for _ in range(100):
+        limiter.record(0.02, failed=False, in_flight=0)
+    assert 0.019 < limiter.baseline_latency < 0.02
+
+    # failures never teach the baseline anything
+    limiter.record(0.001, failed=True, in_flight=0)
+    assert limiter.baseline_latency > 0.019
+
+
+def test_admission_follows_the_adaptive_limit():
+    limiter = AdaptiveLimiter('test', AdaptiveLimitSettings(initial_limit=2, backoff_ratio=0.5, min_limit=1))
+    controller = AdmissionController('test', AdmissionSettings(max_queue_depth=5), limiter)
+
+    async def adaptive():
+        assert await controller.acquire()
+        assert await controller.acquire()
+        queued = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        assert not queued.done()
+
+        # healthy upstream requests while at the limit let it grow, admitting the queued request
+        while not queued.done():
+            controller.record_upstream_latency(0.01, failed=False)
+            await asyncio.sleep(0)
+        assert controller.in_flight == 3
+
+        # and once it shrinks, freed slots are not handed on until the requests in flight are under it
+        controller.record_upstream_latency(1, failed=True)
+        assert controller.max_in_flight() == 1
+        queued = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        controller.release()
+        controller.release()
+        await asyncio.sleep(0)
+        assert not queued.done()
+        controller.release()
+        assert await queued
+
+    run(adaptive())
+    assert controller.stats()['adaptive_limit']['limit'] == 1
+
+
+def test_upstream_latency_is_fed_to_the_limiter():
+    controller = admin_backend.admission_controller
+    assert controller.limiter is not None
+
+    async def send():
+        await request_to_backend('req', method='GET', url='https://unit-tests/admin/', admission=controller)
+
+    with MockHttpProxy() as m:
+        m.add(re.compile('.*'), 'GET', body='admin')
+        run(send())
+
+    assert controller.limiter.last_latency is not None
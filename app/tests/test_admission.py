@@ -0,0 +1,162 @@
+import asyncio
+import re
+
+import pytest
+from starlette.responses import Response
+
+from liminus.admission import (
+    REJECTED_DISPLACED,
+    REJECTED_QUEUE_FULL,
+    REJECTED_QUEUE_TIMEOUT,
+    AdmissionController,
+    AdmissionSettings,
+    RequestPriority,
+)
+from liminus.backends.donations_service import donation_service_backend
+
+from .conftest import run
+from .mock_http_proxy import MockHttpProxy
+
+
+def test_requests_over_the_limit_wait_for_a_slot():
+    controller = AdmissionController('test', AdmissionSettings(max_in_flight=2, max_queue_depth=5))
+
+    async def over_the_limit():
+        assert await controller.acquire()
+        assert await controller.acquire()
+
+        waiting = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        assert controller.stats()['queued'] == 1
+
+        # the freed slot is handed straight over
+        controller.release()
+        assert await waiting
+        assert controller.in_flight == 2
+
+        controller.release()
+        controller.release()
+
+    run(over_the_limit())
+    assert controller.stats() == {
+        'max_in_flight': 2,
+        'in_flight': 0,
+        'queued': 0,
+        'admitted': 3,
+        'rejected': {REJECTED_QUEUE_FULL: 0, REJECTED_QUEUE_TIMEOUT: 0, REJECTED_DISPLACED: 0},
+    }
+
+
+def test_queued_requests_are_admitted_by_priority():
+    controller = AdmissionController('test', AdmissionSettings(max_in_flight=1, max_queue_depth=5))
+    admitted = []
+
+    async def queued(name: str, priority: RequestPriority):
+        await controller.acquire(priority)
+        admitted.append(name)
+
+    async def by_priority():
+        await controller.acquire()
+        waiting = [
+            asyncio.ensure_future(queued('page', RequestPriority.NORMAL)),
+            asyncio.ensure_future(queued('stats', RequestPriority.LOW)),
+            asyncio.ensure_future(queued('donation', RequestPriority.HIGH)),
+            asyncio.ensure_future(queued('page-2', RequestPriority.NORMAL)),
+        ]
+        await asyncio.sleep(0)
+        for _ in waiting:
+            controller.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*waiting)
+
+    run(by_priority())
+    assert admitted == ['donation', 'page', 'page-2', 'stats']
+
+
+def test_full_queue_rejects_or_displaces_lower_priority():
+    controller = AdmissionController('test', AdmissionSettings(max_in_flight=1, max_queue_depth=1))
+
+    async def full_queue():
+        await controller.acquire()
+        low = asyncio.ensure_future(controller.acquire(RequestPriority.LOW))
+        await asyncio.sleep(0)
+
+        # an equal priority can't take its place, but a higher one can
+        assert not await controller.acquire(RequestPriority.LOW)
+        high = asyncio.ensure_future(controller.acquire(RequestPriority.HIGH))
+        await asyncio.sleep(0)
+        assert not await low
+
+        controller.release()
+        assert await high
+
+    run(full_queue())
+    assert controller.rejected == {REJECTED_QUEUE_FULL: 1, REJECTED_QUEUE_TIMEOUT: 0, REJECTED_DISPLACED: 1}
+
+
+def test_queue_timeout_and_cancellation():
+    controller = AdmissionController(
+        'test', AdmissionSettings(max_in_flight=1, max_queue_depth=5, queue_timeout_seconds=0.01)
+    )
+
+    async def time_out():
+        await controller.acquire()
+        assert not await controller.acquire()
+
+        cancelled = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+
+        assert controller.stats()['queued'] == 0
+        controller.release()
+
+    run(time_out())
+    assert controller.in_flight == 0
+    assert controller.rejected[REJECTED_QUEUE_TIMEOUT] == 1
+
+
+def test_unlimited_by_default():
+    controller = AdmissionController('test', AdmissionSettings())
+
+    async def many():
+        assert all([await controller.acquire() for _ in range(1000)])
+
+    run(many())
+    assert controller.in_flight == 1000
+
+
+@pytest.fixture
+def overloaded_donations():
+    controller = donation_service_backend.admission_controller
+    original_settings = controller.settings
+    controller.settings = AdmissionSettings(max_in_flight=0, retry_after_seconds=5)
+    yield controller
+    controller.settings = original_settings
+
+
+def test_overloaded_backend_sheds_load(client, overloaded_donations):
+    rejected = overloaded_donations.rejected[REJECTED_QUEUE_FULL]
+    with MockHttpProxy() as m:
+        m.add(re.compile('.*'), 'GET', body='pong')
+        response: Response = client.get('/donation/public_api/ping')
+        assert m.active_mock.call_count == 0
+
+    assert response.status_code == 503
+    assert response.headers['retry-after'] == '5'
+    # no session was started for the rejected request
+    assert 'set-cookie' not in response.headers
+    assert overloaded_donations.rejected[REJECTED_QUEUE_FULL] == rejected + 1
+    assert client.get('/health').json()['admission']['donations']['rejected'][REJECTED_QUEUE_FULL] == rejected + 1
+
+
+def test_admitted_requests_are_released(client):
+    controller = donation_service_backend.admission_controller
+    with MockHttpProxy() as m:
+        m.add(re.compile('.*'), 'GET', body='pong')
+        response: Response = client.get('/donation/public_api/ping')
+
+    assert response.status_code == 200
+    assert controller.in_flight == 0
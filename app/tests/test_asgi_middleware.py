@@ -0,0 +1,105 @@
+import re
+from unittest.mock import patch
+
+import pytest
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from liminus.base.backend import Backend, BackendDispatcher, ListenPathSettings, RouteSettings
+from liminus.base.middleware import GkRequestMiddleware
+from liminus.errors import ErrorResponse
+from liminus.middleware_runner import GatekeeperMiddlewareRunner
+from liminus.middlewares.request_logging import RequestLoggingMiddleware
+from liminus.resolution_cache import ResolutionCache
+
+
+SCOPE_KEYS = ['backend', 'backend_listener', 'backend_per_request_settings', 'request_id']
+
+
+class HookMiddleware(GkRequestMiddleware):
+    async def handle_request(self, req, reqset, backend):
+        if req.url.path == '/hooks/early':
+            return PlainTextResponse('early', 403)
+        if req.url.path == '/hooks/raise-request':
+            raise ErrorResponse(PlainTextResponse('request error', 401))
+
+    async def handle_response(self, res, req, reqset, backend):
+        res.headers['X-Hooked'] = 'yes'
+        if req.url.path == '/hooks/replace':
+            return PlainTextResponse('replaced', 202)
+        if req.url.path == '/hooks/raise-response':
+            raise ErrorResponse(PlainTextResponse('response error', 502))
+
+
+async def endpoint(request):
+    if request.url.path == '/hooks/raise-app':
+        raise ErrorResponse(PlainTextResponse('too large', 413))
+
+    scope_keys = ','.join(key for key in SCOPE_KEYS if key in request.scope)
+
+    async def body():
+        yield b'streamed '
+        yield scope_keys.encode()
+
+    return StreamingResponse(body(), headers={'X-Upstream': 'kept'})
+
+
+@pytest.fixture
+def client():
+    backend = Backend(
+        name='hooks',
+        listen=ListenPathSettings(path_regex=re.compile('^/hooks/')),
+        routes=[RouteSettings(path_regex=re.compile('^/hooks/'))],
+        middlewares=[HookMiddleware],
+    )
+    backend.init()
+
+    app = Starlette(
+        routes=[Route('/{path:path}', endpoint)],
+        middleware=[Middleware(RequestLoggingMiddleware), Middleware(GatekeeperMiddlewareRunner)],
+    )
+    with patch('liminus.middleware_runner.backend_dispatcher', BackendDispatcher([backend])):
+        with patch.object(GatekeeperMiddlewareRunner, '_resolution_cache', ResolutionCache(16)):
+            yield TestClient(app)
+
+
+def test_response_hooks_see_streamed_response(client):
+    response = client.get('/hooks/proxied')
+    assert response.status_code == 200
+    assert response.text == 'streamed ' + ','.join(SCOPE_KEYS)
+    assert response.headers['x-upstream'] == 'kept'
+    assert response.headers['x-hooked'] == 'yes'
+    assert len(response.headers['x-request-id']) == 8
+
+
+@pytest.mark.parametrize(
+    'path, status_code, text',
+    [
+        ('/hooks/early', 403, 'early'),
+        ('/hooks/raise-request', 401, 'request error'),
+        ('/hooks/replace', 202, 'replaced'),
+        ('/hooks/raise-response', 502, 'response error'),
+    ],
+)
+def test_hooks_can_short_circuit(client, path, status_code, text):
+    response = client.get(path)
+    assert response.status_code == status_code
+    assert response.text == text
+    assert 'x-upstream' not in response.headers
+    assert 'x-request-id' in response.headers
+
+
+def test_no_backend(client):
+    response = client.get('/elsewhere')
+    assert response.status_code == 404
+    assert 'x-request-id' in response.headers
+
+
+def test_response_hooks_see_error_raised_by_the_app(client):
+    response = client.get('/hooks/raise-app')
+    assert response.status_code == 413
+    assert response.text == 'too large'
+    assert response.headers['x-hooked'] == 'yes'
@@ -0,0 +1,86 @@
+import re
+from typing import List, Optional
+
+import pytest
+
+from liminus.base.backend import Backend, BackendDispatcher, ListenPathSettings
+
+
+def listener_matches_path(listen: ListenPathSettings, request_path: str) -> bool:
+    if listen.prefix and request_path.startswith(listen.prefix):
+        return True
+
+    if listen.path_regex and listen.path_regex.match(request_path):
+        return True
+
+    return False
+
+
+def linear_match(backends: List[Backend], request_path: str) -> Optional[Backend]:
+    # the plain first match in order, which the dispatcher must always agree with
+    for be in backends:
+        if listener_matches_path(be.listen, request_path):
+            return be
+    return None
+
+
+@pytest.fixture
+def backends() -> List[Backend]:
+    return [
+        Backend(name='admin', listen=ListenPathSettings(path_regex=re.compile('^/admin(/|$)'))),
+        Backend(name='simplesaml', listen=ListenPathSettings(prefix='/simplesaml/')),
+        Backend(name='donations', listen=ListenPathSettings(prefix='/donation/')),
+        Backend(name='donations-v2', listen=ListenPathSettings(prefix='/donation/v2/')),
+        Backend(name='auth', listen=ListenPathSettings(path_regex=re.compile('^/(auth|auth-service)/'))),
+        Backend(name='admin-shadowed', listen=ListenPathSettings(prefix='/admin/')),
+        Backend(name='act', listen=ListenPathSettings(prefix='/act/')),
+        Backend(name='donation-regex', listen=ListenPathSettings(path_regex=re.compile('/donation'))),
+        Backend(name='health', listen=ListenPathSettings(path_regex=re.compile('^/health(/|$)'))),
+    ]
+
+
+@pytest.mark.parametrize(
+    'request_path',
+    [
+        '/admin',
+        '/admin/',
+        '/admin/index.php',
+        '/administrator',
+        '/simplesaml/module.php',
+        '/simplesaml',
+        '/donation/',
+        '/donation',
+        '/donation/v2/new',
+        '/donation/public_api/ping',
+        '/auth/saml/metadata',
+        '/auth-service/jwks',
+        '/authors/',
+        '/act/cities.php',
+        '/health',
+        '/health/ping',
+        '/',
+        '',
+        '/unknown/path',
+    ],
+)
+def test_dispatch_matches_linear_scan(backends, request_path):
+    dispatcher = BackendDispatcher(backends)
+    assert dispatcher.match(request_path) is linear_match(backends, request_path)
+
+
+def test_first_backend_wins(backends):
+    dispatcher = BackendDispatcher(backends)
+    # both the regex and prefix admin backends match, but the regex one was listed first
+    assert dispatcher.match('/admin/index.php').name == 'admin'
+    # the shorter /donation/ prefix is listed before /donation/v2/, so it has priority
+    assert dispatcher.match('/donation/v2/new').name == 'donations'
+
+
+def test_uncombinable_regexes_fall_back(backends):
+    backends.append(Backend(name='backref', listen=ListenPathSettings(path_regex=re.compile(r'^/(x)\1/'))))
+    backends.append(Backend(name='nocase', listen=ListenPathSettings(path_regex=re.compile('^/CASE/', re.I))))
+    dispatcher = BackendDispatcher(backends)
+
+    assert dispatcher.match('/xx/page').name == 'backref'
+    assert dispatcher.match('/case/page').name == 'nocase'
+    assert dispatcher.match('/health/ping').name == 'health'
@@ -0,0 +1,117 @@
+import re
+from unittest.mock import patch
+
+import pytest
+from aiohttp import ClientConnectionError
+from starlette.responses import Response
+
+from liminus.backends.dev_cloudflare_simulator import dev_cfsimulator_backend
+from liminus.backends.donations_service import donation_service_backend
+from liminus.circuit_breaker import STATE_CLOSED, STATE_HALF_OPEN, STATE_OPEN, CircuitBreaker, CircuitBreakerSettings
+from liminus.middleware_runner import GatekeeperMiddlewareRunner
+from liminus.response_cache import CACHE_STALE, CachedResponse
+
+from .mock_http_proxy import MockHttpProxy
+
+
+@pytest.fixture
+def breaker():
+    breaker = donation_service_backend.listen.upstream_breaker
+    yield breaker
+    breaker.record_success()
+
+
+def test_opens_after_consecutive_failures_and_probes_once_half_open():
+    breaker = CircuitBreaker('test', CircuitBreakerSettings(failure_threshold=3, open_seconds=10))
+
+    with patch('liminus.circuit_breaker.monotonic', return_value=100):
+        breaker.record_failure()
+        breaker.record_status(200)
+        breaker.record_failure()
+        breaker.record_status(502)
+        assert breaker.state == STATE_CLOSED
+
+        breaker.record_status(504)
+        assert breaker.state == STATE_OPEN
+        assert not breaker.allow_request()
+        assert breaker.retry_after() == 10
+
+    with patch('liminus.circuit_breaker.monotonic', return_value=110):
+        # a single probe is let through, and everything else still fails fast
+        assert breaker.allow_request()
+        assert breaker.state == STATE_HALF_OPEN
+        assert not breaker.allow_request()
+
+        # the probe failing opens the circuit again straight away
+        breaker.record_failure()
+        assert breaker.state == STATE_OPEN
+        assert not breaker.allow_request()
+
+    with patch('liminus.circuit_breaker.monotonic', return_value=120):
+        assert breaker.allow_request()
+        breaker.record_status(404)
+        assert breaker.state == STATE_CLOSED
+        assert breaker.allow_request()
+
+    assert breaker.stats() == {'state': STATE_CLOSED, 'consecutive_failures': 0, 'times_opened': 2, 'rejected': 3}
+
+
+def test_lost_probe_is_replaced():
+    breaker = CircuitBreaker('test', CircuitBreakerSettings(failure_threshold=1, open_seconds=10))
+
+    with patch('liminus.circuit_breaker.monotonic', return_value=100):
+        breaker.record_failure()
+    with patch('liminus.circuit_breaker.monotonic', return_value=110):
+        assert breaker.allow_request()
+    # the probe never reported back, eg the client went away
+    with patch('liminus.circuit_breaker.monotonic', return_value=115):
+        assert not breaker.allow_request()
+    with patch('liminus.circuit_breaker.monotonic', return_value=120):
+        assert breaker.allow_request()
+
+
+def test_disabled_breaker_always_allows():
+    breaker = CircuitBreaker('test', CircuitBreakerSettings(enabled=False, failure_threshold=1))
+    breaker.record_failure()
+    assert breaker.allow_request()
+
+
+def test_open_circuit_fails_fast(client, breaker):
+    with MockHttpProxy() as m:
+        m.add(re.compile('.*'), 'GET', exception=ClientConnectionError(), repeat=True)
+        for _ in range(breaker.settings.failure_threshold):
+            with pytest.raises(ClientConnectionError):
+                client.get('/donation/public_api/ping')
+        assert m.active_mock.call_count == breaker.settings.failure_threshold
+
+        with patch.object(GatekeeperMiddlewareRunner, '_run_request_hooks') as run_request_hooks:
+            response: Response = client.get('/donation/public_api/ping')
+        assert response.status_code == 503
+        assert int(response.headers['retry-after']) > 0
+        # the upstream was not tried again, and no session or other request hook work was done either
+        assert m.active_mock.call_count == breaker.settings.failure_threshold
+        assert not run_request_hooks.called
+
+    health = client.get('/health').json()
+    assert health['circuit_breakers']['donations']['state'] == STATE_OPEN
+
+
+def test_open_circuit_still_serves_stale_cached_responses(client):
+    breaker = dev_cfsimulator_backend.listen.upstream_breaker
+    with MockHttpProxy() as m:
+        headers = {'Cache-Control': 'max-age=60', 'Content-Length': '4'}
+        m.add(re.compile('.*'), 'GET', body='page', headers=headers, repeat=True)
+        client.get('/page/while-down')
+
+        for _ in range(breaker.settings.failure_threshold):
+            breaker.record_failure()
+        try:
+            with patch.object(CachedResponse, 'is_fresh', return_value=False):
+                response: Response = client.get('/page/while-down')
+        finally:
+            breaker.record_success()
+        assert m.active_mock.call_count == 1
+
+    assert response.status_code == 200
+    assert response.headers['x-gk-cache'] == CACHE_STALE
+    assert response.content == b'page'
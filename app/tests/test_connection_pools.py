@@ -0,0 +1,63 @@
+import re
+
+from starlette.responses import Response
+
+from liminus.backends.donations_service import donation_service_backend
+from liminus.backends.web_act import web_act_backend
+from liminus.connection_pools import (
+    ConnectionPool,
+    ConnectionPoolSettings,
+    connection_pool_stats,
+    get_ad_hoc_connection_pool,
+)
+
+from .conftest import run
+from .mock_http_proxy import MockHttpProxy
+
+
+def test_each_upstream_has_its_own_pool():
+    pools = [web_act_backend.listen.upstream_pool, donation_service_backend.listen.upstream_pool]
+    pools.append(get_ad_hoc_connection_pool())
+    assert all(isinstance(pool, ConnectionPool) for pool in pools)
+    assert len(set(map(id, pools))) == 3
+
+
+def test_pool_timeouts_are_kept_with_a_request_timeout():
+    pool = ConnectionPool('timeouts', ConnectionPoolSettings(connect_timeout_seconds=1, read_timeout_seconds=5))
+    timeout = pool.timeout(10)
+    assert (timeout.total, timeout.sock_connect, timeout.sock_read) == (10, 1, 5)
+    # and requests without one of their own can never hang forever
+    assert pool.timeout().total == 300
+
+
+def test_pool_session_settings_and_stats():
+    pool = ConnectionPool(
+        'stats', ConnectionPoolSettings(max_connections=7, max_connections_per_host=3, dns_cache_ttl_seconds=None)
+    )
+    assert pool.stats() == {'max_connections': 7, 'max_connections_per_host': 3, 'in_use': 0, 'idle': 0, 'waiting': 0}
+
+    async def use_pool():
+        session = pool.session()
+        assert session is pool.session()
+        assert session.connector.limit == 7
+        assert session.connector.limit_per_host == 3
+        assert not session.connector.use_dns_cache
+        assert session.timeout.total == 300
+        await pool.close()
+        # a closed pool starts a new session when next used
+        assert pool.session() is not session
+        await pool.close()
+
+    run(use_pool())
+
+
+def test_proxied_requests_use_the_backend_pool(client):
+    with MockHttpProxy() as m:
+        m.add(re.compile('.*'), 'GET', body='ok')
+        response: Response = client.get('/act/cities.php')
+
+        assert response.status_code == 200
+        session = m.active_mock.call_args.args[0]
+        assert session is web_act_backend.listen.upstream_pool._session
+
+    assert 'web-act' in connection_pool_stats()
@@ -0,0 +1,74 @@
+import gc
+import re
+import tracemalloc
+from itertools import count
+
+from aiohttp import web
+from starlette.responses import Response
+
+from liminus.connection_pools import ConnectionPool, ConnectionPoolSettings
+
+from .conftest import run
+from .mock_http_proxy import MockHttpProxy
+
+
+def test_cookie_header_forwarded_as_is(client):
+    # a cookie header that would change if it were parsed and re-encoded
+    cookie_header = 'a=b; quoted="x y"; flag; a=duplicate'
+    with MockHttpProxy() as m:
+        m.add(re.compile('.*'), 'GET', body='ok')
+        response: Response = client.get('/act/cities.php', headers={'cookie': cookie_header})
+
+        assert response.status_code == 200
+        backend_request_args = m.active_mock.call_args.kwargs
+        assert 'cookies' not in backend_request_args
+        assert backend_request_args['headers']['cookie'] == cookie_header
+
+
+async def soak_distinct_set_cookies(requests: int) -> list:
+    # an upstream that sets a new, distinct cookie on every response
+    cookie_ids = count()
+
+    async def set_cookie(request):
+        response = web.Response(text='ok')
+        cookie_id = next(cookie_ids)
+        response.set_cookie(f'upstream_{cookie_id}', 'x' * 100)
+        return response
+
+    upstream = web.Application()
+    upstream.router.add_get('/', set_cookie)
+    runner = web.AppRunner(upstream, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    pool = ConnectionPool('soak', ConnectionPoolSettings())
+    memory_samples = []
+    try:
+        for request_number in range(requests):
+            async with pool.session().get(f'http://localhost:{port}/') as response:
+                await response.read()
+            if request_number % 500 == 499:
+                gc.collect()
+                memory_samples.append(tracemalloc.get_traced_memory()[0])
+
+        assert len(pool.session().cookie_jar) == 0
+    finally:
+        await pool.close()
+        await runner.cleanup()
+
+    return memory_samples
+
+
+def test_upstream_set_cookies_do_not_accumulate():
+    tracemalloc.start()
+    try:
+        memory_samples = run(soak_distinct_set_cookies(2000))
+    finally:
+        tracemalloc.stop()
+
+    # after warming up, memory stays flat rather than growing with every distinct cookie
+    # a shared cookie jar would hold 1500 more cookies of over 100 bytes each by the end
+    growth = memory_samples[-1] - memory_samples[0]
+    assert growth < 100 * 1024, memory_samples
@@ -0,0 +1,236 @@
+import asyncio
+import json
+from time import time
+from unittest.mock import patch
+
+import pytest
+from starlette.requests import Request
+from starlette.responses import Response
+
+from liminus import background_tasks, settings
+from liminus.base.backend import CsrfSettings, ReqSettings
+from liminus.errors import ErrorResponse
+from liminus.expire_legacy_csrf_keys import expire_legacy_csrf_keys
+from liminus.middlewares.mixins.csrf_mixin import CONSUMED_CSRF_SCORE_OFFSET
+from liminus.middlewares.public_session_csrf_jwt import PublicSessionMiddleware
+
+from .conftest import run
+
+
+CSRF_REQSET = ReqSettings(csrf=CsrfSettings(require_token=True, single_use=True))
+
+
+def make_request(session_id: str, csrf_token: str, method: str = 'POST') -> Request:
+    cookie = f'{PublicSessionMiddleware.SESSION_ID_COOKIE_NAME}={session_id}'
+    headers = [
+        (b'cookie', cookie.encode()),
+        (PublicSessionMiddleware.CSRF_HEADER_NAME.lower().encode(), csrf_token.encode()),
+    ]
+    request = Request({'type': 'http', 'method': method, 'path': '/', 'query_string': b'', 'headers': headers})
+    request.state.headers = request.headers.mutablecopy()
+    return request
+
+
+async def start_session(redis, middleware: PublicSessionMiddleware, session_id: str, csrf_token: str):
+    session_key = middleware._get_session_redis_key(session_id)
+    await redis.setex(session_key, 60, json.dumps({'strict_expiry': 2 ** 40, 'jwt': 'j'}))
+    await middleware._store_new_csrf(session_id, csrf_token)
+
+
+async def token_score(redis, session_id: str, csrf_token: str):
+    middleware = PublicSessionMiddleware()
+    tokens_key = middleware._get_csrf_tokens_key(session_id, csrf_token)
+    return await redis.zscore(tokens_key, middleware._get_csrf_token_hash(csrf_token))
+
+
+def test_session_and_csrf_are_checked_in_one_round_trip(redis):
+    middleware = PublicSessionMiddleware()
+    request = make_request('abc', 'token')
+
+    async def post():
+        await start_session(redis, middleware, 'abc', 'token')
+        with patch.object(redis, 'pipeline', wraps=redis.pipeline) as pipeline, patch.object(
+            redis, 'get', wraps=redis.get
+        ) as get, patch.object(redis, 'expire', wraps=redis.expire) as expire:
+            await middleware.handle_request(request, CSRF_REQSET, None)
+        return pipeline.call_count, get.call_count + expire.call_count, await token_score(redis, 'abc', 'token')
+
+    pipelines, other_calls, score = run(post())
+    assert (pipelines, other_calls) == (1, 0)
+    # the token was consumed, but can still be reused for a few seconds
+    assert 0 < score - CONSUMED_CSRF_SCORE_OFFSET - time() <= middleware.CSRF_REUSE_GRACE_TTL_SECONDS
+    assert request.state.rotate_csrf
+    assert request.state.headers[middleware.AUTH_JWT_HEADER] == 'j'
+
+
+def test_consumed_csrf_can_be_reused_within_the_grace_ttl(redis):
+    middleware = PublicSessionMiddleware()
+
+    async def post_twice():
+        await start_session(redis, middleware, 'abc', 'token')
+        for _ in range(2):
+            await middleware.handle_request(make_request('abc', 'token'), CSRF_REQSET, None)
+
+    run(post_twice())
+
+
+@pytest.mark.parametrize('session_id, csrf_token', [('abc', 'wrong'), ('other', 'token'), ('abc', '')])
+def test_invalid_csrf_is_rejected_with_a_new_token(redis, session_id, csrf_token):
+    middleware = PublicSessionMiddleware()
+
+    async def post():
+        await start_session(redis, middleware, 'abc', 'token')
+        await middleware.handle_request(make_request(session_id, csrf_token), CSRF_REQSET, None)
+
+    with pytest.raises(ErrorResponse) as error:
+        run(post())
+    assert error.value.response.status_code == 401
+    assert error.value.response.headers[middleware.CSRF_HEADER_NAME]
+
+
+def test_csrf_is_only_checked_when_required(redis):
+    middleware = PublicSessionMiddleware()
+    request = make_request('abc', '', method='GET')
+
+    async def get():
+        await start_session(redis, middleware, 'abc', 'token')
+        await middleware.handle_request(request, CSRF_REQSET, None)
+        response = Response()
+        await middleware.handle_response(response, request, CSRF_REQSET, None)
+        return response
+
+    response = run(get())
+    assert middleware.CSRF_HEADER_NAME.lower() not in response.headers
+
+
+def test_consuming_csrf_tokens_leaves_no_pending_tasks(redis):
+    middleware = PublicSessionMiddleware()
+
+    async def many_posts():
+        session_ids = [f'session-{i}' for i in range(200)]
+        for session_id in session_ids:
+            await start_session(redis, middleware, session_id, 'token')
+
+        # let fakeredis finish disconnecting any connections left over from earlier tests
+        await asyncio.sleep(0)
+        tasks_before = len(asyncio.all_tasks())
+        background_tasks_before = len(background_tasks._background_tasks)
+        await asyncio.gather(
+            *[
+                middleware.handle_request(make_request(session_id, 'token'), CSRF_REQSET, None)
+                for session_id in session_ids
+            ]
+        )
+        return (tasks_before, background_tasks_before), (
+            len(asyncio.all_tasks()),
+            len(background_tasks._background_tasks),
+        )
+
+    before, after = run(many_posts())
+    assert before == after
+
+
+def test_expired_consumed_csrf_is_rejected(redis):
+    middleware = PublicSessionMiddleware()
+    tokens_key = middleware._get_csrf_tokens_key('abc', 'token')
+
+    async def post_after_grace():
+        await start_session(redis, middleware, 'abc', 'token')
+        expired_score = CONSUMED_CSRF_SCORE_OFFSET + time() - 1
+        await redis.zadd(tokens_key, {middleware._get_csrf_token_hash('token'): expired_score})
+        try:
+            await middleware.handle_request(make_request('abc', 'token'), CSRF_REQSET, None)
+        finally:
+            # and it's removed, rather than brought back by being consumed again
+            assert await token_score(redis, 'abc', 'token') is None
+
+    with pytest.raises(ErrorResponse):
+        run(post_after_grace())
+
+
+def test_csrf_tokens_are_capped_per_session_and_expire_with_it(redis):
+    middleware = PublicSessionMiddleware()
+    tokens_key = middleware._get_csrf_tokens_key('abc', '')
+    tokens = [f'token-{i}' for i in range(middleware.CSRF_MAX_TOKENS_PER_SESSION + 5)]
+
+    async def rotate_tokens():
+        for token in tokens:
+            await middleware._store_new_csrf('abc', token)
+        count, ttl = await redis.zcard(tokens_key), await redis.ttl(tokens_key)
+        scores = [await token_score(redis, 'abc', token) for token in tokens]
+
+        await redis.expire(tokens_key, 5)
+        await middleware._store_session_in_cache('abc', middleware.SESSION_IDLE_TIMEOUT_SECONDS, {})
+        return count, ttl, scores, await redis.ttl(tokens_key)
+
+    count, ttl, scores, ttl_after_session_store = run(rotate_tokens())
+    assert count == middleware.CSRF_MAX_TOKENS_PER_SESSION
+    assert 0 < ttl <= middleware.SESSION_IDLE_TIMEOUT_SECONDS
+    # only the most recent tokens are kept
+    assert [score is not None for score in scores] == [False] * 5 + [True] * middleware.CSRF_MAX_TOKENS_PER_SESSION
+    assert ttl_after_session_store > middleware.SESSION_IDLE_TIMEOUT_SECONDS - 5
+
+
+def test_consumed_csrf_outlives_rotations_in_a_full_session(redis):
+    middleware = PublicSessionMiddleware()
+    max_tokens = middleware.CSRF_MAX_TOKENS_PER_SESSION
+    tokens_key = middleware._get_csrf_tokens_key('abc', '')
+
+    async def reuse_after_rotations():
+        for i in range(max_tokens - 1):
+            await middleware._store_new_csrf('abc', f'earlier-token-{i}')
+        await start_session(redis, middleware, 'abc', 'token')
+        await middleware.handle_request(make_request('abc', 'token'), CSRF_REQSET, None)
+
+        # other tabs are given new tokens, taking the set well over its cap
+        for i in range(max_tokens):
+            await middleware._store_new_csrf('abc', f'later-token-{i}')
+        await middleware.handle_request(make_request('abc', 'token'), CSRF_REQSET, None)
+
+        unconsumed = await redis.zcount(tokens_key, '-inf', f'({CONSUMED_CSRF_SCORE_OFFSET}')
+        return unconsumed, [await token_score(redis, 'abc', f'earlier-token-{i}') for i in range(max_tokens - 1)]
+
+    unconsumed, earlier_scores = run(reuse_after_rotations())
+    # the oldest unconsumed tokens made way instead
+    assert unconsumed == max_tokens
+    assert earlier_scores == [None] * (max_tokens - 1)
+
+
+def test_legacy_csrf_keys_are_still_accepted(redis):
+    middleware = PublicSessionMiddleware()
+    legacy_key = middleware._get_legacy_csrf_cache_key('abc', 'old-token')
+    request = make_request('abc', 'old-token')
+
+    async def post_with_legacy_token():
+        await start_session(redis, middleware, 'abc', 'token')
+        await redis.set(legacy_key, '1')
+        await middleware.handle_request(request, CSRF_REQSET, None)
+        return await redis.ttl(legacy_key)
+
+    # the legacy token is consumed the same way it always was
+    assert 0 < run(post_with_legacy_token()) <= middleware.CSRF_REUSE_GRACE_TTL_SECONDS
+    assert request.state.rotate_csrf
+
+
+def test_legacy_csrf_keys_are_given_an_expiry(redis):
+    middleware = PublicSessionMiddleware()
+    legacy_keys = [middleware._get_legacy_csrf_cache_key('abc', f'old-token-{i}') for i in range(5)]
+
+    async def migrate():
+        for key in legacy_keys:
+            await redis.set(key, '1')
+        await redis.setex(legacy_keys[0], 2, '1')
+        await middleware._store_new_csrf('abc', 'token')
+
+        expired = await expire_legacy_csrf_keys(batch_size=2)
+        return (
+            expired,
+            [await redis.ttl(key) for key in legacy_keys],
+            await redis.ttl(middleware._get_csrf_tokens_key('abc', '')),
+        )
+
+    expired, ttls, tokens_ttl = run(migrate())
+    assert expired == 4
+    assert ttls[0] <= 2
+    assert all(0 < ttl <= settings.PUBLIC_SESSION_STRICT_MAX_LIFETIME_SECONDS for ttl in ttls[1:])
+    assert tokens_ttl <= middleware.SESSION_IDLE_TIMEOUT_SECONDS
@@ -0,0 +1,173 @@
+import asyncio
+import re
+from typing import List
+
+import pytest
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+
+from liminus.backends.donations_service import donation_service_backend
+from liminus.base.backend import Backend, ListenPathSettings, RecaptchaEnabled, RecaptchaSettings, RouteSettings
+from liminus.base.middleware import GkRequestMiddleware
+from liminus.errors import ErrorResponse
+from liminus.middleware_runner import GatekeeperMiddlewareRunner
+from liminus.middlewares.add_ip_headers import AddIpHeadersMiddleware
+from liminus.middlewares.public_session_csrf_jwt import PublicSessionMiddleware
+from liminus.middlewares.recaptcha_check import RecaptchaCheckMiddleware
+from liminus.middlewares.restrict_headers import RestrictHeadersMiddleware
+
+from .conftest import run
+
+
+class RequestOnlyMiddleware(GkRequestMiddleware):
+    async def handle_request(self, req, reqset, backend):
+        pass
+
+
+class ResponseOnlyMiddleware(GkRequestMiddleware):
+    async def handle_response(self, res, req, reqset, backend):
+        pass
+
+
+class InheritedRequestMiddleware(RequestOnlyMiddleware):
+    pass
+
+
+class NoHooksMiddleware(GkRequestMiddleware):
+    pass
+
+
+class AdminOnlyMiddleware(RequestOnlyMiddleware):
+    def applies_to(self, reqset):
+        return str(reqset).startswith('/p/admin')
+
+
+def hook_owners(hooks):
+    return [type(hook.__self__) for hook in hooks]
+
+
+def request_hook_owners(route):
+    return hook_owners([hook for stage in route.request_stages for hook in stage])
+
+
+def test_only_overridden_hooks_are_compiled():
+    backend = Backend(
+        name='pipeline',
+        listen=ListenPathSettings(prefix='/p/'),
+        routes=[RouteSettings(path='/p/admin'), RouteSettings(path='/p/public')],
+        middlewares=[
+            RequestOnlyMiddleware,
+            ResponseOnlyMiddleware,
+            InheritedRequestMiddleware,
+            NoHooksMiddleware,
+            AdminOnlyMiddleware,
+        ],
+    )
+    backend.init()
+    admin_route, public_route = backend.routes
+
+    assert request_hook_owners(admin_route) == [
+        RequestOnlyMiddleware,
+        InheritedRequestMiddleware,
+        AdminOnlyMiddleware,
+    ]
+    assert request_hook_owners(public_route) == [RequestOnlyMiddleware, InheritedRequestMiddleware]
+    assert hook_owners(admin_route.response_hooks) == [ResponseOnlyMiddleware]
+    assert hook_owners(public_route.response_hooks) == [ResponseOnlyMiddleware]
+
+
+def test_recaptcha_only_applies_to_enabled_routes():
+    middleware = RecaptchaCheckMiddleware()
+    assert not middleware.applies_to(RouteSettings())
+    assert not middleware.applies_to(RouteSettings(recaptcha=RecaptchaSettings(enabled=RecaptchaEnabled.DISABLED)))
+    assert middleware.applies_to(RouteSettings(recaptcha=RecaptchaSettings(enabled=RecaptchaEnabled.ALWAYS)))
+
+    for route in donation_service_backend.routes:
+        recaptcha_hooked = RecaptchaCheckMiddleware in request_hook_owners(route)
+        assert recaptcha_hooked == (route.recaptcha.enabled != RecaptchaEnabled.DISABLED)
+
+
+def test_routes_without_middlewares_have_empty_pipelines():
+    backend = Backend(name='bare', listen=ListenPathSettings(path_regex=re.compile('^/bare/')))
+    backend.init()
+    assert backend.routes[0].request_stages == []
+    assert backend.routes[0].response_hooks == []
+
+
+def test_parallel_safe_hooks_share_a_stage():
+    new_donation, *_ = [
+        route for route in donation_service_backend.routes if route.path == '/donation/public_api/new_donation'
+    ]
+    stages = [hook_owners(stage) for stage in new_donation.request_stages]
+    assert stages == [
+        [AddIpHeadersMiddleware, PublicSessionMiddleware],
+        [RecaptchaCheckMiddleware],
+        [RestrictHeadersMiddleware],
+    ]
+
+
+class SlowMiddleware(GkRequestMiddleware):
+    PARALLEL_SAFE = True
+
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.finished = False
+        self.cancelled = False
+
+    async def handle_request(self, req, reqset, backend):
+        self.started.set()
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        self.finished = True
+
+
+class RejectingMiddleware(GkRequestMiddleware):
+    PARALLEL_SAFE = True
+
+    def __init__(self, others: List[SlowMiddleware], reject_with_error: bool, status_code: int = 401):
+        self.others = others
+        self.reject_with_error = reject_with_error
+        self.status_code = status_code
+
+    async def handle_request(self, req, reqset, backend):
+        # this can only complete if the other hooks in its stage are running at the same time
+        await asyncio.gather(*[other.started.wait() for other in self.others])
+        response = PlainTextResponse('rejected', self.status_code)
+        if self.reject_with_error:
+            raise ErrorResponse(response)
+        return response
+
+
+async def run_concurrent_stage(reject_with_error: bool):
+    backend = Backend(name='concurrent', listen=ListenPathSettings(prefix='/c/'))
+    backend.init()
+    slow_hooks = [SlowMiddleware(), SlowMiddleware()]
+    backend.middleware_instances = [
+        slow_hooks[0],
+        RejectingMiddleware(slow_hooks, reject_with_error),
+        slow_hooks[1],
+        # rejects before any of the others have finished, but is declared after them
+        RejectingMiddleware([], reject_with_error, status_code=403),
+    ]
+    route = backend.routes[0]
+    backend._compile_middleware_hooks(route)
+    assert len(route.request_stages) == 1
+
+    runner = GatekeeperMiddlewareRunner(app=PlainTextResponse(''))
+    request = Request({'type': 'http', 'method': 'GET', 'path': '/c/', 'query_string': b'', 'headers': []})
+    try:
+        early_response = await asyncio.wait_for(runner._run_request_hooks(request, route, backend), timeout=5)
+    except ErrorResponse as error:
+        early_response = error.response
+
+    assert all(hook.finished and not hook.cancelled for hook in slow_hooks)
+    return early_response
+
+
+@pytest.mark.parametrize('reject_with_error', [False, True])
+def test_first_declared_rejection_wins_once_the_stage_finishes(reject_with_error):
+    early_response = run(run_concurrent_stage(reject_with_error))
+    assert early_response.status_code == 401
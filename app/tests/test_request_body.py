@@ -0,0 +1,226 @@
+from typing import List, Optional
+from unittest.mock import patch
+
+import pytest
+from aiohttp import FormData
+from starlette.datastructures import URL, UploadFile
+from starlette.requests import Request
+
+from liminus.base.backend import BodyLimitSettings, ListenPathSettings, RouteSettings
+from liminus.errors import ErrorResponse
+from liminus.proxy_request import construct_backend_request_params
+
+from .conftest import run
+
+
+FILE_DATA = b'0123456789' * 10_000
+
+
+def make_request(body: bytes, content_type: str, body_limits: BodyLimitSettings, content_length: bool = True):
+    received: List[bytes] = []
+    chunk_size = 4096
+    chunks = [body[start:][:chunk_size] for start in range(0, len(body), chunk_size)] or [b'']
+
+    async def receive():
+        chunk = chunks.pop(0)
+        received.append(chunk)
+        return {'type': 'http.request', 'body': chunk, 'more_body': bool(chunks)}
+
+    headers = [(b'content-type', content_type.encode())]
+    if content_length:
+        headers.append((b'content-length', str(len(body)).encode()))
+
+    scope = {
+        'type': 'http',
+        'method': 'POST',
+        'path': '/u/upload',
+        'query_string': b'',
+        'headers': headers,
+        'backend_listener': ListenPathSettings(prefix='/u/', upstream_dsn=URL('https://upstream/')),
+        'backend_per_request_settings': RouteSettings(body_limits=body_limits, timeout=10),
+        'request_id': 'abcd',
+    }
+    request = Request(scope, receive)
+    request.state.headers = request.headers.mutablecopy()
+    return request, received
+
+
+class BufferWriter:
+    def __init__(self):
+        self.buffer = b''
+
+    async def write(self, data: bytes):
+        self.buffer += data
+
+
+def multipart_upload():
+    form = FormData()
+    form.add_field('title', 'export')
+    form.add_field('upload', FILE_DATA, filename='data.bin', content_type='application/octet-stream')
+    multipart = form()
+
+    async def render() -> bytes:
+        writer = BufferWriter()
+        await multipart.write(writer)
+        return writer.buffer
+
+    return run(render()), multipart.content_type
+
+
+def construct(request: Request) -> dict:
+    return run(construct_backend_request_params(request))
+
+
+def assert_too_large(request: Request):
+    with pytest.raises(ErrorResponse) as error:
+        construct(request)
+    assert error.value.response.status_code == 413
+
+
+def test_multipart_is_re_encoded_from_the_stream():
+    body, content_type = multipart_upload()
+    request, _ = make_request(body, content_type, BodyLimitSettings())
+
+    params = construct(request)
+    # the body was parsed straight from the stream, rather than buffered whole first
+    assert not hasattr(request, '_body')
+    assert isinstance(params['data'], FormData)
+
+    async def render() -> bytes:
+        writer = BufferWriter()
+        await params['data']().write(writer)
+        return writer.buffer
+
+    upstream_body = run(render())
+    assert FILE_DATA in upstream_body
+    assert b'name="title"' in upstream_body
+    assert b'filename="data.bin"' in upstream_body
+
+
+@pytest.mark.parametrize('max_body_bytes, max_file_bytes', [(None, None), (len(FILE_DATA) * 2, len(FILE_DATA))])
+def test_multipart_within_limits(max_body_bytes: Optional[int], max_file_bytes: Optional[int]):
+    body, content_type = multipart_upload()
+    request, _ = make_request(
+        body, content_type, BodyLimitSettings(max_body_bytes=max_body_bytes, max_file_bytes=max_file_bytes)
+    )
+    assert isinstance(construct(request)['data'], FormData)
+
+
+def test_declared_content_length_rejected_before_reading():
+    body, content_type = multipart_upload()
+    request, received = make_request(body, content_type, BodyLimitSettings(max_body_bytes=1000))
+
+    assert_too_large(request)
+    assert received == []
+
+
+@pytest.mark.parametrize('multipart', [False, True])
+def test_undeclared_body_rejected_while_reading(multipart):
+    if multipart:
+        body, content_type = multipart_upload()
+    else:
+        body, content_type = b'{"a": "' + b'x' * 20_000 + b'"}', 'application/json'
+    request, received = make_request(body, content_type, BodyLimitSettings(max_body_bytes=10_000), content_length=False)
+
+    assert_too_large(request)
+    # we stop reading as soon as the limit is passed
+    assert len(b''.join(received)) <= 10_000 + 4096
+
+
+def test_file_too_large():
+    body, content_type = multipart_upload()
+    request, _ = make_request(body, content_type, BodyLimitSettings(max_file_bytes=len(FILE_DATA) - 1))
+    assert_too_large(request)
+
+
+def test_file_too_large_rejected_before_spooling():
+    body, content_type = multipart_upload()
+    request, received = make_request(body, content_type, BodyLimitSettings(max_file_bytes=10_000))
+
+    written: List[int] = []
+    write = UploadFile.write
+
+    async def spy_write(upload: UploadFile, data: bytes):
+        written.append(len(data))
+        await write(upload, data)
+
+    with patch.object(UploadFile, 'write', spy_write):
+        assert_too_large(request)
+    # reading stops within a chunk of the limit, and nothing past the limit reaches the spooled file
+    assert len(b''.join(received)) <= 10_000 + 2 * 4096
+    assert sum(written) <= 10_000
+
+
+def test_json_within_limits():
+    request, _ = make_request(b'{"a": 1}', 'application/json', BodyLimitSettings(max_body_bytes=100))
+    assert construct(request)['data'] == b'{"a":1}'
+
+
+@pytest.mark.parametrize(
+    'body, body_limits',
+    [
+        (b'{"a": ', BodyLimitSettings()),
+        (b'\xff\xfe', BodyLimitSettings()),
+        (b'{"a": "' + b'x' * 100 + b'"}', BodyLimitSettings(max_json_bytes=50)),
+        (b'[' * 5 + b']' * 5, BodyLimitSettings(max_json_depth=4)),
+        (b'{"a": ' * 5 + b'1' + b'}' * 5, BodyLimitSettings(max_json_depth=4)),
+        (b'[' * 100_000 + b']' * 100_000, BodyLimitSettings(max_json_bytes=None, max_json_depth=None)),
+    ],
+)
+def test_invalid_declared_json(body, body_limits):
+    request, _ = make_request(body, 'application/json; charset=utf-8', body_limits)
+    with pytest.raises(ErrorResponse) as error:
+        construct(request)
+    assert error.value.response.status_code == 400
+
+
+@pytest.mark.parametrize('content_type', ['text/plain', ''])
+def test_json_limits_only_apply_to_declared_json(content_type):
+    body = b'[' * 5 + b']' * 5
+    request, _ = make_request(body, content_type, BodyLimitSettings(max_json_bytes=4, max_json_depth=4))
+    assert construct(request)['data'] == body
+
+
+def test_json_limits_are_opt_in():
+    request, _ = make_request(b'[' * 100 + b']' * 100, 'application/json', BodyLimitSettings())
+    assert construct(request)['data'] == b'[' * 100 + b']' * 100
+
+
+@pytest.mark.parametrize('content_type', ['application/json', 'application/vnd.api+json', 'text/plain', ''])
+def test_json_is_re_encoded_as_bytes(content_type):
+    request, _ = make_request(b'{"amount": 10, "currency": "EUR", "nested": [[1]]}', content_type, BodyLimitSettings())
+    params = construct(request)
+    assert params['data'] == b'{"amount":10,"currency":"EUR","nested":[[1]]}'
+    assert params['headers']['content-type'] == 'application/json'
+    assert 'json' not in params
+
+
+def test_stdlib_json_fallback():
+    request, _ = make_request(b'{"a": [1, 2]}', 'application/json', BodyLimitSettings())
+    with patch('liminus.json_codec.HAS_ORJSON', False):
+        assert construct(request)['data'] == b'{"a":[1,2]}'
+
+
+@pytest.mark.parametrize(
+    'body, upstream_body',
+    [
+        # as before orjson, these are all forwarded exactly as the stdlib json decoded them
+        (b'{"id": 123456789012345678901234567890}', b'{"id":123456789012345678901234567890}'),
+        (b'[18446744073709551616, -9223372036854775809]', b'[18446744073709551616,-9223372036854775809]'),
+        (b'{"a": NaN, "b": -Infinity}', b'{"a":NaN,"b":-Infinity}'),
+        (b'"\\ud800"', b'"\\ud800"'),
+    ],
+)
+def test_json_orjson_cannot_keep_exactly_is_left_to_the_stdlib(body, upstream_body):
+    request, _ = make_request(body, 'application/json', BodyLimitSettings())
+    assert construct(request)['data'] == upstream_body
+
+
+def test_urlencoded_form_is_not_parsed_as_json():
+    request, _ = make_request(b'a=1&b=2', 'application/x-www-form-urlencoded', BodyLimitSettings())
+    with patch('liminus.json_codec.decode') as decode:
+        params = construct(request)
+
+    decode.assert_not_called()
+    assert isinstance(params['data'], FormData)
+    assert 'content-type' not in params['headers']
@@ -0,0 +1,215 @@
+import asyncio
+import re
+from typing import List, Optional
+from unittest.mock import patch
+
+import pytest
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
+from starlette.responses import Response, StreamingResponse
+
+from liminus import settings
+from liminus.request_coalescing import CoalesceSettings, RequestCoalescer, coalesce_key
+
+from .conftest import run
+from .mock_http_proxy import MockHttpProxy
+
+
+class GatedUpstream:
+    # responses are held back until the test releases them, so it decides exactly which requests overlap
+    def __init__(self, body=b'campaign', error=None, headers=None, streamed=False):
+        self.body = body
+        self.error = error
+        self.headers = headers or {'cache-control': 'no-cache'}
+        self.streamed = streamed
+        self.fetches = 0
+        self.discards = 0
+        self._gate: Optional[asyncio.Event] = None
+        self._discarded: Optional[asyncio.Event] = None
+
+    @property
+    def gate(self) -> asyncio.Event:
+        # created on first use, inside the test's event loop
+        if self._gate is None:
+            self._gate = asyncio.Event()
+        return self._gate
+
+    @property
+    def discarded(self) -> asyncio.Event:
+        if self._discarded is None:
+            self._discarded = asyncio.Event()
+        return self._discarded
+
+    async def fetch(self) -> Response:
+        self.fetches += 1
+        body = self.body if self.body is not None else f'for request {self.fetches}'
+        await self.gate.wait()
+        if self.error:
+            raise self.error
+        if self.streamed:
+            return StreamingResponse(iter([body]), background=BackgroundTask(self._discard))
+        return Response(content=body, headers=self.headers)
+
+    async def _discard(self):
+        self.discards += 1
+        self.discarded.set()
+
+
+async def overlapping(coalescer: RequestCoalescer, requests: List[tuple]) -> list:
+    tasks = [asyncio.ensure_future(coalescer.run(key, upstream.fetch)) for key, upstream in requests]
+    # one pass of the loop lets every request join in before any upstream answers
+    await asyncio.sleep(0)
+    for _, upstream in requests:
+        upstream.gate.set()
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def test_concurrent_requests_share_one_upstream_call():
+    coalescer = RequestCoalescer()
+    campaign, other = GatedUpstream(), GatedUpstream(b'other')
+
+    *responses, other_response = run(
+        overlapping(coalescer, [('GET /campaign', campaign)] * 10 + [('GET /other', other)])
+    )
+    assert (campaign.fetches, other.fetches) == (1, 1)
+    assert other_response.body == b'other'
+    assert {response.body for response in responses} == {b'campaign'}
+
+    # every request has its own copy, for the response middleware to change
+    assert len({id(response) for response in responses}) == 10
+    responses[0].headers['set-cookie'] = 'session=abc'
+    assert 'set-cookie' not in responses[1].headers
+    assert responses[1].headers['cache-control'] == 'no-cache'
+
+    assert coalescer.stats() == {
+        'upstream_requests': 2,
+        'coalesced_requests': 9,
+        'unshared_responses': 0,
+        'in_flight': 0,
+    }
+
+
+def test_upstream_call_outlives_the_first_client():
+    coalescer = RequestCoalescer()
+    upstream = GatedUpstream()
+
+    async def first_client_goes_away():
+        first = asyncio.ensure_future(coalescer.run('GET /campaign', upstream.fetch))
+        second = asyncio.ensure_future(coalescer.run('GET /campaign', upstream.fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        upstream.gate.set()
+        return await second
+
+    assert run(first_client_goes_away()).body == b'campaign'
+    assert upstream.fetches == 1
+
+
+def test_upstream_errors_reach_every_request():
+    coalescer = RequestCoalescer()
+    upstream = GatedUpstream(error=ConnectionError('upstream down'))
+
+    results = run(overlapping(coalescer, [('GET /campaign', upstream)] * 3))
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert upstream.fetches == 1
+    assert coalescer.stats()['in_flight'] == 0
+
+
+@pytest.mark.parametrize(
+    'method, headers, allow_authenticated, coalesced',
+    [
+        ('GET', {}, False, True),
+        ('POST', {}, False, False),
+        ('GET', {'member-authentication-jwt': 'abc'}, False, False),
+        ('GET', {'authorization': 'Bearer abc'}, False, False),
+        ('GET', {'member-authentication-jwt': 'abc'}, True, True),
+        # cookies are not credentials, they only keep requests from sharing with others sending different ones
+        ('GET', {'cookie': 'session=abc'}, False, True),
+    ],
+)
+def test_coalesce_key(method, headers, allow_authenticated, coalesced):
+    coalesce_settings = CoalesceSettings(allow_authenticated=allow_authenticated)
+    key = coalesce_key(method, 'https://unit-tests/campaign', Headers(headers), coalesce_settings)
+    assert (key is not None) is coalesced
+
+
+def test_coalesce_key_includes_vary_headers():
+    coalesce_settings = CoalesceSettings(vary_headers={'accept-language'})
+    english = coalesce_key('GET', 'https://unit-tests/', Headers({'accept-language': 'en'}), coalesce_settings)
+    french = coalesce_key('GET', 'https://unit-tests/', Headers({'accept-language': 'fr'}), coalesce_settings)
+    english_again = coalesce_key('GET', 'https://unit-tests/', Headers({'accept-language': 'en'}), coalesce_settings)
+    assert english != french
+    assert english == english_again
+
+
+def test_coalesce_key_includes_visitor_cookies():
+    def key(cookie: str) -> Optional[str]:
+        return coalesce_key('GET', 'https://unit-tests/', Headers({'cookie': cookie}), CoalesceSettings())
+
+    session_cookie = settings.PUBLIC_SESSION_COOKIE_NAME
+    assert key('session=a') != key('session=b')
+    # visitors who only differ by their gatekeeper session share a response
+    assert key(f'{session_cookie}=a') == key(f'{session_cookie}=b') == key('')
+    assert key(f'session=a; {session_cookie}=a') == key(f'{session_cookie}=b; session=a')
+
+
+@pytest.mark.parametrize('headers', [{'set-cookie': 'session=abc'}, {'cache-control': 'private, max-age=60'}])
+def test_personal_responses_are_not_shared(headers):
+    coalescer = RequestCoalescer()
+    upstream = GatedUpstream(body=None, headers=headers)
+
+    responses = run(overlapping(coalescer, [('GET /campaign', upstream)] * 3))
+    # the first request gets the response it caused, and the others wait for it and then go upstream themselves
+    first, *others = [response.body for response in responses]
+    assert first == b'for request 1'
+    assert sorted(others) == [b'for request 2', b'for request 3']
+    assert coalescer.stats()['unshared_responses'] == 2
+
+
+def test_coalesced_route_responses_are_per_request(client):
+    with MockHttpProxy() as m:
+        m.add(re.compile('.*'), 'GET', body='campaign', headers={'Content-Length': '8'}, repeat=True)
+        first = client.get('/campaign/launch')
+        second = client.get('/campaign/launch')
+        # requests one after the other are never coalesced
+        assert m.active_mock.call_count == 2
+
+    assert first.content == second.content == b'campaign'
+    assert first.headers['x-request-id'] != second.headers['x-request-id']
+
+
+def test_streamed_responses_are_not_shared():
+    coalescer = RequestCoalescer()
+    upstream = GatedUpstream(streamed=True)
+
+    responses = run(overlapping(coalescer, [('GET /static/video.mp4', upstream)] * 3))
+    assert all(isinstance(response, StreamingResponse) for response in responses)
+    assert len({id(response) for response in responses}) == 3
+    assert upstream.fetches == 3
+    assert upstream.discards == 0
+
+
+def test_unclaimed_streamed_response_is_released():
+    coalescer = RequestCoalescer()
+    upstream = GatedUpstream(streamed=True)
+
+    async def client_goes_away():
+        first = asyncio.ensure_future(coalescer.run('GET /static/video.mp4', upstream.fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        upstream.gate.set()
+        await asyncio.wait_for(upstream.discarded.wait(), timeout=5)
+
+    run(client_goes_away())
+    assert upstream.discards == 1
+
+
+def test_coalesced_route_still_streams_large_assets(client):
+    body = b'x' * 300_000
+    with patch('liminus.proxy_request.convert_aiohttp_reponse_to_starlette') as buffered, MockHttpProxy() as m:
+        m.add(re.compile('.*'), 'GET', body=body, headers={'content-type': 'image/png'}, repeat=True)
+        response = client.get('/static/hero.png')
+
+    buffered.assert_not_called()
+    assert response.content == body
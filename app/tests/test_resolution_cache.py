@@ -0,0 +1,68 @@
+import re
+
+from liminus.base.backend import Backend, RouteSettings
+from liminus.resolution_cache import Resolution, ResolutionCache
+
+from .mock_http_proxy import MockHttpProxy
+
+
+def make_resolution(backend_name: str) -> Resolution:
+    return Resolution(Backend(name=backend_name), RouteSettings(path='/'))
+
+
+def test_hits_and_misses():
+    cache = ResolutionCache(max_entries_per_backend=10)
+    resolution = make_resolution('a')
+
+    assert cache.get('GET', '/a/1') is None
+    cache.put('GET', '/a/1', resolution)
+    assert cache.get('GET', '/a/1') is resolution
+    assert cache.get('POST', '/a/1') is None
+
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_negative_outcomes_are_cached():
+    cache = ResolutionCache(max_entries_per_backend=10)
+    not_found = Resolution(None)
+    cache.put('GET', '/nowhere', not_found)
+
+    assert cache.get('GET', '/nowhere') is not_found
+
+
+def test_entries_are_capped_per_backend():
+    cache = ResolutionCache(max_entries_per_backend=2)
+    hot = make_resolution('a')
+    cache.put('GET', '/a/hot', hot)
+
+    # random paths matching no backend cannot push out other backends' entries
+    for i in range(100):
+        cache.put('GET', f'/random/{i}', Resolution(None))
+    assert cache.get('GET', '/a/hot') is hot
+    assert cache.stats()['entries'] == {'a': 1, 'None': 2}
+
+    # within a backend, the least recently used entry is evicted
+    cache.put('GET', '/a/cold', make_resolution('a'))
+    cache.get('GET', '/a/hot')
+    cache.put('GET', '/a/new', make_resolution('a'))
+    assert cache.get('GET', '/a/hot') is hot
+    assert cache.get('GET', '/a/cold') is None
+
+
+def test_long_paths_are_not_cached():
+    cache = ResolutionCache(max_entries_per_backend=10)
+    long_path = '/a/' + 'x' * ResolutionCache.MAX_PATH_LENGTH
+    cache.put('GET', long_path, make_resolution('a'))
+
+    assert cache.get('GET', long_path) is None
+
+
+def test_stats_are_reported_on_health_check(client):
+    with MockHttpProxy() as m:
+        m.add(re.compile('.*'), 'GET', body='ok', repeat=True)
+        client.get('/act/cities.php')
+        client.get('/act/cities.php')
+
+    stats = client.get('/health').json()['route_resolution_cache']
+    assert stats['hits'] >= 1
+    assert stats['entries']['web-act'] >= 1
@@ -0,0 +1,213 @@
+import asyncio
+import re
+from unittest.mock import patch
+
+import fakeredis.aioredis
+import pytest
+from starlette.datastructures import Headers
+from starlette.responses import Response, StreamingResponse
+
+from liminus import settings
+from liminus.response_cache import (
+    CACHE_HIT,
+    CACHE_MISS,
+    CacheSettings,
+    ResponseCache,
+    cacheable_entry,
+    parse_cache_control,
+    request_is_cacheable,
+)
+
+from .conftest import run
+from .mock_http_proxy import MockHttpProxy
+
+
+def upstream_response(body=b'cached', status_code=200, **headers) -> Response:
+    response = Response(content=body, status_code=status_code)
+    for name, value in headers.items():
+        response.headers[name.replace('_', '-')] = value
+    return response
+
+
+def test_parse_cache_control():
+    assert parse_cache_control('public, max-age=60, stale-while-revalidate="30", No-Transform') == {
+        'public': None,
+        'max-age': '60',
+        'stale-while-revalidate': '30',
+        'no-transform': None,
+    }
+    assert parse_cache_control('') == {}
+
+
+@pytest.mark.parametrize(
+    'method, headers, cacheable',
+    [
+        ('GET', {}, True),
+        ('HEAD', {}, False),
+        ('POST', {}, False),
+        ('GET', {'authorization': 'Bearer abc'}, False),
+        ('GET', {'member-authentication-jwt': 'abc'}, False),
+        ('GET', {'member-authentication-jwt': ''}, True),
+        ('GET', {'cache-control': 'no-cache'}, False),
+        ('GET', {'cookie': 'a=b'}, True),
+    ],
+)
+def test_request_is_cacheable(method, headers, cacheable):
+    assert request_is_cacheable(method, Headers(headers)) is cacheable
+
+
+@pytest.mark.parametrize(
+    'response, ttl, stale_ttl',
+    [
+        (upstream_response(cache_control='max-age=60'), 60, 30),
+        (upstream_response(cache_control='max-age=60, s-maxage=10'), 10, 30),
+        (upstream_response(cache_control='max-age=6000'), 300, 30),
+        (upstream_response(cache_control='max-age=60, stale-while-revalidate=5'), 60, 5),
+        (upstream_response(status_code=404, cache_control='max-age=60'), 60, 30),
+        (upstream_response(), 20, 30),
+        (upstream_response(cache_control='max-age=0'), None, None),
+        (upstream_response(cache_control='max-age=60, private'), None, None),
+        (upstream_response(cache_control='no-store'), None, None),
+        (upstream_response(cache_control='max-age=60', set_cookie='session=abc'), None, None),
+        (upstream_response(cache_control='max-age=60', member_authentication_jwt='abc'), None, None),
+        (upstream_response(cache_control='max-age=60', vary='*'), None, None),
+        (upstream_response(status_code=500, cache_control='max-age=60'), None, None),
+        (upstream_response(body=b'x' * 2000, cache_control='max-age=60'), None, None),
+    ],
+)
+def test_cacheable_entry(response, ttl, stale_ttl):
+    cache_settings = CacheSettings(default_ttl_seconds=20, stale_while_revalidate_seconds=30, max_entry_bytes=1000)
+    entry = cacheable_entry(response, cache_settings)
+    assert (entry.ttl, entry.stale_ttl) == (ttl, stale_ttl) if entry else ttl is None
+
+
+def test_streamed_responses_are_not_cached():
+    async def body():
+        yield b'streamed'
+
+    assert cacheable_entry(StreamingResponse(body()), CacheSettings(default_ttl_seconds=60)) is None
+
+
+def test_lru_is_bounded_by_bytes():
+    cache = ResponseCache(max_bytes=3000)
+    cache_settings = CacheSettings(default_ttl_seconds=60)
+
+    async def fill():
+        for i in range(5):
+            await cache.store(f'GET /{i}', Headers(), upstream_response(body=b'x' * 500), cache_settings)
+        await cache.lookup('GET /4', Headers(), cache_settings)
+        await cache.lookup('GET /0', Headers(), cache_settings)
+
+    run(fill())
+    stats = cache.stats()
+    assert stats['bytes_held'] <= 3000
+    assert stats['entries'] == 3
+    assert stats['evictions'] == 2
+    assert (stats['hits'], stats['misses'], stats['hit_ratio']) == (1, 1, 0.5)
+
+
+def test_variants_are_stored_by_vary_headers():
+    cache = ResponseCache(max_bytes=100000)
+    cache_settings = CacheSettings(default_ttl_seconds=60)
+    english, french = Headers({'accept-language': 'en'}), Headers({'accept-language': 'fr'})
+
+    async def vary():
+        await cache.store('GET /page', english, upstream_response(b'hello', vary='Accept-Language'), cache_settings)
+        await cache.store('GET /page', french, upstream_response(b'bonjour', vary='Accept-Language'), cache_settings)
+        return [(await cache.lookup('GET /page', headers, cache_settings)) for headers in [english, french]]
+
+    cached_english, cached_french = run(vary())
+    assert cached_english.body == b'hello'
+    assert cached_french.body == b'bonjour'
+
+
+def test_stale_responses_are_revalidated_once():
+    cache = ResponseCache(max_bytes=100000)
+    cache_settings = CacheSettings(default_ttl_seconds=60, stale_while_revalidate_seconds=60)
+    fetches = []
+
+    async def fetch():
+        fetches.append(1)
+        await asyncio.sleep(0.01)
+        return upstream_response(b'fresh')
+
+    async def revalidate():
+        with patch('liminus.response_cache.time', return_value=1000):
+            await cache.store('GET /stale', Headers(), upstream_response(b'old'), cache_settings)
+        with patch('liminus.response_cache.time', return_value=1070):
+            stale = await cache.lookup('GET /stale', Headers(), cache_settings)
+            assert stale.body == b'old'
+            assert not stale.is_fresh(1070)
+            cache.revalidate('GET /stale', Headers(), cache_settings, fetch)
+            cache.revalidate('GET /stale', Headers(), cache_settings, fetch)
+        await asyncio.sleep(0.05)
+        return await cache.lookup('GET /stale', Headers(), cache_settings)
+
+    refreshed = run(revalidate())
+    assert refreshed.body == b'fresh'
+    assert len(fetches) == 1
+    assert cache.stats()['stale_hits'] == 1
+
+
+def test_shared_tier_is_used_across_workers():
+    cache_settings = CacheSettings(default_ttl_seconds=60, shared=True)
+    first_worker, second_worker = ResponseCache(max_bytes=100000), ResponseCache(max_bytes=100000)
+    request_headers = Headers({'accept-language': 'en'})
+
+    async def share():
+        response = upstream_response(b'\x00shared\xff', vary='accept-language', content_type='text/plain')
+        await first_worker.store('GET /shared', request_headers, response, cache_settings)
+        return await second_worker.lookup('GET /shared', request_headers, cache_settings)
+
+    with patch('liminus.redis_client._redis_client', fakeredis.aioredis.FakeRedis()):
+        cached = run(share())
+
+    assert cached.body == b'\x00shared\xff'
+    assert ('content-type', 'text/plain') in cached.headers
+    assert second_worker.stats()['entries'] == 1
+
+
+def test_proxied_responses_are_cached(client):
+    with MockHttpProxy() as m:
+        m.add(
+            re.compile('.*'),
+            'GET',
+            body='app',
+            headers={'Cache-Control': 'max-age=60', 'Content-Length': '3'},
+            repeat=True,
+        )
+        first = client.get('/static/cached-app.js')
+        second = client.get('/static/cached-app.js')
+        assert m.active_mock.call_count == 1
+
+    assert (first.headers['x-gk-cache'], second.headers['x-gk-cache']) == (CACHE_MISS, CACHE_HIT)
+    assert second.content == b'app'
+    assert second.headers['age'] == '0'
+    assert 'response_cache' in client.get('/health').json()
+
+
+def test_session_responses_are_not_cached(client):
+    with MockHttpProxy() as m:
+        headers = {'Cache-Control': 'max-age=60', 'Content-Length': '4', 'Set-Cookie': 'session=abc'}
+        m.add(re.compile('.*'), 'GET', body='page', headers=headers, repeat=True)
+        client.get('/page/with-session')
+        response = client.get('/page/with-session')
+        assert m.active_mock.call_count == 2
+
+    assert response.headers['x-gk-cache'] == CACHE_MISS
+
+
+def test_visitors_with_different_cookies_do_not_share_entries(client):
+    session_cookie = settings.PUBLIC_SESSION_COOKIE_NAME
+    with MockHttpProxy() as m:
+        headers = {'Cache-Control': 'max-age=60', 'Content-Length': '4'}
+        m.add(re.compile('.*'), 'GET', body='page', headers=headers, repeat=True)
+        first = client.get('/page/personal', headers={'Cookie': 'upstream-session=alice'})
+        second = client.get('/page/personal', headers={'Cookie': 'upstream-session=bob'})
+        assert m.active_mock.call_count == 2
+
+        # the gatekeeper's own session id means nothing to the upstream, so it doesn't split the cache
+        third = client.get('/page/personal', headers={'Cookie': f'upstream-session=bob; {session_cookie}=abc'})
+        assert m.active_mock.call_count == 2
+
+    assert [r.headers['x-gk-cache'] for r in (first, second, third)] == [CACHE_MISS, CACHE_MISS, CACHE_HIT]
@@ -0,0 +1,102 @@
+import re
+from typing import List, Optional, Tuple
+
+import pytest
+
+from liminus.backends.donations_service import donation_service_backend
+from liminus.base.backend import Backend, ListenPathSettings, RouteIndex, RouteSettings
+from liminus.constants import HttpMethods
+
+
+def route_matches(route: RouteSettings, path: str) -> bool:
+    if route.path == path:
+        return True
+
+    if route.path_regex and route.path_regex.match(path):
+        return True
+
+    return False
+
+
+def linear_match(
+    routes: List[RouteSettings], method: str, path: str
+) -> Tuple[Optional[RouteSettings], Optional[RouteSettings]]:
+    # exact paths first and then regexes, each in order, which the route index must always agree with
+    route_wrong_method = None
+    for route in routes:
+        if route.path == path:
+            if route.method_matches(method):
+                return route, None
+            route_wrong_method = route
+
+    for route in routes:
+        if route_matches(route, path):
+            if route.method_matches(method):
+                return route, None
+            route_wrong_method = route_wrong_method or route
+
+    return None, route_wrong_method
+
+
+@pytest.fixture
+def backend() -> Backend:
+    backend = Backend(
+        name='routes',
+        listen=ListenPathSettings(prefix='/r/'),
+        routes=[
+            RouteSettings(path='/r/ping', allow_methods=[HttpMethods.GET]),
+            RouteSettings(path='/r/ping', allow_methods=[HttpMethods.HEAD]),
+            RouteSettings(path='/r/both', allow_methods=[HttpMethods.POST]),
+            RouteSettings(path='/r/both'),
+            RouteSettings(path='/r/both', allow_methods=[HttpMethods.GET]),
+            RouteSettings(path_regex=re.compile('/r/api/(one|two)'), allow_methods=[HttpMethods.POST]),
+            RouteSettings(path_regex=re.compile('/r/api/'), allow_methods=[HttpMethods.GET, HttpMethods.POST]),
+            RouteSettings(path='/r/mixed', path_regex=re.compile('/r/mix'), allow_methods=[HttpMethods.PUT]),
+            RouteSettings(path_regex=re.compile('/r/open/')),
+            RouteSettings(path_regex=re.compile('/r/ping'), allow_methods=[HttpMethods.DELETE]),
+        ],
+    )
+    backend.init()
+    return backend
+
+
+@pytest.mark.parametrize(
+    'path',
+    [
+        '/r/ping',
+        '/r/ping/more',
+        '/r/both',
+        '/r/api/one',
+        '/r/api/two/three',
+        '/r/api/zero',
+        '/r/mixed',
+        '/r/mixer',
+        '/r/open/anything',
+        '/r/nothing',
+    ],
+)
+@pytest.mark.parametrize('method', ['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'PROPFIND'])
+def test_route_index_matches_linear_scan(backend, method, path):
+    assert backend.match_route(method, path) == linear_match(backend.routes, method, path)
+
+
+@pytest.mark.parametrize(
+    'method, path',
+    [
+        ('POST', '/donation/public_api/new_donation'),
+        ('GET', '/donation/public_api/new_donation'),
+        ('GET', '/donation/public_api/ping'),
+        ('POST', '/donation/public_api/get_donation_receipt'),
+        ('GET', '/donation/public_api/get_donation_receipt'),
+        ('POST', '/donation/public_api/unknown'),
+    ],
+)
+def test_donation_routes(method, path):
+    routes = donation_service_backend.routes
+    assert RouteIndex(routes).match(method, path) == linear_match(routes, method, path)
+
+
+def test_precomputed_allow_header(backend):
+    route, route_wrong_method = backend.match_route('PATCH', '/r/api/one')
+    assert route is None
+    assert set(route_wrong_method.allow_header.split(',')) == {HttpMethods.POST}
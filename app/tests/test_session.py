@@ -0,0 +1,109 @@
+import json
+from unittest.mock import patch
+
+import pytest
+from starlette.requests import Request
+from starlette.responses import Response
+
+from liminus.base.backend import ReqSettings
+from liminus.middlewares.mixins.session_mixin import (
+    SESSION_TTL_REFRESH_SKIPPED,
+    SESSION_TTL_REFRESHED,
+    session_save_stats,
+)
+from liminus.middlewares.public_session_csrf_jwt import PublicSessionMiddleware
+
+from .conftest import run
+
+
+def make_request(session_id=None) -> Request:
+    headers = []
+    if session_id:
+        cookie = f'{PublicSessionMiddleware.SESSION_ID_COOKIE_NAME}={session_id}'
+        headers.append((b'cookie', cookie.encode()))
+    return Request({'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'headers': headers})
+
+
+def session_key(session_id: str) -> str:
+    return PublicSessionMiddleware()._get_session_redis_key(session_id)
+
+
+async def store_session(redis, session_id: str, data: dict, ttl: int):
+    await redis.setex(session_key(session_id), ttl, json.dumps(data))
+
+
+async def round_trip(middleware, request, response):
+    await middleware.handle_request(request, ReqSettings(), None)
+    await middleware.handle_response(response, request, ReqSettings(), None)
+
+
+def test_session_is_loaded_once_per_request(redis):
+    middleware = PublicSessionMiddleware()
+    request = make_request('abc')
+
+    async def load_twice():
+        await store_session(redis, 'abc', {'strict_expiry': 2 ** 40, 'jwt': 'j'}, 60)
+        first = await middleware._load_session(request)
+        await redis.delete(session_key('abc'))
+        second, is_new = await middleware._ensure_session(request)
+        return first, second, is_new
+
+    first, second, is_new = run(load_twice())
+    assert first is second
+    assert second.session_data['jwt'] == 'j'
+    assert not is_new
+
+
+def save_count(outcome: str) -> int:
+    return session_save_stats().get(PublicSessionMiddleware.SESSION_KEY_PREFIX, {}).get(outcome, 0)
+
+
+@pytest.mark.parametrize(
+    'fraction_left, expect_refresh',
+    [(0.1, True), (0.7, True), (0.8, False), (1, False)],
+)
+def test_unchanged_session_ttl_is_only_refreshed_when_low(redis, fraction_left, expect_refresh):
+    middleware = PublicSessionMiddleware()
+    idle_timeout = middleware.SESSION_IDLE_TIMEOUT_SECONDS
+    ttl_left = int(idle_timeout * fraction_left)
+    refreshed, skipped = save_count(SESSION_TTL_REFRESHED), save_count(SESSION_TTL_REFRESH_SKIPPED)
+
+    async def request_with_session():
+        await store_session(redis, 'abc', {'strict_expiry': 2 ** 40}, ttl_left)
+        with patch.object(middleware, '_store_session_in_cache', wraps=middleware._store_session_in_cache) as store:
+            await round_trip(middleware, make_request('abc'), Response())
+        return store.call_count, await redis.ttl(session_key('abc'))
+
+    stores, ttl = run(request_with_session())
+    assert stores == 0
+    if expect_refresh:
+        assert ttl > idle_timeout - 5
+        assert save_count(SESSION_TTL_REFRESHED) == refreshed + 1
+    else:
+        assert ttl <= ttl_left
+        assert save_count(SESSION_TTL_REFRESH_SKIPPED) == skipped + 1
+
+
+def test_new_and_changed_sessions_are_written(redis):
+    middleware = PublicSessionMiddleware()
+
+    async def new_session():
+        response = Response()
+        await round_trip(middleware, make_request(), response)
+        return response
+
+    response = run(new_session())
+    session_id = response.headers['set-cookie'].split(';')[0].split('=', 1)[1]
+    assert json.loads(run(redis.get(session_key(session_id))))['strict_expiry'] > 0
+
+    async def login():
+        await store_session(redis, 'abc', {'strict_expiry': 2 ** 40}, 60)
+        response = Response(headers={middleware.AUTH_JWT_HEADER: 'new-jwt'})
+        await round_trip(middleware, make_request('abc'), response)
+        return response
+
+    response = run(login())
+    new_session_id = response.headers['set-cookie'].split(';')[0].split('=', 1)[1]
+    assert new_session_id != 'abc'
+    assert json.loads(run(redis.get(session_key(new_session_id))))['jwt'] == 'new-jwt'
+    assert json.loads(run(redis.get(session_key('abc')))) is None
@@ -0,0 +1,54 @@
+import re
+from unittest.mock import patch
+
+import pytest
+from starlette.responses import Response
+
+from liminus.backends.web_act import web_act_backend
+from liminus.base.backend import StreamingSettings
+
+from .mock_http_proxy import MockHttpProxy
+
+
+@pytest.mark.parametrize(
+    'streaming, content_length, content_type, expected',
+    [
+        (StreamingSettings(), None, 'text/html', False),
+        (StreamingSettings(enabled=True), 10, 'text/html', True),
+        (StreamingSettings(enabled=True, min_content_length=100), 10, 'text/html', False),
+        (StreamingSettings(enabled=True, min_content_length=100), 100, 'text/html', True),
+        (StreamingSettings(enabled=True, min_content_length=100), None, 'text/html', True),
+        (StreamingSettings(enabled=True, content_types={'image/'}), 10, 'image/png', True),
+        (StreamingSettings(enabled=True, content_types={'image/'}), None, 'text/html', False),
+        (StreamingSettings(enabled=True, min_content_length=100, content_types={'image/'}), 10, 'image/png', True),
+    ],
+)
+def test_should_stream(streaming, content_length, content_type, expected):
+    assert streaming.should_stream(content_length, content_type) is expected
+
+
+def test_streamed_response_keeps_header_hooks(client):
+    body = b'x' * 200_000
+    route = web_act_backend.routes[0]
+    streaming = StreamingSettings(enabled=True, chunk_size=1024)
+
+    with patch.object(route, 'streaming', streaming), patch(
+        'liminus.proxy_request.convert_aiohttp_reponse_to_starlette'
+    ) as buffered, MockHttpProxy() as m:
+        m.add(
+            re.compile('.*'),
+            'GET',
+            body=body,
+            headers={'content-type': 'text/csv', 'x-powered-by': 'php', 'member-authentication-jwt': 'abc'},
+        )
+        response: Response = client.get('/act/export.csv')
+
+    buffered.assert_not_called()
+    assert response.status_code == 200
+    assert response.content == body
+    # the response hooks still see and change the headers
+    assert response.headers['content-type'] == 'text/csv'
+    assert 'x-powered-by' not in response.headers
+    assert 'member-authentication-jwt' not in response.headers
+    assert 'set-cookie' in response.headers
+    assert 'x-request-id' in response.headers
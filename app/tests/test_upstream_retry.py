@@ -0,0 +1,147 @@
+import asyncio
+import re
+
+import pytest
+from aiohttp import ClientConnectionError, FormData
+from starlette.responses import Response
+
+from liminus.base.backend import RetryPolicy
+from liminus.proxy_request import request_to_backend
+from liminus.upstream_retry import send_with_retry_policy
+from liminus.utils import LatencyWindow
+
+from .conftest import run
+from .mock_http_proxy import MockHttpProxy
+
+
+class FakeUpstreamResponse:
+    def __init__(self, status: int):
+        self.status = status
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+def fake_upstream(*outcomes, delays=None):
+    """each attempt gets the next outcome, either a status code or an exception to raise"""
+    attempts = []
+
+    async def send_attempt(timeout):
+        attempt = len(attempts)
+        attempts.append(timeout)
+        await asyncio.sleep(delays[attempt] if delays else 0)
+        outcome = outcomes[attempt]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeUpstreamResponse(outcome)
+
+    return send_attempt, attempts
+
+
+def test_retries_retryable_statuses_and_connection_errors():
+    send_attempt, attempts = fake_upstream(503, ClientConnectionError(), 200)
+    policy = RetryPolicy(max_attempts=3, backoff_base_seconds=0.001)
+
+    response = run(send_with_retry_policy(send_attempt, policy, None, 10))
+    assert response.status == 200
+    assert len(attempts) == 3
+
+
+def test_last_response_is_returned_once_out_of_attempts():
+    send_attempt, attempts = fake_upstream(502, 503, 200)
+    policy = RetryPolicy(max_attempts=2, backoff_base_seconds=0.001)
+
+    response = run(send_with_retry_policy(send_attempt, policy, None, 10))
+    assert response.status == 503
+    assert not response.released
+    assert len(attempts) == 2
+
+    send_attempt, attempts = fake_upstream(ClientConnectionError(), ClientConnectionError())
+    with pytest.raises(ClientConnectionError):
+        run(send_with_retry_policy(send_attempt, policy, None, 10))
+
+
+def test_other_errors_are_not_retried():
+    send_attempt, attempts = fake_upstream(500, 200)
+    response = run(send_with_retry_policy(send_attempt, RetryPolicy(max_attempts=3), None, 10))
+    assert response.status == 500
+    assert len(attempts) == 1
+
+
+def test_retries_stay_within_the_deadline():
+    send_attempt, attempts = fake_upstream(503, 503, 503, 200)
+    policy = RetryPolicy(max_attempts=4, backoff_base_seconds=0.2, backoff_max_seconds=0.2, deadline_seconds=0.05)
+
+    # a retry whose backoff would end past the deadline is never attempted, and attempts get the remaining time
+    response = run(send_with_retry_policy(send_attempt, policy, None, 10))
+    assert response.status == 503
+    assert len(attempts) < 4
+    assert all(timeout <= 0.05 for timeout in attempts)
+
+
+def test_hedges_after_the_route_p95():
+    latency_window = LatencyWindow()
+    for _ in range(20):
+        latency_window.record(0.01)
+
+    # the first request hangs, so the hedged second request answers first
+    send_attempt, attempts = fake_upstream(200, 200, delays=[1, 0])
+    policy = RetryPolicy(hedge=True)
+
+    response = run(asyncio.wait_for(send_with_retry_policy(send_attempt, policy, latency_window, 10), 0.5))
+    assert response.status == 200
+    assert len(attempts) == 2
+
+
+def test_no_hedging_without_enough_latency_samples():
+    send_attempt, attempts = fake_upstream(200, 200, delays=[0.05, 0])
+    policy = RetryPolicy(hedge=True)
+
+    latency_window = LatencyWindow()
+    response = run(send_with_retry_policy(send_attempt, policy, latency_window, 10))
+    assert response.status == 200
+    assert len(attempts) == 1
+    assert len(latency_window) == 1
+
+
+def test_retry_policy_methods():
+    policy = RetryPolicy(max_attempts=3)
+    assert policy.allows_method('GET') and policy.allows_method('HEAD')
+    assert not policy.allows_method('POST')
+    assert RetryPolicy(retry_unsafe_methods=True).allows_method('POST')
+    assert not RetryPolicy().is_enabled()
+
+
+def test_proxied_get_is_retried(client):
+    with MockHttpProxy() as m:
+        m.add(re.compile('.*'), 'GET', status=503)
+        m.add(re.compile('.*'), 'GET', body='ok')
+        response: Response = client.get('/act/cities.php')
+
+        assert response.status_code == 200
+        assert m.active_mock.call_count == 2
+
+
+@pytest.mark.parametrize('retry_unsafe_methods, expected_calls', [(False, 1), (True, 2)])
+def test_posts_are_only_retried_when_opted_in(retry_unsafe_methods, expected_calls):
+    policy = RetryPolicy(max_attempts=3, backoff_base_seconds=0.001, retry_unsafe_methods=retry_unsafe_methods)
+    params = {'method': 'POST', 'url': 'http://donations/new_donation', 'data': b'{}', 'timeout': 10}
+
+    with MockHttpProxy() as m:
+        m.add(re.compile('.*'), 'POST', status=503)
+        m.add(re.compile('.*'), 'POST', body='ok')
+        run(request_to_backend('req', retry=policy, **params))
+        assert m.active_mock.call_count == expected_calls
+
+
+def test_streamed_bodies_are_never_retried():
+    policy = RetryPolicy(max_attempts=3, retry_unsafe_methods=True)
+    params = {'method': 'POST', 'url': 'http://donations/new_donation', 'data': FormData({'a': 'b'}), 'timeout': 10}
+
+    with MockHttpProxy() as m:
+        m.add(re.compile('.*'), 'POST', status=503)
+        m.add(re.compile('.*'), 'POST', body='ok')
+        response = run(request_to_backend('req', retry=policy, **params))
+        assert response.status_code == 503
+        assert m.active_mock.call_count == 1
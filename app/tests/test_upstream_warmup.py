@@ -0,0 +1,87 @@
+import asyncio
+from timeit import default_timer as timer
+
+from aiohttp import web
+from starlette.datastructures import URL
+
+from liminus import upstream_warmup
+from liminus.base.backend import Backend, ListenPathSettings
+from liminus.upstream_warmup import prewarm_upstreams, start_upstream_keepalive, stop_upstream_keepalive
+
+from .conftest import run
+
+
+async def start_upstream(ping_delay: float = 0):
+    # a local upstream that tracks each distinct connection its pings arrive on
+    upstream = web.Application()
+    seen: dict = {'pings': 0, 'connections': set()}
+
+    async def ping(request):
+        seen['pings'] += 1
+        seen['connections'].add(request.transport.get_extra_info('peername'))
+        await asyncio.sleep(ping_delay)
+        return web.Response(text='pong')
+
+    upstream.router.add_get('/ping', ping)
+    runner = web.AppRunner(upstream, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return seen, runner
+
+
+def make_backend(name: str, runner: web.AppRunner) -> Backend:
+    port = runner.addresses[0][1]
+    backend = Backend(name=name, listen=ListenPathSettings(prefix='/', upstream_dsn=URL(f'http://127.0.0.1:{port}/')))
+    backend.init()
+    return backend
+
+
+def test_prewarm_opens_idle_connections():
+    async def prewarm():
+        seen, runner = await start_upstream(ping_delay=0.05)
+        backend = make_backend('prewarm-test', runner)
+        pool = backend.listen.upstream_pool
+        try:
+            await prewarm_upstreams([backend, Backend(name='no-upstream')], connections=3, timeout=2)
+            assert len(seen['connections']) == 3
+            assert pool.stats()['idle'] == 3
+            assert upstream_warmup.upstream_warmup_stats['connections'] == {'prewarm-test': 3}
+        finally:
+            await pool.close()
+            await runner.cleanup()
+
+    run(prewarm())
+
+
+def test_prewarm_never_delays_startup_beyond_the_timeout():
+    async def prewarm():
+        seen, runner = await start_upstream(ping_delay=5)
+        backend = make_backend('prewarm-slow-test', runner)
+        try:
+            start = timer()
+            duration = await prewarm_upstreams([backend], connections=2, timeout=0.2)
+            assert duration < 1
+            assert timer() - start < 1
+        finally:
+            await backend.listen.upstream_pool.close()
+            await runner.cleanup()
+
+    run(prewarm())
+
+
+def test_keepalive_pings_quiet_upstreams():
+    async def keepalive():
+        seen, runner = await start_upstream()
+        backend = make_backend('keepalive-test', runner)
+        try:
+            start_upstream_keepalive([backend], connections=2, interval=0.05, timeout=1)
+            await asyncio.sleep(0.3)
+            await stop_upstream_keepalive()
+            assert seen['pings'] >= 4
+            assert backend.listen.upstream_pool.stats()['idle'] >= 1
+        finally:
+            await backend.listen.upstream_pool.close()
+            await runner.cleanup()
+
+    run(keepalive())